@@ -1,40 +1,45 @@
-import math
-import statistics
-import random
+import os
+import sys
 from datetime import datetime
 
-from collections import defaultdict
-
-from qgis.PyQt.QtWidgets import QApplication, QMessageBox
+import numpy as np
 
 from qgis.utils import iface
 from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsProcessingContext,
+    QgsProcessingFeedback,
     QgsProject,
-    QgsRasterLayer,
+    QgsTask,
     QgsVectorLayer,
-    QgsPointXY,
-    QgsGeometry,
     QgsFeature,
-    QgsWkbTypes,
     edit,
 )
 from qgis import processing
 
 from tools import tools
 
-
-def fcnExpScale(val, domainMin, domainMax, rangeMin, rangeMax, exponent):
-    if val is None or (domainMin >= domainMax) or (exponent <= 0):
-        return None
-
-    if val >= domainMax:
-        return rangeMax
-    elif val <= domainMin:
-        return rangeMin
-
-    return (
-        (float(rangeMax) - float(rangeMin)) / math.pow(domainMax - domainMin, exponent)
-    ) * math.pow(float(val) - domainMin, exponent) + rangeMin
+# The algorithm itself lives in the hachures package next to this script
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    # run from the console editor without __file__: use the working dir
+    sys.path.insert(0, os.getcwd())
+from hachures.engine import HachureEngine  # noqa: E402
+from hachures.aoi import aoi_window, clip_store  # noqa: E402
+from hachures.cache import DerivativeCache  # noqa: E402
+from hachures.checkpoint import Checkpoint  # noqa: E402
+from hachures.contours import build_contours, trace_contours  # noqa: E402
+from hachures.derivatives import horn  # noqa: E402
+from hachures.headless import array_dataset, make_contours  # noqa: E402
+from hachures.levels import REFINE, adaptive_levels  # noqa: E402
+from hachures.params import needs_dem  # noqa: E402
+from hachures.prefilter import prefilter_settings, smooth, smoothing_name  # noqa: E402
+from hachures.profiling import NullProfiler, Profiler  # noqa: E402
+from hachures.rasters import Grid, TileCache  # noqa: E402
+from hachures.writer import HachureWriter, elevations  # noqa: E402
+from hachures import tiles  # noqa: E402
 
 
 # ============================USER PARAMETERS============================
@@ -43,11 +48,11 @@ def fcnExpScale(val, domainMin, domainMax, rangeMin, rangeMax, exponent):
 # when the slope is at its minimum
 
 # default : pixel units
-params = {"minhs":5, "maxhs":50, "mins":None, "maxs":None, "minslope":15, "maxslope":60, "checks":100, "shift":1}
+params = {"minhs":5, "maxhs":50, "mins":None, "maxs":None, "minslope":15, "maxslope":60, "checks":100, "shift":1, "clip":"polygon", "growth":"full", "contours":"gdal", "levels":"uniform", "prefilter":None, "tracer":"fixed"}
 # map units
-# params = {"minhs":None, "maxhs":None, "mins":20, "maxs":100, "minslope":15, "maxslope":50, "checks":300, "shift":0.9}
+# params = {"minhs":None, "maxhs":None, "mins":20, "maxs":100, "minslope":15, "maxslope":50, "checks":300, "shift":0.9, "clip":"polygon", "growth":"full", "contours":"gdal", "levels":"uniform", "prefilter":None, "tracer":"fixed"}
 # miglos 1m. Pixels units
-# params = {"minhs":3, "maxhs":30, "mins":None, "maxs":None, "minslope":15, "maxslope":60, "checks":300, "shift":0.8}
+# params = {"minhs":3, "maxhs":30, "mins":None, "maxs":None, "minslope":15, "maxslope":60, "checks":300, "shift":0.8, "clip":"polygon", "growth":"full", "contours":"gdal", "levels":"uniform", "prefilter":None, "tracer":"fixed"}
 
 min_hachure_spacing = params["minhs"]
 max_hachure_spacing = params["maxhs"]
@@ -67,706 +72,585 @@ spacing_checks = params["checks"]
 min_slope = params["minslope"]  # degrees
 max_slope = params["maxslope"]
 
+# How hachures are stopped at a contour: "polygon" subtracts the polygon
+# of everything higher than the contour (needs the contour polygons and
+# the STEP 3 chain), "elevation" cuts each hachure where the DEM rises
+# past the contour's elevation, and needs neither
+clip_mode = params["clip"]
+
+# "full" traces each new hachure all the way up-slope at once; "lazy" only
+# grows hachures as far as the next contour, one band per main loop pass,
+# so lines that get clipped never pay for their discarded tail
+growth_mode = params["growth"]
+
+# Where the contours come from: "gdal" runs gdal:contour (and
+# gdal:contour_polygon for the polygon clip), "numpy" traces them all from
+# the DEM in one marching squares pass. The latter makes no polygons, so
+# it needs the "elevation" clip
+contour_mode = params["contours"]
+if contour_mode == "numpy" and clip_mode == "polygon":
+    raise ValueError('numpy contours have no polygons: use "clip":"elevation"')
+
+# Which contours the main loop runs over: "uniform" takes every one of the
+# spacing checks, "adaptive" picks them from the slope of each elevation
+# band, more where the hachure spacing changes quickly, fewer on even
+# slopes and only one per stretch too flat for hachures
+level_mode = params["levels"]
+
+# Smoothing the DEM first speeds up every later stage (fewer contour
+# vertices, fewer zig-zagging traces). None leaves it as it is; "quality",
+# "balanced" & "fast" smooth more and more, scaled to min_hachure_spacing
+prefilter = params["prefilter"]
+
+# How hachures are traced: "fixed" steps 3 pixels at a time in the aspect
+# of the nearest cell; "adaptive" follows the aspect blended between cells
+# (smoother lines) in strides that grow up to 4 times longer where the
+# direction hardly changes, so long even slopes take fewer steps; "flow"
+# walks a D-infinity flow raster made from the DEM, cell to cell, and
+# smooths the jagged lines afterwards (full growth only)
+tracer = params["tracer"]
+
+# None runs everything in this process. Otherwise the DEM is split into
+# tiles of "size" pixels, each run in its own process ("workers" of them
+# at once, default: one per core), with an "overlap" in pixels around each
+# tile (default: long enough for the longest hachure)
+tiling = None
+# tiling = {"size": 2048, "overlap": None, "workers": None}
+
+# None processes the whole DEM. An area of interest (a QgsRectangle, or a
+# polygon QgsGeometry, in the DEM's CRS) only reads a window around it,
+# with a buffer wide enough for hachures from outside to reach in as they
+# would on the whole DEM, and cuts the hachures back to it at the end.
+# (Untiled runs only.)
+aoi = None
+# aoi = iface.mapCanvas().extent()  # what the map shows
+
+# None holds the DEM, slope & aspect in memory as whole arrays. A number of
+# bytes reads them in tiles instead, as the main loop reaches them, keeping
+# at most that much of them (least recently used out first), for DEMs too
+# big for memory. It needs "gdal" contours, "uniform" levels & no
+# prefilter, which all go over the whole DEM. (Untiled runs only, & not
+# with an aoi, whose window is small anyway.)
+raster_budget = None
+# raster_budget = 4 * 1024**3
+out_of_core = raster_budget is not None and tiling is None and aoi is None
+if out_of_core and (
+    contour_mode == "numpy" or level_mode == "adaptive" or prefilter is not None
+):
+    raise ValueError(
+        'raster_budget needs "contours":"gdal", "levels":"uniform" & no prefilter'
+    )
+
+# None adds the hachures to the project as a memory layer (Z from
+# native:setzfromraster). A path ending in .gpkg or .fgb streams them to
+# that file instead, in batches, with Z & a length attribute
+output = None
+# output = "/tmp/hachures.gpkg"
+
+# STEP 1's gdal contours are kept between runs in this folder
+# (None: ~/.cache/hachures), which may grow to cache_size bytes
+cache_folder = None
+cache_size = 2 * 1024**3
+
+# None: no profiling. A .json path: time each stage & main loop contour,
+# count the hot-path operations, write that report there & log a summary
+profile_report = None
+# profile_report = "/tmp/hachures-profile.json"
+profiler = Profiler() if profile_report is not None else NullProfiler()
+
+# None: no checkpoints. A path: the main loop's progress is saved there
+# every checkpoint_every contours or checkpoint_minutes minutes, and when
+# the task is cancelled. Running again with the same DEM &
+# params resumes from it; it's deleted once a run finishes. (Untiled runs
+# only: a tiled run's tiles are short anyway.)
+checkpoint_file = None
+# checkpoint_file = "/tmp/hachures-checkpoint.npz"
+checkpoint_every = 10
+checkpoint_minutes = 10
+
 DEM = iface.activeLayer()  # The layer of interest must be selected
 average_pixel_size = 0.5 * (DEM.rasterUnitsPerPixelX() + DEM.rasterUnitsPerPixelY())
-jump_distance = average_pixel_size * 3
-jump_distance_2 = (jump_distance*1.5) ** 2
 
 if min_spacing is None:
     min_spacing = average_pixel_size * min_hachure_spacing
     max_spacing = average_pixel_size * max_hachure_spacing
 
-spacing_range = max_spacing - min_spacing
-
 TITLE = f"Hachures-{min_spacing:0.0f}-{max_spacing:0.0f}-{min_slope:0.0f}-{max_slope:0.0f}-{slopeShiftExponent:0.1f}"
-SLOPE = 0
-ASPECT = 1
-
-min_slope = fcnExpScale(min_slope, 0, 90, 0, 90, slopeShiftExponent)
-max_slope = fcnExpScale(max_slope, 0, 90, 0, 90, slopeShiftExponent)
-slope_range = max_slope - min_slope
 
 
 # ============================PREPATORY WORK=============================
-tools.log("STEP 1 - Get slope/aspect/contours using built in tools")
-# ---------STEP 1: Get slope/aspect/contours using built in tools--------
-stats = DEM.dataProvider().bandStatistics(1)
-elevation_range = stats.maximumValue - stats.minimumValue
-contour_interval = elevation_range / spacing_checks
-
-
-slope_layer = tools.getLayer("slope")
-aspect_layer = tools.getLayer("aspect")
-filled_contours = tools.getLayer("filled_contours")
-line_contours = tools.getLayer("line_contours")
-
-parameters = {"INPUT": DEM, "OUTPUT": "TEMPORARY_OUTPUT"}
-if slope_layer is None:
-    slope_layer = QgsRasterLayer(
-        processing.run("qgis:slope", parameters)["OUTPUT"], "Slope"
-    )
-    tools.addMapLayer(slope_layer, name="slope", visible=False)
-
-if aspect_layer is None:
-    aspect_layer = QgsRasterLayer(
-        processing.run("qgis:aspect", parameters)["OUTPUT"], "Aspect"
-    )
-    tools.addMapLayer(aspect_layer, name="aspect", visible=False)
-
-parameters["INTERVAL"] = contour_interval
-if filled_contours is None:
-    filled_contours = QgsVectorLayer(
-        processing.run("gdal:contour_polygon", parameters)["OUTPUT"],
-        "Contour Layer",
-        "ogr",
-    )
-    tools.addMapLayer(filled_contours, name="filled_contours", visible=False)
-
-if line_contours is None:
-    line_contours = QgsVectorLayer(
-        processing.run("gdal:contour", parameters)["OUTPUT"], "Contour Layer", "ogr"
-    )
-    tools.addMapLayer(line_contours, name="line_contours", visible=False)
-
-
-# --------STEP 2: Set up variables & prepare rasters for reading---------
-tools.log("STEP 2: Set up variables & prepare rasters for reading")
+tools.log("STEP 1 - Read the DEM & get slope/aspect/contours")
+# ---------STEP 1: Read the DEM & get slope/aspect/contours--------------
 instance = QgsProject.instance()
 crs = instance.crs()
 
-provider = slope_layer.dataProvider()
-extent = provider.extent()
-rows = slope_layer.height()
-cols = slope_layer.width()
-slope_block = provider.block(1, extent, cols, rows)
-
-aspect_block = aspect_layer.dataProvider().block(1, extent, cols, rows)
-
-cell_width = extent.width() / cols
-cell_height = extent.height() / rows
-
-
-# ===========================CLASS DEFINITIONS===========================
-# ------Contour lines are used to check the spacing of the hachures------
-class Contour:
-    def __init__(self, contour_geometry, poly_geometry):
-        self.geometry = contour_geometry
-        self.polygon = poly_geometry
-
-    def ring_list(self):
-        # Returns a list of all rings that this contour is made from
-        if self.geometry.isMultipart():
-            all_rings = [
-                QgsGeometry.fromPolylineXY(line)
-                for line in self.geometry.asMultiPolyline()
-            ]
+dem_provider = DEM.dataProvider()
+dem_source = DEM.source()
+extent = dem_provider.extent()
+rows = DEM.height()
+cols = DEM.width()
+grid = Grid.from_extent(extent, rows, cols)
+full_grid = grid
+if aoi is not None:
+    if tiling is not None:
+        raise ValueError("An area of interest runs untiled: set tiling = None")
+    # From here on the window around the area stands in for the DEM
+    window = aoi_window(grid, aoi, params)
+    grid = grid.window(*window)
+    extent = grid.rectangle()
+    rows, cols = grid.rows, grid.cols
+
+# The engine works on plain arrays, copied once from the DEM block
+NUMPY_TYPES = {
+    Qgis.Byte: np.uint8,
+    Qgis.UInt16: np.uint16,
+    Qgis.Int16: np.int16,
+    Qgis.UInt32: np.uint32,
+    Qgis.Int32: np.int32,
+    Qgis.Float32: np.float32,
+    Qgis.Float64: np.float64,
+}
+
+
+def block_to_array(block):
+    dtype = NUMPY_TYPES[block.dataType()]
+    array = np.frombuffer(bytes(block.data()), dtype=dtype)
+    return array.reshape(block.height(), block.width()).astype(np.float64)
+
+
+dem_nodata = None
+if dem_provider.sourceHasNoDataValue(1):
+    dem_nodata = dem_provider.sourceNoDataValue(1)
+
+smoothing = prefilter_settings(params, grid)
+
+# dem_padded is what the prefilter & Horn run on: the DEM, or with an area
+# of interest its window plus the margin they need (as tiles.read_window
+# reads it), so the window's edges come out as they would on the whole
+# DEM. inner is the window within it.
+dem_array = dem_padded = slope_array = aspect_array = levels = None
+inner = (slice(None), slice(None))
+if out_of_core:
+    # Nothing is read yet: the tiles are, as the main loop needs them
+    raster_cache = TileCache(raster_budget)
+    dem_array, slope_array, aspect_array = tiles.terrain_rasters(
+        dem_source, grid, cache=raster_cache
+    )
+elif (
+    tiling is None
+    or contour_mode == "numpy"
+    or level_mode == "adaptive"
+    or smoothing is not None
+):
+    # The DEM (or the window around the area of interest) is read once,
+    # here on the main thread like every other use of the layer. Tiled
+    # runs read their own windows of it, but numpy contours, adaptive
+    # levels & the prefilter go over the whole thing first.
+    with profiler.stage("read"):
+        if aoi is None:
+            dem_padded = block_to_array(dem_provider.block(1, extent, cols, rows))
         else:
-            all_rings = [self.geometry]
-        return all_rings
-
-    def split_by_hachures(self):
-        # Split this contour according to our current list of hachures
-        all_segments = []
-
-        for line_geometry in self.ring_list():
-
-            intersection_points = []
-            for hachure_geometry in current_hachures:
-                point = line_geometry.intersection(hachure_geometry)
-                if point.wkbType() == QgsWkbTypes.MultiPoint:
-                    intersection_points += [
-                        CutPoint(QgsGeometry.fromPointXY(p), hachure_geometry)
-                        for p in point.asMultiPoint()
-                    ]
-                elif point.wkbType() == QgsWkbTypes.Point:
-                    intersection_points += [CutPoint(point, hachure_geometry)]
-                # The intersection can return Empty or (rarely)
-                # a geometryCollection. We can safely skip over these
-
-            for point in intersection_points:
-                # This tells us where along the line to cut
-                point.cut_location = line_geometry.lineLocatePoint(point.geometry)
-
-            if len(intersection_points) > 0:
-                # If we found intersections, use them to cut the ring
-                contour_segments = cutpoint_splitter(line_geometry, intersection_points)
-                all_segments += contour_segments
-            else:
-                # If not, we should still return the unbroken ring
-                all_segments.append(Segment(line_geometry))
-
-        return all_segments
-
-
-# ----Segments are contour pieces used to space or generate hachures-----
-class Segment:
-    def __init__(self, geom):
-        self.geometry = QgsGeometry(geom)
-        self.length = self.geometry.length()
-        self.slope = None
-        self.hachures = []
-        # Status stores info on how this segment should affect hachures
-        # These values are used later in subsequent_contour
-        self.status = None
-
-    def getStatus(self):
-        # The 0.9 and 2.2 above are thermostat controls. Instead of a
-        # line being "too short" when it exactly falls below its ideal
-        # spacing, we let it get a little tighter to avoid near-parallel
-        # hachures cycling on/off rapidly.
-        if self.status is None:
-            try:
-                if self.getSlope() < min_slope:
-                    self.status = 0
-                elif self.length < (ideal_spacing(self.getSlope()) * 0.9):
-                    self.status = 1
-                elif self.length > (ideal_spacing(self.getSlope()) * 2.2):
-                    self.status = 2
-            except Exception:
-                self.status = 0
-
-        return self.status
-
-    def ring_list(self):
-        return [self.geometry]
-
-    def getSlope(self):
-        if self.slope is None:
-            # Get the average slope under this segment
-            densified_line = self.geometry.densifyByDistance(average_pixel_size)
-            row_col_coords = [xy_to_rc(vertex.x(), vertex.y()) for vertex in densified_line.vertices()]
-            samples = [sample_raster(c, SLOPE) for c in row_col_coords]
-            self.slope = statistics.fmean(samples)
-        
-        return self.slope
-
-
-# --------------CutPoints mark where a contour is to be cut--------------
-class CutPoint:
-    def __init__(self, point_geometry, hachure_geom):
-        self.geometry = point_geometry
-        self.hachure = hachure_geom
-        self.cut_location = None
-
-
-# =========================FUNCTION DEFINITIONS-=========================
-# --------Converts x/y coords to row/col for sampling the rasters--------
-def xy_to_rc(x, y):
-    col = round((x - extent.xMinimum()) / cell_width - 0.5)
-    row = round((extent.yMaximum() - y) / cell_height - 0.5)
-
-    return (row, col)
-
-
-# -------------------Samples the slope or aspect raster------------------
-def sample_raster(location, type=SLOPE):
-    row, col = location
-
-    if row >= rows or col >= cols or row < 0 or col < 0:
-        # i.e., if we're out of bounds
-        return 0
-
-    if type == SLOPE:
-        return slope_block.value(row, col)
-    else:
-        return aspect_block.value(row, col)
-
-
-# -----------Given a slope, find the ideal spacing of hachures-----------
-def ideal_spacing(slope):
-    global slopeShiftExponent
-
-    slope = fcnExpScale(slope, 0, 90, 0, 90, slopeShiftExponent)
-
-    if slope > max_slope:
-        slope = max_slope
-    elif slope < min_slope:
-        # None indicates that slope is too shallow & needs no hachures
-        return None
-
-    # Finds where the slop is in the range of min/max slope
-    # Then normalizes it to the range of min/max spacing
-    slope_pct = (slope - min_slope) / slope_range
-    spacing_qty = slope_pct * spacing_range
-    spacing = max_spacing - spacing_qty
-
-    return spacing
-
-
-# --Take Segments & turn them into dashed lines based on ideal spacing---
-def dash_maker(contour_segment_list):
-
-    output_segments = []
-
-    for contour_segment in contour_segment_list:
-        QApplication.processEvents()
-        slope = contour_segment.getSlope()
-        if slope < min_slope:
-            continue
-
-        spacing = ideal_spacing(slope)
-        if spacing is None:
-            continue
-
-        # We tune the spacing value based on the segment length to ensure
-        # an integer number of dashes. This is rather like the automatic
-        # dash/gap spacing in Adobe Illustrator
-
-        # Our goal here is to split a segment into dashes & gaps, thusly:
-        #  ----    ----    ----    ----    ----    ----    ----
-        # Each dash length = spacing, surrounded by gaps half that width
-        # Thus one unit looks like this: |  ----  |
-
-        total_length = spacing * 2  # the length of a gap + dash + gap
-        total_units = round(contour_segment.length / total_length)
-
-        if total_units == 0:
-            # Just in case we round down to the point of having 0 dashes
-            continue
-
-        dash_gap_length = contour_segment.length / total_units
-
-        dash_width = dash_gap_length / 2
-        # half of our gap-dash-gap is the dash
-
-        gap_width = dash_width / 2
-        start_point = gap_width
-        end_point = dash_width + gap_width
-
-        gc = contour_segment.geometry.constGet()
-        while True:
-            line_substring = gc.curveSubstring(start_point, end_point)
-            output_segments.append(Segment(line_substring))
-
-            end_point += dash_gap_length
+            top, left, bottom, right = tiles.window_padding(
+                full_grid, window, smoothing
+            )
+            padded_grid = full_grid.window(
+                window[0] - top,
+                window[1] - left,
+                rows + top + bottom,
+                cols + left + right,
+            )
+            dem_padded = block_to_array(
+                dem_provider.block(
+                    1, padded_grid.rectangle(), padded_grid.cols, padded_grid.rows
+                )
+            )
+            inner = (slice(top, top + rows), slice(left, left + cols))
+        dem_array = np.ascontiguousarray(dem_padded[inner])
+
+if aoi is not None:
+    valid = np.isfinite(dem_array)
+    if dem_nodata is not None:
+        valid &= dem_array != dem_nodata
+    elevation_range = dem_array[valid].max() - dem_array[valid].min()
+else:
+    stats = dem_provider.bandStatistics(1)
+    elevation_range = stats.maximumValue - stats.minimumValue
+contour_interval = elevation_range / spacing_checks
 
-            if end_point > contour_segment.length:
-                break
+uniform_interval = contour_interval
+if level_mode == "adaptive":
+    # The contours are made on the candidates' finer interval, then
+    # thinned down to the levels kept
+    contour_interval = contour_interval / REFINE
+
+# The contours come from the cache when this DEM, extent & interval were
+# seen before; otherwise they're made once into the cache
+cache = DerivativeCache(cache_folder, cache_size)
+cache_extent = (
+    extent.xMinimum(),
+    extent.yMinimum(),
+    extent.xMaximum(),
+    extent.yMaximum(),
+)
 
-            start_point += dash_gap_length
 
-    if len(output_segments) > 0:
-        return output_segments
+def derivative(task, name, suffix, algorithm, interval):
+    if smoothing is not None or aoi is not None:
+        # gdal:contour only sees the whole DEM on disk, so a smoothed one or
+        # the window around the area goes through GDAL directly, from
+        # memory (the cache key has the window's extent). The array is in
+        # the DEM's CRS, whatever the project's is.
+        if smoothing is not None:
+            name = smoothing_name(smoothing) + "_" + name
+        make = make_contours(
+            array_dataset(dem_array, grid, DEM.crs().toWkt(), dem_nodata),
+            interval,
+            polygonize=algorithm == "gdal:contour_polygon",
+        )
     else:
-        return None
-
-
-# -------------------Starts our first set of hachures--------------------
-def first_contour(contour):
-    global current_hachures
-
-    # Split the contour into even segments to begin
-    contour_segments = even_splitter(contour)
-
-    # Then turn them into dashes
-    dashes = dash_maker(contour_segments)
-
-    if dashes:
-        current_hachures = hachure_generator(dashes)
-
-
-# ----Checks a contour to see where hachures need to be trimmed/begun----
-def subsequent_contour(contour):
-    global current_hachures
-
-    # First we split the contour according to the existing hachures
-
-    split_contour = contour.split_by_hachures()
-
-    # We may need to further subdivide some of these. Some segments may
-    # be too long & their slope calculations are no longer local
-
-    segment_list = []
-
-    for segment in split_contour:
-        QApplication.processEvents()
-        if segment.length > max_spacing * 3:
-            segment_list += even_splitter(segment)
-        else:
-            segment_list += [segment]
-
-    too_short = []
-    too_long = []
-    clip_all = []
-
-    for segment in segment_list:
-        if segment.getStatus() == 1:
-            too_short.append(segment)
-        elif segment.getStatus() == 2:
-            too_long.append(segment)
-        elif segment.getStatus() == 0:
-            clip_all.append(segment)
-
-    # too_short: this segment spans 2 hachures that are too close
-    # too_long: segment's 2 hachures are too far apart
-    # clip_all: this segment's slope is low enough that hachures stop
-
-    # We first find which hachures must be clipped off
-
-    to_clip = []
-
-    for seg in clip_all:
-        to_clip.extend(seg.hachures)
-
-    for seg in too_short:
-        hachures = seg.hachures
-        if len(hachures) == 2:
-            # Some segments won't touch enough hachures
-            random.shuffle(hachures)
-            to_clip.append(hachures[0])
-
-    # to_clip can have duplicates. A hachure may have too_short segments
-    # on each side, and both of them choose that particular hachure as
-    # the 1 that needs to be clipped off. So we remove duplicates:
-
-    to_clip = list(set(to_clip))
-
-    # Remove those to be clipped from the current hachures
-    current_hachures = [g for g in current_hachures if g not in to_clip]
-
-    # Clip them, then put them back
-    clipped_hachures = haircut(contour, to_clip)
-    current_hachures += clipped_hachures
-
-    # Let's next deal with adding new hachures to the too_long segments
-
-    made_additions = False
-    if len(too_long) > 0:
-        dashes = dash_maker(too_long)
-
-        if dashes:  # this could come back with None so we must check
-            made_additions = True
-            additions = hachure_generator(dashes)
-
-    if made_additions:
-        current_hachures += additions
-
-
-# ----Clips off hachures that need to stop at this particular contour----
-def haircut(contour, hachure_list):
-
-    contour_poly_geometry = contour.polygon
-
-    clipped = []
-    for hachure_geo in hachure_list:
-        clipped.append(hachure_geo.difference(contour_poly_geometry))
-
-    return clipped
-
-
-# --Generates new hachures starting at the middle of any given segment---
-def hachure_generator(segment_list):
-
-    # First we need the midpoint in each line, to begin our hachure from
-    start_points = []
-
-    for segment in segment_list:
-        midpoint = segment.geometry.interpolate(segment.length / 2)
-        start_points.append(midpoint.asPoint())
-
-    # Next loop through the start_points & make hachures
-
-    geom_list = []
-
-    for coords in start_points:
-        line_coords = [coords]
-
-        x, y = coords
-        rc = xy_to_rc(x, y)
-        value = sample_raster(rc, ASPECT)  # 1= Get the aspect value
-
-        if value == 0:  # if we go out of bounds, stop this line
-            continue
-
-        # And here I try to recall 11th-grade trigonometry
-
-        value += 180
-        new_x = x + math.sin(math.radians(value)) * jump_distance
-        new_y = y + math.cos(math.radians(value)) * jump_distance
-
-        line_coords += [(new_x, new_y)]
-
-        for _ in range(0, 150):
-            # this loop is a failsafe in case other checks below fail
-            # to stop the hachure when they should
-
-            x, y = line_coords[-1]
-            rc = xy_to_rc(x, y)
-            value = sample_raster(rc, ASPECT)  # get the aspect value
-            if value == 0:  # we're out of bounds of the raster
-                del line_coords[-1]
-                break
-
-            slope = sample_raster(rc, SLOPE)  # the slope, too
-            if slope < min_slope:
-                # if we hit shallow slopes, lines should end
-                del line_coords[-1]
-                break
-
-            # Hachures often bounce back and forth in shallow slopes &
-            # should stop. If lines are zig-zagging, every other point
-            # will be separated by only a small distance
-
-            if len(line_coords) > 3 and sqdist(line_coords[-1], line_coords[-3]) < jump_distance_2:
-                # Snip off the last couple points if we've gone bad:
-                del line_coords[-2:]
-                break
-
-            value += 180
-            new_x = x + math.sin(math.radians(value)) * jump_distance
-            new_y = y + math.cos(math.radians(value)) * jump_distance
-            line_coords += [(new_x, new_y)]
+        def make(path):
+            # Run on the DEM's file rather than the layer, which belongs to
+            # the main thread. The task manager's progress bar follows
+            # GDAL's, and cancelling the task cancels it.
+            feedback = QgsProcessingFeedback()
+
+            def relay(percent):
+                task.setProgress(percent)
+                if task.isCanceled():
+                    feedback.cancel()
+
+            feedback.progressChanged.connect(relay)
+            processing.run(
+                algorithm,
+                {"INPUT": dem_source, "INTERVAL": interval, "OUTPUT": path},
+                context=QgsProcessingContext(),
+                feedback=feedback,
+            )
 
-        if len(line_coords) > 1:
-            # if we stopped before we even got 2 points, don't bother
-            geom_list.append(make_lines(line_coords))
+    return cache.get(dem_source, cache_extent, name, suffix, make, interval)
+
+
+# ===========================BACKGROUND TASKS============================
+# Everything from here on runs in a QgsTask, so QGIS stays usable during
+# long runs: the task manager shows the progress & can cancel it at any
+# time. STEP 1's independent stages are subtasks running side by side
+# (slope & aspect, each contour run), after the prefilter when there is
+# one. The task itself prepares the contours & runs the main loop once
+# they're all done; the hachures are added to the map back on the main
+# thread. Each stage leaves what it makes in these globals.
+line_contours_path = filled_contours_path = None
+
+
+def prefilter_stage(task):
+    # Slope, aspect & the contours are all made from the smoothed DEM
+    # (tiled runs smooth each window the same way)
+    global dem_array, dem_padded
+    started = datetime.now()
+    with profiler.stage("prefilter"):
+        dem_padded = smooth(dem_padded, *smoothing, dem_nodata)
+        dem_array = np.ascontiguousarray(dem_padded[inner])
+    tools.log(
+        "Prefilter {}: {} kernel, sigma {:.2f} px, {}".format(
+            prefilter, smoothing[0], smoothing[1], datetime.now() - started
+        )
+    )
 
-    return geom_list
 
+def derivatives_stage(task):
+    # Slope & aspect (same Horn kernel as qgis:slope & qgis:aspect) come
+    # straight from the DEM in memory. Tiled runs do the same per window.
+    global slope_array, aspect_array, levels
+    with profiler.stage("derivatives"):
+        slope_array, aspect_array = horn(
+            dem_padded, grid.cell_width, grid.cell_height, dem_nodata
+        )
+        slope_array = np.ascontiguousarray(slope_array[inner])
+        aspect_array = np.ascontiguousarray(aspect_array[inner])
 
-# ---------------------Cartesian square distance calculator---------------------
-def sqdist(one, two):
-    x1, y1 = one
-    x2, y2 = two
-    return (x1 - x2) ** 2 + (y1 - y2) ** 2
+    if level_mode == "adaptive":
+        levels = adaptive_levels(
+            dem_array, slope_array, params, uniform_interval, dem_nodata
+        )
+        tools.log(
+            "Adaptive levels: {} instead of {}".format(len(levels), spacing_checks)
+        )
 
-# -------Turns list of tuples of xy coodinates into a line Geom-------
-def make_lines(coord_list):
-    points = [QgsPointXY(x, y) for x, y in coord_list]
-    polyline = QgsGeometry.fromPolylineXY(points)
 
-    return polyline
+def line_contours_stage(task):
+    global line_contours_path, contour_lines
+    if contour_mode == "numpy":
+        # One marching squares pass over the DEM gives every level's
+        # contour already dissolved & sorted, so there's nothing to
+        # prepare
+        tools.log("Contours: marching squares")
+        with profiler.stage("line contours"):
+            contour_lines = trace_contours(
+                dem_array, grid, contour_interval, dem_nodata, levels
+            )
+        return
 
-# -----Splits a line  into even segments based on max_spacing-----
-def even_splitter(contourOrSeg):
-    spacing = max_spacing * 3
-    output_segments = []
+    with profiler.stage("line contours"):
+        line_contours_path = derivative(
+            task, "line_contours", ".gpkg", "gdal:contour", contour_interval
+        )
 
-    for line_geometry in contourOrSeg.ring_list():
-        length = line_geometry.length()
-        # start_point = 0
-        # end_point = spacing
 
-        i = spacing
-        cut_locations = []
-        while i < length:
-            cut_locations.append(i)
-            i += spacing
+def filled_contours_stage(task):
+    global filled_contours_path
+    with profiler.stage("filled contours"):
+        filled_contours_path = derivative(
+            task,
+            "filled_contours",
+            ".gpkg",
+            "gdal:contour_polygon",
+            contour_interval,
+        )
 
-        output_segments.extend(master_splitter(line_geometry, cut_locations))
 
-    return output_segments
+def prepare_contours():
+    # In elevation mode hachures are cut using the DEM, so the contour
+    # polygons aren't needed
+    tools.log(
+        "Derivative cache: {} hits, {} misses".format(cache.hits, cache.misses)
+    )
+    tools.log("Contour preparation")
+    polygon_features = boundary = None
+    if clip_mode == "polygon":
+        filled_contours = QgsVectorLayer(filled_contours_path, "Contour Layer", "ogr")
+        polygon_features = [
+            (f.geometry(), f["ELEV_MIN"], f["ELEV_MAX"])
+            for f in filled_contours.getFeatures()
+        ]
+        boundary = filled_contours.extent()
+
+    line_contours = QgsVectorLayer(line_contours_path, "Contour Layer", "ogr")
+    line_features = [
+        (f.geometry(), f.attributeMap()["ELEV"]) for f in line_contours.getFeatures()
+    ]
+    return build_contours(line_features, polygon_features, boundary, profiler, levels)
 
 
-# ---Takes a single line geometry and splits it at a list of locations---
-def master_splitter(line_geometry, cut_locations):
-    start_point = 0
-    cut_locations.append(line_geometry.length())
-    cut_locations.sort()
+# ========MAIN LOOP: Iterate through Contours to generate hachures=======
+t0 = None
+firstContour = None  # not 0 when resuming from a checkpoint
 
-    segment_list = []
 
-    constline = line_geometry.constGet()
-    for cut_spot in cut_locations:
-        line_substring = constline.curveSubstring(start_point, cut_spot)
-        segment_list.append(Segment(line_substring))
-        start_point = cut_spot
+def progressLogAndContinueOrNot(task, i, tot):
+    # Called before each contour (after each tile when tiled): moves the
+    # progress bar, logs the ETA, and stops the run once it's cancelled
+    global firstContour
 
-    return segment_list
+    if firstContour is None:
+        firstContour = i
+    done = i - firstContour
 
+    task.setProgress(100 * i / tot)
+    dt = datetime.now() - t0
+    d = (tot - i) * (dt / (done + 1))
+    d = d.total_seconds()
+    tools.log("{}/{} reste {:.0f}s".format(i, tot, d), delay=5)
 
-# ---Like master_splitter, but uses CutPoints instead of cut locations---
-def cutpoint_splitter(line_geometry, CutPoint_list):
-    CutPoint_list.sort(key=lambda x: x.cut_location)
+    return not task.isCanceled()
 
-    # CutPoints hold info on what hachure generated them; we want to add
-    # that info to the subsequent segments
 
-    segment_list = []
+def main_loop(task):
+    global t0, contour_lines, hachure_store, avoided, tested
 
-    # Add first segment
-    constline = line_geometry.constGet()
-    line_substring = constline.curveSubstring(
-        0, CutPoint_list[0].cut_location
-    )
-    segment_list.append(Segment(line_substring))
-
-    # Then do all the middle cuts & append hachure data to the Segments
-    for i in range(0, len(CutPoint_list)):
-        start_point = CutPoint_list[i]
-        start_location = start_point.cut_location
-        if i == len(CutPoint_list) - 1:
-            # Checks if we're at end of the list & handles final segment
-            end_location = line_geometry.length()
-        else:
-            end_point = CutPoint_list[i + 1]
-            end_location = end_point.cut_location
+    if contour_mode != "numpy":
+        contour_lines = prepare_contours()
 
-        line_substring = constline.curveSubstring(
-            start_location, end_location
+    tools.log("MAIN LOOP 1 : Iterate through Contours")
+    t0 = datetime.now()
+    profiler.start("main loop")
+    if tiling is None:
+        engine = HachureEngine(
+            params,
+            grid,
+            slope_array,
+            aspect_array,
+            dem_array if needs_dem(params) else None,
+            profiler=profiler,
+            nodata=dem_nodata,
         )
-        new_segment = Segment(line_substring)
-        segment_list.append(new_segment)
-        if i != len(CutPoint_list) - 1:
-            new_segment.hachures = [start_point.hachure, end_point.hachure]
-
-    return segment_list
-
-
-# ===============FUNCTIONS OVER; BEGIN CONTOUR PREPARATION===============
-# -STEP 1: Process the contours so that they are all in the needed format
-tools.log("STEP 1: Process the contours")
-
-# instance.addMapLayer(filled_contours,False)
-# Add filled_contours as hidden layer so I can work with it below
-
-# First we sort the contours from low elevation to high.
-# They probably were already sorted this way, but let's not chance it.
-
-contour_polys = [f for f in filled_contours.getFeatures()]
-contour_polys.sort(key=lambda x: x.attributeMap()["ELEV_MIN"])
-
-# Each contour poly will be turned into a new polygon showing all areas
-# that are *higher* than that contour
+        checkpoint = None
+        if checkpoint_file is not None:
+            checkpoint = Checkpoint(
+                checkpoint_file, checkpoint_every, checkpoint_minutes, dem_source
+            )
+        hachure_store = engine.run(
+            contour_lines,
+            lambda i, tot: progressLogAndContinueOrNot(task, i, tot),
+            checkpoint,
+        )
+        if checkpoint is not None:
+            tools.log(
+                "Checkpoint: resumed after {} contours, {} saves".format(
+                    checkpoint.resumed, checkpoint.saves
+                )
+            )
+        avoided, tested = engine.index.avoided, engine.index.tested
+        profiler.stop("main loop")
+        if out_of_core:
+            tools.log(
+                "Raster tiles: {} hits, {} misses, {} evicted".format(
+                    raster_cache.hits, raster_cache.misses, raster_cache.evictions
+                )
+            )
+        if task.isCanceled():
+            return None
 
-# -----STEP 2: Make a simple rectangle poly covering contours' extent----
-tools.log("STEP 2: Make a simple rectangle")
-extent = filled_contours.extent()
-boundary_polygon = QgsGeometry.fromRect(extent)
+        if aoi is not None:
+            with profiler.stage("aoi clip"):
+                hachure_store = clip_store(hachure_store, aoi)
 
-# --STEP 3: Iterate through each contour poly and subtract it from our---
-tools.log("STEP 3: Iterate")
-# ------rectangle, thus yielding rectangles with varying size holes------
+        profiler.start("output")
+        if writer is not None:
+            writer.write_store(hachure_store, elevations(grid, dem_array, dem_nodata))
+        profiler.stop("output")
+    else:
+        # Tiles write their hachures (with Z) straight to the file as they
+        # finish, so only an unwritten tile's worth is ever held
+        hachure_store, counters = tiles.run_tiled(
+            params,
+            grid,
+            contour_lines,
+            dem_source,
+            tile_size=tiling["size"],
+            overlap=tiling["overlap"],
+            workers=tiling["workers"],
+            progress=lambda done, tot: progressLogAndContinueOrNot(task, done, tot),
+            sink=writer,
+            profiler=profiler,
+        )
+        avoided, tested = counters["avoided"], counters["tested"]
+        profiler.stop("main loop")
+        if task.isCanceled():
+            return None
 
-contour_geometries = [f.geometry() for f in contour_polys]
+    return True
 
-# Loop below starts with our boundary rectangle, subtracts the lowest
-# elevation poly from it, and stores the result. It then subtracts the
-# 2nd-lowest poly from that result and stores that. And so on, each time
-# subtracting the next-lowest poly from the result of the last operation
 
-working_geometry = boundary_polygon
-contour_differences = []
+# =================OUTPUT: back on the main thread=======================
+def add_hachures(exception, result=None):
+    if writer is not None:
+        writer.close()
+    if result is None:
+        # Cancelled (with its checkpoint saved, if any), or a stage failed
+        tools.log("Stopped" if exception is None else "Stopped: {}".format(exception))
+        return
 
-for geom in contour_geometries[:-1]:
-    # We drop the last one because it's going to be empty
-    working_geometry = working_geometry.difference(geom)
-    contour_differences.append(working_geometry)
+    tools.log(
+        "Spatial index: {} of {} intersection tests avoided".format(
+            avoided, avoided + tested
+        )
+    )
 
-# ------------------STEP 4: Dissolve the contour lines-------------------
-tools.log("STEP 4: Dissolve")
-contour_dict = defaultdict(list)
+    profiler.start("output")
+    if writer is not None:
+        tools.log("{} hachures written to {}".format(writer.count, output))
+        hachureLayer = QgsVectorLayer(output, "Hachures", "ogr")
 
-for feature in line_contours.getFeatures():
-    contour_dict[feature.attributeMap()["ELEV"]].append(feature)
-    # this dict is now of the form {Elevation: [list of features]}
+    else:
+        # Add it to the map & also add length attributes so user can filter
+        hachureLayer = QgsVectorLayer("linestring", "Hachures", "memory")
+        hachureLayer.setCrs(crs)
+
+        with edit(hachureLayer):
+            feats = []
+            for hachure_id in hachure_store.ids():
+                # This is the only place the finished hachures become
+                # geometries
+                newf = QgsFeature()
+                newf.setGeometry(hachure_store.geometry(hachure_id))
+                feats.append(newf)
+            hachureLayer.dataProvider().addFeatures(feats)
+
+        r = processing.run(
+            "native:setzfromraster",
+            {
+                "INPUT": hachureLayer,
+                "RASTER": DEM,
+                "BAND": 1,
+                "NODATA": 0,
+                "SCALE": 1,
+                "OFFSET": 0,
+                "OUTPUT": "TEMPORARY_OUTPUT",
+            },
+        )
 
-keys = list(contour_dict.keys())
-keys.sort()
+        hachureLayer = r["OUTPUT"]
+        hachureLayer.setName("Hachures")
 
-# we need to sort these low-to-high so they match the order of the
-# contour_differences we just generated
+    hachureLayer.setTitle(TITLE)
 
-dissolved_lines = []
-for key in keys:
-    geometries = [f.geometry() for f in contour_dict[key]]
-    combined_geo = QgsGeometry.collectGeometry(geometries)
-    dissolved_lines.append(combined_geo)
+    instance.addMapLayer(hachureLayer)
+    profiler.stop("output")
 
-# then turn them into Contours for use by the main loop
-contour_lines = []
-for dissolved_line, poly_geometry in zip(dissolved_lines, contour_differences):
-    contour_lines.append(Contour(dissolved_line, poly_geometry))
+    if profile_report is not None:
+        profiler.write(profile_report)
+        for line in profiler.summary():
+            tools.log(line)
 
-# each Contour carrys a record of its corresponding poly for use by haircut
+    tools.log("FIN !!")
 
-# instance.removeMapLayer(filled_contours) # no longer needed
 
-# ========MAIN LOOP: Iterate through Contours to generate hachures=======
-tools.log("MAIN LOOP 1 : Iterate through Contours")
-
-current_hachures = None
-
-# As we iterate through, it's possible that it takes a few contour lines
-# before the slope is high enough (i.e. > min_slope) to make hachures.
-# So each time, the if statement checks to see if we got anything back.
-# Otherwise it moves to the next line and again tries to generate
-# a set of starting hachures.
-t0 = datetime.now()
-okToContinue = False
-
-
-def progressLogAndContinueOrNot(i, tot, limit=300):
-    global t0, okToContinue
-
-    QApplication.processEvents()
-
-    t1 = datetime.now()
-    dt = t1 - t0
-    if dt.total_seconds() > 5 and not okToContinue:
-        reste = (tot - i) * (dt / (i + 1))
-        if reste.total_seconds() > limit:
-            d = reste.total_seconds()
-            r = QMessageBox.question(
-                None,
-                f"Traitement long ({d:.0f} s)",
-                "Continuer ?",
-                QMessageBox.Yes | QMessageBox.No,
-            )
-            okToContinue = r == QMessageBox.Yes
-            if not okToContinue:
-                return False
+def stage_finished(name):
+    # A subtask that fails stops the whole run; this logs why
+    def finished(exception, result=None):
+        if exception is not None:
+            tools.log("{} stopped: {}".format(name, exception))
 
-    d = (tot - i) * (dt / (i + 1))
-    d = d.total_seconds()
-    tools.log("{}/{} reste {:.0f}s".format(i, tot, d), delay=5)
+    return finished
 
-    return True
 
+# With an output file, hachures are streamed to it as they're handed over
+writer = None
+if output is not None:
+    writer = HachureWriter(output, crs.toWkt())
 
-fc = len(contour_lines)
-for i, line in enumerate(contour_lines):
-    if not progressLogAndContinueOrNot(i, fc, limit=300):
-        break
+task = QgsTask.fromFunction(TITLE, main_loop, on_finished=add_hachures)
 
-    if current_hachures:
-        subsequent_contour(line)
-    else:
-        first_contour(line)
-
-# We sometimes pick up errant duplicates, so let's clean the final list
-current_hachures = list(set(current_hachures))
-
-# Add it to the map & also add length attributes so user can filter
-hachureLayer = QgsVectorLayer("linestring", "Hachures", "memory")
-hachureLayer.setCrs(crs)
-
-with edit(hachureLayer):
-    feats = []
-    for g in current_hachures:
-        newf = QgsFeature()
-        newf.setGeometry(g)
-        feats.append(newf)
-    hachureLayer.dataProvider().addFeatures(feats)
-
-r = processing.run(
-    "native:setzfromraster",
-    {
-        "INPUT": hachureLayer,
-        "RASTER": DEM,
-        "BAND": 1,
-        "NODATA": 0,
-        "SCALE": 1,
-        "OFFSET": 0,
-        "OUTPUT": "TEMPORARY_OUTPUT",
-    },
+prefilter_task = None
+first = []
+if smoothing is not None:
+    prefilter_task = QgsTask.fromFunction(
+        "Prefilter", prefilter_stage, on_finished=stage_finished("Prefilter")
+    )
+    first = [prefilter_task]
+    task.addSubTask(prefilter_task, [], QgsTask.ParentDependsOnSubTask)
+
+derivatives_task = None
+if not out_of_core and (tiling is None or level_mode == "adaptive"):
+    derivatives_task = QgsTask.fromFunction(
+        "Slope & aspect",
+        derivatives_stage,
+        on_finished=stage_finished("Slope & aspect"),
+    )
+    task.addSubTask(derivatives_task, first, QgsTask.ParentDependsOnSubTask)
+
+# numpy contours are thinned to the adaptive levels as they're traced, so
+# they wait for the slope; gdal's are thinned later & don't
+line_first = first
+if contour_mode == "numpy" and level_mode == "adaptive":
+    line_first = first + [derivatives_task]
+task.addSubTask(
+    QgsTask.fromFunction(
+        "Contour lines",
+        line_contours_stage,
+        on_finished=stage_finished("Contour lines"),
+    ),
+    line_first,
+    QgsTask.ParentDependsOnSubTask,
 )
+if contour_mode != "numpy" and clip_mode == "polygon":
+    task.addSubTask(
+        QgsTask.fromFunction(
+            "Contour polygons",
+            filled_contours_stage,
+            on_finished=stage_finished("Contour polygons"),
+        ),
+        first,
+        QgsTask.ParentDependsOnSubTask,
+    )
 
-hachureLayer = r["OUTPUT"]
-hachureLayer.setName("Hachures")
-hachureLayer.setTitle(TITLE)
-
-instance.addMapLayer(hachureLayer)
-
-tools.log("FIN !!")
-
+QgsApplication.taskManager().addTask(task)
@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
+
+# Benchmarks the engine on SampleDEM.tif (or any DEM) over the parameter
+# presets from Hachure Generator.py, and checks the results against a
+# stored baseline:
+#
+#   python benchmarks/bench.py --update      # record benchmarks/baseline.json
+#   python benchmarks/bench.py               # compare, exit 1 on drift
+#   python benchmarks/bench.py --prefilter balanced
+#                                            # + time saved by a prefilter
+#   python benchmarks/bench.py --tracers adaptive flow
+#                                            # + other tracers, side by side
+#
+# Every run is seeded, so the random too_short clipping picks the same
+# hachures each time and the output should match the baseline exactly;
+# the output tolerance only absorbs GEOS/platform differences. Each preset
+# runs in a fresh process, so its peak RSS is its own.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+# The three parameter sets from the script's USER PARAMETERS
+PRESETS = {
+    "default": {"minhs": 5, "maxhs": 50, "mins": None, "maxs": None, "minslope": 15, "maxslope": 60, "checks": 100, "shift": 1},
+    "map_units": {"minhs": None, "maxhs": None, "mins": 20, "maxs": 100, "minslope": 15, "maxslope": 50, "checks": 300, "shift": 0.9},
+    "miglos": {"minhs": 3, "maxhs": 30, "mins": None, "maxs": None, "minslope": 15, "maxslope": 60, "checks": 300, "shift": 0.8},
+}
+
+DEFAULT_DEM = os.path.join(os.path.dirname(HERE), "SampleDEM.tif")
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+
+# -------------Peak resident memory of this process, in MiB---------------
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        # Windows has no resource module; psutil's peak_wset is the same idea
+        try:
+            import psutil
+
+            return psutil.Process().memory_info().peak_wset / 2**20
+        except (ImportError, AttributeError):
+            return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+# ---------------One seeded run, in its own process------------------------
+def run_preset(dem_path, params, seed):
+    from hachures.headless import generate
+
+    started = time.perf_counter()
+    store = generate(dem_path, params, seed=seed)
+    runtime = time.perf_counter() - started
+
+    total_length = 0.0
+    for hachure_id in store.ids():
+        xs, ys = store.coords(hachure_id)
+        total_length += float(np.hypot(np.diff(xs), np.diff(ys)).sum())
+
+    return {
+        "runtime": runtime,
+        "peak_rss_mib": peak_rss(),
+        "hachures": len(store),
+        "total_length": total_length,
+    }
+
+
+def measure(dem_path, params, seed, repeat):
+    # The fastest of the repeats, each in a fresh spawned process
+    results = []
+    for _ in range(repeat):
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run_preset, dem_path, params, seed).result())
+
+    best = min(results, key=lambda r: r["runtime"])
+    rss = [r["peak_rss_mib"] for r in results if r["peak_rss_mib"] is not None]
+    best["peak_rss_mib"] = max(rss) if rss else None
+    return best
+
+
+# ------------Checks one preset's results against the baseline------------
+def drift(result, baseline, runtime_tolerance, output_tolerance):
+    problems = []
+
+    limit = baseline["runtime"] * (1 + runtime_tolerance)
+    if result["runtime"] > limit:
+        problems.append(
+            "runtime {:.2f}s > {:.2f}s (baseline {:.2f}s)".format(
+                result["runtime"], limit, baseline["runtime"]
+            )
+        )
+
+    for key in ("hachures", "total_length"):
+        expected = baseline[key]
+        allowed = abs(expected) * output_tolerance
+        if abs(result[key] - expected) > allowed:
+            problems.append(
+                "{} {:,.1f} vs baseline {:,.1f}".format(key, result[key], expected)
+            )
+
+    return problems
+
+
+def print_row(name, result, status):
+    rss = result["peak_rss_mib"]
+    print(
+        "{:<12}{:>10.2f}{:>12}{:>10}{:>16,.0f}  {}".format(
+            name,
+            result["runtime"],
+            "{:.0f}".format(rss) if rss is not None else "-",
+            result["hachures"],
+            result["total_length"],
+            status,
+        )
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hachure engine against a stored baseline"
+    )
+    parser.add_argument("--dem", default=DEFAULT_DEM)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--presets", nargs="+", choices=sorted(PRESETS), default=sorted(PRESETS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per preset, fastest kept")
+    parser.add_argument("--runtime-tolerance", type=float, default=0.25, help="allowed slowdown, as a fraction")
+    parser.add_argument("--output-tolerance", type=float, default=0.01, help="allowed change in count/length, as a fraction")
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--prefilter", help="also run each preset with this DEM prefilter and report the time it saves")
+    parser.add_argument("--tracers", nargs="+", choices=["fixed", "adaptive", "flow"], default=[], help="also run each preset with these tracers and report the time they save")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.update:
+        # Timings only mean something on the machine that recorded them,
+        # so none ship with the repo
+        print(
+            "No baseline at {}: run with --update to record one, "
+            "then compare against it\n".format(args.baseline)
+        )
+
+    results = {}
+    failed = False
+    print("{:<12}{:>10}{:>12}{:>10}{:>16}  {}".format("preset", "seconds", "peak MiB", "hachures", "length", "status"))
+    for name in args.presets:
+        result = measure(args.dem, PRESETS[name], args.seed, args.repeat)
+        results[name] = result
+
+        if args.update:
+            status = "recorded"
+        elif name not in baseline:
+            status = "no baseline, run --update"
+        else:
+            problems = drift(result, baseline[name], args.runtime_tolerance, args.output_tolerance)
+            status = "; ".join(problems) if problems else "ok"
+            failed |= bool(problems)
+
+        print_row(name, result, status)
+
+        # Not part of the baseline: just how much faster each variant
+        # runs, and how different its output is
+        variants = []
+        if args.prefilter:
+            variants.append(("+" + args.prefilter, {"prefilter": args.prefilter}))
+        for tracer in args.tracers:
+            variants.append(("+" + tracer, {"tracer": tracer}))
+        for label, changes in variants:
+            params = {**PRESETS[name], **changes}
+            variant = measure(args.dem, params, args.seed, args.repeat)
+            saved = result["runtime"] - variant["runtime"]
+            print_row(
+                label,
+                variant,
+                "saved {:.2f}s ({:.0%})".format(saved, saved / result["runtime"]),
+            )
+
+    if args.update:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import math
+
+import numpy as np
+
+from qgis.core import QgsGeometry, QgsRectangle, QgsWkbTypes
+
+from .store import HachureStore
+from .tiles import default_overlap
+
+# Area of interest: runs the algorithm on one part of a (possibly huge)
+# DEM. Only a window around the area is read, and the slope, aspect &
+# contours are made for that window alone. The window is the area's
+# bounding box plus a buffer as wide as a tile's overlap (the longest
+# hachure, 150 jumps, plus one even_splitter chunk), so hachures reaching
+# into the area from outside are traced as they would be on the whole
+# DEM. They're cut back to the area at the end.
+#
+# An area is a QgsRectangle, a polygon QgsGeometry, or (x_min, y_min,
+# x_max, y_max), in the DEM's coordinates.
+
+
+def aoi_geometry(aoi):
+    if isinstance(aoi, QgsGeometry):
+        if aoi.type() != QgsWkbTypes.PolygonGeometry:
+            raise ValueError("The area of interest must be a polygon")
+        return aoi
+    if not isinstance(aoi, QgsRectangle):
+        aoi = QgsRectangle(*aoi)
+    return QgsGeometry.fromRect(aoi)
+
+
+# ----The (row, col, rows, cols) of the DEM a run over the area reads-----
+def aoi_window(grid, aoi, params):
+    bounds = aoi_geometry(aoi).boundingBox()
+    buffer = default_overlap(params, grid)
+
+    col = math.floor((bounds.xMinimum() - grid.x_min) / grid.cell_width) - buffer
+    row = math.floor((grid.y_max - bounds.yMaximum()) / grid.cell_height) - buffer
+    end_col = math.ceil((bounds.xMaximum() - grid.x_min) / grid.cell_width) + buffer
+    end_row = math.ceil((grid.y_max - bounds.yMinimum()) / grid.cell_height) + buffer
+
+    row, col = max(row, 0), max(col, 0)
+    end_row, end_col = min(end_row, grid.rows), min(end_col, grid.cols)
+    if end_row <= row or end_col <= col:
+        raise ValueError("The area of interest is outside the DEM")
+
+    return (row, col, end_row - row, end_col - col)
+
+
+# ------------The hachures of a store, cut back to the area---------------
+def clip_store(store, aoi):
+    # Returns a new HachureStore. Hachures wholly inside the area's
+    # bounding box (& inside the polygon) are copied as they are; the
+    # others are cut, and every piece of two vertices or more is kept.
+    area = aoi_geometry(aoi)
+    bounds = area.boundingBox()
+    rectangular = area.isGeosEqual(QgsGeometry.fromRect(bounds))
+    if not rectangular:
+        area_engine = QgsGeometry.createGeometryEngine(area.constGet())
+        area_engine.prepareGeometry()
+
+    ids = store.ids()
+    x_min, y_min, x_max, y_max = store.bounds[ids].T
+    outside = (
+        (x_max < bounds.xMinimum())
+        | (x_min > bounds.xMaximum())
+        | (y_max < bounds.yMinimum())
+        | (y_min > bounds.yMaximum())
+    )
+    inside = (
+        (x_min >= bounds.xMinimum())
+        & (x_max <= bounds.xMaximum())
+        & (y_min >= bounds.yMinimum())
+        & (y_max <= bounds.yMaximum())
+    )
+
+    clipped = HachureStore()
+    for hachure_id, skip, within in zip(ids, outside, inside):
+        if skip:
+            continue
+        if within and rectangular:
+            clipped.add(*store.coords(hachure_id))
+            continue
+
+        geometry = store.geometry(hachure_id)
+        if rectangular:
+            trimmed = geometry.clipped(bounds)
+        elif area_engine.contains(geometry.constGet()):
+            clipped.add(*store.coords(hachure_id))
+            continue
+        else:
+            trimmed = geometry.intersection(area)
+
+        # An intersection can also hold points where a line only touches
+        for part in trimmed.asGeometryCollection():
+            if part.type() != QgsWkbTypes.LineGeometry:
+                continue
+            line = part.asPolyline()
+            if len(line) > 1:
+                clipped.add(
+                    np.array([p.x() for p in line], dtype=np.float64),
+                    np.array([p.y() for p in line], dtype=np.float64),
+                )
+
+    return clipped
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import tempfile
+import threading
+import uuid
+
+# An on-disk cache for the STEP 1 derivatives (slope, aspect & the two
+# contour layers). Every file is named after a hash of what it was made
+# from: the DEM's bytes, its extent and, for the contours, the contour
+# interval. A changed DEM or spacing_checks can therefore never pick up a
+# stale file, while re-running with other spacing/slope params skips STEP 1
+# entirely. Once the folder grows past max_bytes, the least recently used
+# files go first.
+#
+# One cache can be shared by threads (the script's contour subtasks run
+# side by side): the DEM is hashed once under a lock, and the files this
+# cache has handed out are pinned, so one thread's eviction never deletes
+# a file another has yet to read.
+
+# Bump when the way a derivative is made changes, to orphan the old files
+CACHE_VERSION = 1
+
+
+# ---------------Hash of a file's bytes, None if it isn't one-------------
+def file_hash(path):
+    if not os.path.isfile(path):
+        return None
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DerivativeCache:
+    def __init__(self, folder=None, max_bytes=2 * 1024**3):
+        if folder is None:
+            folder = os.path.join(os.path.expanduser("~"), ".cache", "hachures")
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # (path, size, mtime) -> DEM hash, so a DEM is read once per process
+        self._dem_hashes = {}
+        self._lock = threading.Lock()
+        self._pinned = set()
+        os.makedirs(self.folder, exist_ok=True)
+
+    # ---------------Hash of the DEM's file, None if it has none-------------
+    def dem_hash(self, dem_path):
+        if not os.path.isfile(dem_path):
+            return None
+
+        stat = os.stat(dem_path)
+        memo = (os.path.abspath(dem_path), stat.st_size, stat.st_mtime_ns)
+        # Held while hashing, so a second thread waits for the first's hash
+        # rather than reading the whole DEM again
+        with self._lock:
+            if memo not in self._dem_hashes:
+                self._dem_hashes[memo] = file_hash(dem_path)
+
+            return self._dem_hashes[memo]
+
+    def key(self, dem_path, extent, name, interval=None):
+        # extent: (x_min, y_min, x_max, y_max); interval only for contours
+        dem_hash = self.dem_hash(dem_path)
+        if dem_hash is None:
+            return None
+
+        parts = [str(CACHE_VERSION), dem_hash, name]
+        parts += [repr(float(v)) for v in extent]
+        if interval is not None:
+            parts.append(repr(float(interval)))
+
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    # -----------The cached file, made by make(path) when it's missing-------
+    def get(self, dem_path, extent, name, suffix, make, interval=None):
+        # make(path) must write the derivative to path (which ends in
+        # suffix, e.g. ".tif"). Returns the path of the derivative.
+        key = self.key(dem_path, extent, name, interval)
+        if key is None:
+            # A DEM without a file (e.g. a web service) can't be hashed, so
+            # its derivatives are made fresh each time
+            self.misses += 1
+            path = os.path.join(tempfile.mkdtemp(prefix="hachures-"), name + suffix)
+            make(path)
+            return path
+
+        path = os.path.join(self.folder, f"{name}-{key}{suffix}")
+        with self._lock:
+            if os.path.exists(path):
+                self.hits += 1
+                os.utime(path)  # marks it as recently used
+                self._pinned.add(path)
+                return path
+            self.misses += 1
+
+        # Made under a scratch name & moved into place in one go, so a run
+        # alongside this one never sees a half-written file. Only this
+        # isn't locked, so several derivatives can be made at once.
+        scratch = os.path.join(self.folder, f"tmp-{uuid.uuid4().hex}{suffix}")
+        try:
+            make(scratch)
+            # Moved & pinned together, so no eviction can slip in between
+            with self._lock:
+                os.replace(scratch, path)
+                self._pinned.add(path)
+                self.evict()
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+        return path
+
+    # -------Drops the least recently used files until under max_bytes------
+    def evict(self):
+        # Called with the lock held. Pinned files are skipped.
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.startswith("tmp-"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path in self._pinned:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # still open somewhere (e.g. a loaded layer on Windows)
+                continue
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.folder):
+            if entry.is_file():
+                os.remove(entry.path)
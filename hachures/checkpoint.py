@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from .cache import file_hash
+from .tracing import HachureBatch
+
+# Saves the main loop's progress to disk every so often, so a long run that
+# crashes, or that was cancelled, picks up where it was instead of
+# starting over. What's saved is everything the next contour
+# depends on: the hachures (store), the still-growing lazy batches, the
+# random generator, and how many contours are done. The spatial index is
+# rebuilt from the store on resume.
+#
+# A checkpoint only resumes a run with the same params, contours & DEM
+# (by the hash of its file, as the derivative cache keys it); any other
+# run ignores it and starts from the first contour.
+
+CHECKPOINT_VERSION = 2
+
+BATCH_ARRAYS = (
+    "line_x",
+    "line_y",
+    "lengths",
+    "steps",
+    "started",
+    "growing",
+    "ids",
+    "stride",
+    "kx",
+    "ky",
+    "checked",
+)
+
+
+class Checkpoint:
+    def __init__(self, path, every=10, minutes=10, dem_path=None):
+        # every: save after this many contours; minutes: or once this long
+        # has passed since the last save, whichever comes first. Either
+        # can be None. dem_path: the DEM's file, so a DEM edited in place
+        # doesn't resume an old run (headless.generate fills it in).
+        self.path = path
+        self.dem_path = dem_path
+        self.dem_hash = None
+        self.every = every
+        self.seconds = None if minutes is None else minutes * 60
+        self.last_done = 0
+        self.last_time = time.monotonic()
+        self.saves = 0
+        self.resumed = 0  # contours done by the checkpoint we resumed
+
+    # --------------Which run a checkpoint belongs to------------------------
+    def fingerprint(self, engine, contours):
+        parts = [str(CHECKPOINT_VERSION), json.dumps(engine.params, sort_keys=True)]
+        parts.append(repr(tuple(engine.grid.geotransform())))
+        if self.dem_path is not None:
+            # Hashed once: the DEM doesn't change under a running engine
+            if self.dem_hash is None:
+                self.dem_hash = str(file_hash(self.dem_path))
+            parts.append(self.dem_hash)
+        parts += [repr(float(contour.elevation)) for contour in contours]
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def due(self, done):
+        if self.every is not None and done - self.last_done >= self.every:
+            return True
+        if self.seconds is not None:
+            return time.monotonic() - self.last_time >= self.seconds
+        return False
+
+    # ---------------------------Save & restore------------------------------
+    def save(self, engine, contours, done):
+        # done: how many contours are finished
+        store = engine.store
+        store.compact()
+        version, internal, gauss_next = engine.random.getstate()
+
+        arrays = {
+            "meta": np.array(
+                json.dumps(
+                    {
+                        "fingerprint": self.fingerprint(engine, contours),
+                        "done": done,
+                        "next_id": int(store.next_id),
+                        "live": int(store.live),
+                        "used": int(store.used),
+                        "random_version": version,
+                        "gauss_next": gauss_next,
+                        "batches": len(engine.lazy_growth.batches),
+                    }
+                )
+            ),
+            "random_state": np.array(internal, dtype=np.int64),
+            "xs": store.xs[: store.used],
+            "ys": store.ys[: store.used],
+            "start": store.start[: store.next_id],
+            "length": store.length[: store.next_id],
+            "alive": store.alive[: store.next_id],
+            "bounds": store.bounds[: store.next_id],
+        }
+        for n, batch in enumerate(engine.lazy_growth.batches):
+            for name in BATCH_ARRAYS:
+                arrays["batch{}_{}".format(n, name)] = getattr(batch, name)
+
+        # Written beside the old one & swapped in, so a crash mid-save
+        # leaves the last good checkpoint
+        scratch = self.path + ".tmp.npz"
+        np.savez(scratch, **arrays)
+        os.replace(scratch, self.path)
+
+        self.last_done = done
+        self.last_time = time.monotonic()
+        self.saves += 1
+
+    def restore(self, engine, contours):
+        # Puts a matching checkpoint's state into a fresh engine & returns
+        # how many contours it had done: 0 when there's nothing to resume
+        if not os.path.exists(self.path):
+            return 0
+
+        with np.load(self.path) as saved:
+            meta = json.loads(str(saved["meta"]))
+            if meta["fingerprint"] != self.fingerprint(engine, contours):
+                return 0
+
+            store = engine.store
+            capacity = max(meta["next_id"], 1024)
+            room = max(meta["used"] * 2, 1024 * 16)
+
+            def spare(array, size):
+                # The saved values, then zeros up to size, as the store
+                # grows its own arrays
+                result = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+                result[: len(array)] = array
+                return result
+
+            store.xs = spare(saved["xs"], room)
+            store.ys = spare(saved["ys"], room)
+            store.used = meta["used"]
+            store.garbage = 0
+            store.start = spare(saved["start"], capacity)
+            store.length = spare(saved["length"], capacity)
+            store.alive = spare(saved["alive"], capacity)
+            store.bounds = spare(saved["bounds"], capacity)
+            store.next_id = meta["next_id"]
+            store.live = meta["live"]
+
+            engine.random.setstate(
+                (
+                    meta["random_version"],
+                    tuple(int(v) for v in saved["random_state"]),
+                    meta["gauss_next"],
+                )
+            )
+
+            growth = engine.lazy_growth
+            growth.batches = []
+            growth.owners = {}
+            for n in range(meta["batches"]):
+                arrays = {
+                    name: saved["batch{}_{}".format(n, name)] for name in BATCH_ARRAYS
+                }
+                batch = HachureBatch.restore(engine, arrays)
+                growth.batches.append(batch)
+                for index in np.flatnonzero(batch.ids >= 0):
+                    hachure_id = int(batch.ids[index])
+                    if store.alive[hachure_id]:
+                        growth.owners[hachure_id] = (batch, index)
+
+        engine.index.rebuild()
+        self.last_done = self.resumed = meta["done"]
+        self.last_time = time.monotonic()
+        return meta["done"]
+
+    def clear(self):
+        # Once the run is finished, so the next one starts afresh
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,172 @@
+import struct
+from collections import defaultdict
+
+import numpy as np
+
+from qgis.core import QgsGeometry
+
+from .engine import Contour
+from .marching import march, uniform_levels
+from .profiling import NullProfiler
+
+# Turns contour lines (and filled contour polygons) from wherever they came
+# from into the Contour list the main loop runs over. Both the QGIS script
+# and the headless entry point go through here.
+
+
+# ============================CONTOUR PREPARATION============================
+def build_contours(
+    line_features,
+    polygon_features=None,
+    boundary=None,
+    profiler=None,
+    levels=None,
+):
+    # line_features: (geometry, elevation) pairs, as many per elevation as
+    # the contouring gave us. polygon_features: (geometry, lowest elevation,
+    # highest elevation) triples of the filled contours, only for the
+    # "polygon" clip, with boundary the rectangle they cover.
+    # levels: the elevations to keep, e.g. from adaptive_levels(), when the
+    # contours were made on a finer interval. The others are dropped, and
+    # the filled contours between two kept levels are subtracted together.
+    profiler = profiler or NullProfiler()
+    if levels is not None:
+        levels = np.asarray(levels, dtype=np.float64)
+        line_features = [
+            (geometry, elevation)
+            for geometry, elevation in line_features
+            if is_level(levels, elevation)
+        ]
+        # The polygons pair up with the levels that actually have lines
+        levels = np.unique([elevation for _, elevation in line_features])
+
+    contour_differences = None
+    if polygon_features is not None:
+        with profiler.stage("polygon chain"):
+            contour_differences = subtract_polygons(
+                polygon_features, boundary, levels
+            )
+        profiler.count("differences", len(contour_differences))
+
+    # ------------------STEP 4: Dissolve the contour lines-------------------
+    profiler.start("dissolve")
+    contour_dict = defaultdict(list)
+
+    for geometry, elevation in line_features:
+        contour_dict[elevation].append(geometry)
+        # this dict is now of the form {Elevation: [list of geometries]}
+
+    keys = list(contour_dict.keys())
+    keys.sort()
+
+    # we need to sort these low-to-high so they match the order of the
+    # contour_differences we just generated
+
+    dissolved_lines = []
+    for key in keys:
+        combined_geo = QgsGeometry.collectGeometry(contour_dict[key])
+        dissolved_lines.append(combined_geo)
+
+    # then turn them into Contours for use by the main loop
+    contour_lines = []
+    if contour_differences is not None:
+        for dissolved_line, poly_geometry, elevation in zip(
+            dissolved_lines, contour_differences, keys
+        ):
+            contour_lines.append(Contour(dissolved_line, poly_geometry, elevation))
+    else:
+        for dissolved_line, elevation in zip(dissolved_lines, keys):
+            contour_lines.append(Contour(dissolved_line, None, elevation))
+
+    # each Contour carrys a record of its corresponding poly for use by haircut
+    profiler.stop("dissolve")
+    return contour_lines
+
+
+# ---Whether an elevation is one of the levels, give or take float noise---
+def is_level(levels, elevation):
+    if not len(levels):
+        return False
+    tolerance = 1e-6 * (np.diff(levels).min() if len(levels) > 1 else 1)
+    i = min(np.searchsorted(levels, elevation), len(levels) - 1)
+    nearest = min(abs(levels[i] - elevation), abs(levels[i - 1] - elevation))
+    return nearest <= tolerance
+
+
+def subtract_polygons(polygon_features, boundary, levels=None):
+    # -STEP 1: Process the contours so that they are all in the needed format
+
+    # First we sort the contours from low elevation to high.
+    # They probably were already sorted this way, but let's not chance it.
+    polygon_features = sorted(polygon_features, key=lambda x: x[1])
+
+    # Each contour poly will be turned into a new polygon showing all areas
+    # that are *higher* than that contour
+
+    # -----STEP 2: Make a simple rectangle poly covering contours' extent----
+    boundary_polygon = QgsGeometry.fromRect(boundary)
+
+    # --STEP 3: Iterate through each contour poly and subtract it from our---
+    # ------rectangle, thus yielding rectangles with varying size holes------
+
+    if levels is None:
+        # We drop the last one because it's going to be empty
+        groups = [[feature[0]] for feature in polygon_features[:-1]]
+    else:
+        groups = band_groups(polygon_features, levels)
+
+    # Loop below starts with our boundary rectangle, subtracts the lowest
+    # elevation poly from it, and stores the result. It then subtracts the
+    # 2nd-lowest poly from that result and stores that. And so on, each time
+    # subtracting the next-lowest poly from the result of the last operation
+
+    working_geometry = boundary_polygon
+    contour_differences = []
+
+    for group in groups:
+        if len(group) == 1:
+            working_geometry = working_geometry.difference(group[0])
+        elif group:
+            working_geometry = working_geometry.difference(
+                QgsGeometry.unaryUnion(group)
+            )
+        contour_differences.append(working_geometry)
+
+    return contour_differences
+
+
+# -----Filled contours grouped by the kept level each one lies under------
+def band_groups(polygon_features, levels):
+    # polygon_features sorted low to high. Bands above the last kept level
+    # belong to no group, like the last band of a uniform run.
+    tolerance = 1e-6 * (np.diff(levels).min() if len(levels) > 1 else 1)
+    groups = [[] for _ in levels]
+    for geometry, _, elevation_max in polygon_features:
+        i = np.searchsorted(levels, elevation_max - tolerance)
+        if i < len(levels):
+            groups[i].append(geometry)
+    return groups
+
+
+# ======MARCHING SQUARES: the Contour list straight from the DEM array======
+def trace_contours(dem, grid, interval, nodata=None, levels=None):
+    # The Contour list (low to high, polygons left out) straight from the
+    # DEM array (see marching.py), on the given grid. levels replaces the multiples of the
+    # interval, e.g. with adaptive_levels().
+    if levels is None:
+        levels = uniform_levels(dem, interval, nodata)
+    contours = []
+    for level, lines in sorted(march(dem, levels, nodata).items()):
+        # Built as WKB in one go, rather than point by point
+        parts = [struct.pack("<BII", 1, 5, len(lines))]
+        for rows, cols in lines:
+            xs = grid.x_min + (cols + 0.5) * grid.cell_width
+            ys = grid.y_max - (rows + 0.5) * grid.cell_height
+            parts.append(struct.pack("<BII", 1, 2, len(xs)))
+            parts.append(np.column_stack([xs, ys]).astype("<f8").tobytes())
+
+        geometry = QgsGeometry()
+        geometry.fromWkb(b"".join(parts))
+        contours.append(Contour(geometry, None, level))
+
+    return contours
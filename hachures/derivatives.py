@@ -0,0 +1,63 @@
+import numpy as np
+
+# Slope & aspect straight from the DEM array, in one vectorized pass. It's
+# the same Horn kernel, conventions & nodata handling as qgis:slope and
+# qgis:aspect, without their temporary GeoTIFFs:
+#   - a nodata cell gives nodata in both outputs
+#   - a nodata (or off the raster) neighbour takes the centre cell's value
+#   - slope in degrees; aspect in degrees, 0 = north, nodata where flat
+
+NODATA = -9999
+
+# (row, col) offset of each kernel cell, with its weight in dz/dx & dz/dy
+# z11 z12 z13
+# z21 z22 z23
+# z31 z32 z33
+KERNEL = [
+    (-1, -1, -1, -1),
+    (-1, 0, 0, -2),
+    (-1, 1, 1, -1),
+    (0, -1, -2, 0),
+    (0, 1, 2, 0),
+    (1, -1, -1, 1),
+    (1, 0, 0, 2),
+    (1, 1, 1, 1),
+]
+
+
+def horn(dem, cell_width, cell_height, nodata=None):
+    # dem: 2D elevation array, north up. cell_width/cell_height: positive
+    # cell sizes in map units. Returns (slope, aspect) float64 arrays.
+    dem = np.asarray(dem, dtype=np.float64)
+    rows, cols = dem.shape
+
+    missing = ~np.isfinite(dem)
+    if nodata is not None:
+        missing |= dem == nodata
+
+    # A 1-cell NaN border stands in for the cells off the raster
+    padded = np.full((rows + 2, cols + 2), np.nan)
+    padded[1 : rows + 1, 1 : cols + 1] = np.where(missing, np.nan, dem)
+    centre = padded[1 : rows + 1, 1 : cols + 1]
+
+    sum_x = np.zeros((rows, cols))
+    sum_y = np.zeros((rows, cols))
+    for d_row, d_col, weight_x, weight_y in KERNEL:
+        neighbour = padded[1 + d_row : rows + 1 + d_row, 1 + d_col : cols + 1 + d_col]
+        neighbour = np.where(np.isnan(neighbour), centre, neighbour)
+        if weight_x:
+            sum_x += weight_x * neighbour
+        if weight_y:
+            sum_y += weight_y * neighbour
+
+    # y runs down the rows, so dz/dy flips sign to point north
+    der_x = sum_x / (8 * cell_width)
+    der_y = sum_y / (8 * -cell_height)
+
+    slope = np.degrees(np.arctan(np.hypot(der_x, der_y)))
+    aspect = 180 + np.degrees(np.arctan2(der_x, der_y))
+
+    slope[missing] = NODATA
+    aspect[missing | ((der_x == 0) & (der_y == 0))] = NODATA
+
+    return slope, aspect
@@ -0,0 +1,700 @@
+import math
+import random
+import time
+
+import numpy as np
+
+from qgis.core import (
+    QgsPointXY,
+    QgsGeometry,
+    QgsWkbTypes,
+    QgsSpatialIndex,
+)
+
+from .flow import FlowField
+from .params import DEFAULT_PARAMS, needs_dem
+from .profiling import NullProfiler
+from .store import HachureStore
+from .tracing import HachureBatch, LazyGrowth, StepField
+
+
+def fcnExpScale(val, domainMin, domainMax, rangeMin, rangeMax, exponent):
+    if val is None or (domainMin >= domainMax) or (exponent <= 0):
+        return None
+
+    if val >= domainMax:
+        return rangeMax
+    elif val <= domainMin:
+        return rangeMin
+
+    return (
+        (float(rangeMax) - float(rangeMin)) / math.pow(domainMax - domainMin, exponent)
+    ) * math.pow(float(val) - domainMin, exponent) + rangeMin
+
+
+# ===========================CLASS DEFINITIONS===========================
+# ------Contour lines are used to check the spacing of the hachures------
+class Contour:
+    def __init__(self, contour_geometry, poly_geometry, elevation=None):
+        self.geometry = contour_geometry
+        self.polygon = poly_geometry
+        self.elevation = elevation
+        self.rings = None
+
+    def ring_list(self):
+        # Returns a list of all rings that this contour is made from
+        if self.geometry.isMultipart():
+            all_rings = [
+                QgsGeometry.fromPolylineXY(line)
+                for line in self.geometry.asMultiPolyline()
+            ]
+        else:
+            all_rings = [self.geometry]
+        return all_rings
+
+    def profiled_rings(self, engine):
+        # Each ring with its slope profile, and where the ring starts along
+        # itself (always 0 for a whole ring). Sampled once per main loop
+        # pass, which drops them again when it's done.
+        if self.rings is None:
+            self.rings = [
+                (ring, SlopeProfile(ring, engine), 0) for ring in self.ring_list()
+            ]
+        return self.rings
+
+
+# --Spatial index over the live hachures, kept in step with the main loop--
+class HachureIndex:
+    def __init__(self, store):
+        self.store = store
+        self.index = QgsSpatialIndex()
+        self.entries = 0
+        # Counters so we can see how many GEOS intersections we skipped
+        self.avoided = 0
+        self.tested = 0
+
+    def add(self, hachure_ids):
+        # Also used for hachures that grew: the old entry just goes stale
+        for hachure_id in hachure_ids:
+            self.index.addFeature(int(hachure_id), self.store.rectangle(hachure_id))
+            self.entries += 1
+
+        if self.entries > 2 * len(self.store) + 1024:
+            self.rebuild()
+
+    def rebuild(self):
+        self.index = QgsSpatialIndex()
+        self.entries = 0
+        self.add(self.store.ids())
+
+    def candidates(self, rectangle):
+        # QgsSpatialIndex can only delete with the original bounds, so it
+        # keeps entries for removed hachures and for the old extent of
+        # clipped or grown ones. The store's live bounds weed those out.
+        found = np.unique(np.array(self.index.intersects(rectangle), dtype=np.int64))
+        bounds = self.store.bounds[found]
+        keep = (
+            self.store.alive[found]
+            & (bounds[:, 0] <= rectangle.xMaximum())
+            & (bounds[:, 2] >= rectangle.xMinimum())
+            & (bounds[:, 1] <= rectangle.yMaximum())
+            & (bounds[:, 3] >= rectangle.yMinimum())
+        )
+        return found[keep]
+
+
+# ----Segments are contour pieces used to space or generate hachures-----
+class Segment:
+    def __init__(self, geom, profile, start=0):
+        self.geometry = QgsGeometry(geom)
+        self.length = self.geometry.length()
+        # The slope profile of the ring this segment was cut from, and
+        # where along that ring the segment begins
+        self.profile = profile
+        self.start = start
+        self.hachures = []
+
+    def profiled_rings(self, engine=None):
+        return [(self.geometry, self.profile, self.start)]
+
+
+# ----Slope sampled once along a contour ring, as running totals----------
+class SlopeProfile:
+    def __init__(self, ring_geometry, engine):
+        # Sample the slope at pixel spacing all along the ring, and keep
+        # a running total so any stretch of it can be averaged at once
+        densified_line = ring_geometry.densifyByDistance(engine.average_pixel_size)
+        points = densified_line.asPolyline()
+        xs = np.array([p.x() for p in points], dtype=np.float64)
+        ys = np.array([p.y() for p in points], dtype=np.float64)
+
+        steps = np.hypot(np.diff(xs), np.diff(ys))
+        self.distances = np.concatenate(([0.0], np.cumsum(steps)))
+        # The densified ring keeps every original vertex, so it also
+        # places points along the ring exactly
+        self.xs = xs
+        self.ys = ys
+
+        # out of bounds samples count as 0
+        self.samples = engine.grid.sample(engine.slope_array, xs, ys)
+        engine.profiler.count("raster samples", len(xs))
+        self.totals = np.concatenate(([0.0], np.cumsum(self.samples)))
+
+    def means(self, starts, ends):
+        # Average of the samples over each stretch (start, end) of the ring
+        first = np.searchsorted(self.distances, starts, side="left")
+        last = np.searchsorted(self.distances, ends, side="right")
+        counts = last - first
+        result = (self.totals[last] - self.totals[first]) / np.maximum(counts, 1)
+
+        # Shorter than a pixel: take the sample nearest the middle instead
+        short = counts <= 0
+        if short.any():
+            middle = np.searchsorted(self.distances, (starts[short] + ends[short]) / 2)
+            result[short] = self.samples[np.minimum(middle, len(self.samples) - 1)]
+        return result
+
+    def points(self, locations):
+        # x & y arrays of the points at these distances along the ring
+        return (
+            np.interp(locations, self.distances, self.xs),
+            np.interp(locations, self.distances, self.ys),
+        )
+
+
+# --------------CutPoints mark where a contour is to be cut--------------
+class CutPoint:
+    def __init__(self, point_geometry, hachure_id):
+        self.geometry = point_geometry
+        self.hachure = hachure_id
+        self.cut_location = None
+
+
+# ==============THE ENGINE: one run of the hachure algorithm==============
+class HachureEngine:
+    def __init__(
+        self,
+        params,
+        grid,
+        slope_array,
+        aspect_array,
+        dem_array=None,
+        seed=None,
+        profiler=None,
+        nodata=None,
+    ):
+        # params: the user parameters (missing ones take DEFAULT_PARAMS)
+        # grid: where slope_array, aspect_array & dem_array sit on the map
+        # dem_array: only needed for the "elevation" clip, "lazy" growth &
+        # the "flow" tracer. All three can also be rasters.TiledRasters,
+        # for DEMs too big for memory (the flow tracer needs a real array).
+        # The engine keeps no global state & never calls back into a GUI,
+        # so any number of them can run side by side, in threads (e.g. a
+        # QgsTask) or processes.
+        # profiler: a hachures.profiling.Profiler to time & count the run
+        # nodata: the DEM's nodata value, if it has one (the flow tracer
+        # treats those cells as off the raster)
+        self.params = {**DEFAULT_PARAMS, **params}
+        self.grid = grid
+        self.slope_array = slope_array
+        self.aspect_array = aspect_array
+        self.dem_array = dem_array
+        self.nodata = nodata
+        self.random = random.Random(seed)
+        self.profiler = profiler or NullProfiler()
+
+        params = self.params
+        self.clip_mode = params["clip"]
+        self.growth_mode = params["growth"]
+        if self.dem_array is None and needs_dem(params):
+            raise ValueError(
+                "The elevation clip, lazy growth and flow tracer need the DEM"
+            )
+        if params["tracer"] == "flow" and self.growth_mode == "lazy":
+            raise ValueError("The flow tracer traces hachures in full growth only")
+        if params["tracer"] == "flow" and not isinstance(dem_array, np.ndarray):
+            raise ValueError("The flow tracer needs the whole DEM in memory")
+
+        # The hachure spacings are in DEM pixel units unless given in map
+        # units through mins/maxs
+        self.average_pixel_size = 0.5 * (grid.cell_width + grid.cell_height)
+        self.jump_distance = self.average_pixel_size * 3
+        self.jump_distance_2 = (self.jump_distance * 1.5) ** 2
+
+        # "fixed" traces hachures in jump_distance steps, each one in the
+        # direction of the cell it starts from. "adaptive" follows the
+        # direction blended between cells, in strides from jump_distance
+        # up to max_stride, as long as the path stays within
+        # stride_tolerance of a more accurate one. "flow" walks D-infinity
+        # pointers from cell to cell (see flow.py)
+        self.tracer = params["tracer"]
+        self.max_stride = self.jump_distance * 4
+        self.stride_tolerance = self.average_pixel_size * 0.25
+
+        self.min_spacing = params["mins"]
+        self.max_spacing = params["maxs"]
+        if self.min_spacing is None:
+            self.min_spacing = self.average_pixel_size * params["minhs"]
+            self.max_spacing = self.average_pixel_size * params["maxhs"]
+        self.spacing_range = self.max_spacing - self.min_spacing
+
+        # faire glisser la répartition des pentes
+        # 1:identity   <1 : shift slope up  >1 : shift slope down
+        self.slopeShiftExponent = params["shift"]
+        self.min_slope = fcnExpScale(
+            params["minslope"], 0, 90, 0, 90, self.slopeShiftExponent
+        )
+        self.max_slope = fcnExpScale(
+            params["maxslope"], 0, 90, 0, 90, self.slopeShiftExponent
+        )
+        self.slope_range = self.max_slope - self.min_slope
+
+        # The ideal hachure spacing at every thousandth of a degree of
+        # slope, looked up for whole arrays of segments at once (see
+        # spacing_lookup)
+        self.spacing_slopes = np.linspace(0, 90, 90001)
+        shifted = 90 * (self.spacing_slopes / 90) ** self.slopeShiftExponent
+        slope_pct = np.minimum(shifted, self.max_slope) - self.min_slope
+        slope_pct /= self.slope_range
+        self.spacing_table = self.max_spacing - slope_pct * self.spacing_range
+
+        self.step_field = StepField(self)
+        self.flow_field = FlowField(self) if self.tracer == "flow" else None
+        self.store = HachureStore()
+        self.index = HachureIndex(self.store)
+        self.lazy_growth = LazyGrowth(self.store)
+
+    # ========MAIN LOOP: Iterate through Contours to generate hachures=======
+    def run(self, contours, progress=None, checkpoint=None):
+        # contours: Contour objects sorted from low to high. progress is
+        # called as progress(i, total) before each one, and may return
+        # False to stop early. checkpoint: a hachures.checkpoint.Checkpoint
+        # to resume from (when it matches this run) & save to as we go;
+        # stopping early saves it too, finishing deletes it. Returns the
+        # HachureStore of the results.
+
+        # As we iterate through, it's possible that it takes a few contour
+        # lines before the slope is high enough (i.e. > min_slope) to make
+        # hachures. So each time, the if statement checks to see if we got
+        # anything back. Otherwise it moves to the next line and again
+        # tries to generate a set of starting hachures.
+        total = len(contours)
+        done = 0
+        if checkpoint is not None:
+            done = checkpoint.restore(self, contours)
+
+        for i, contour in enumerate(contours):
+            if i < done:
+                continue
+            if progress is not None and not progress(i, total):
+                if checkpoint is not None:
+                    checkpoint.save(self, contours, i)
+                return self.store
+
+            started = time.perf_counter()
+            if len(self.store) and self.growth_mode == "lazy":
+                # Bring the hachures up to this contour before checking them
+                self.grow_hachures(contour.elevation)
+
+            if len(self.store):
+                self.subsequent_contour(contour)
+            else:
+                self.first_contour(contour)
+            # The slope profiles are only needed during this pass; kept on
+            # every contour they'd add up to the whole DEM's contour length
+            contour.rings = None
+            self.profiler.contour(contour.elevation, time.perf_counter() - started)
+
+            if checkpoint is not None and checkpoint.due(i + 1):
+                checkpoint.save(self, contours, i + 1)
+
+        if len(self.store) and self.growth_mode == "lazy":
+            # Past the last contour, hachures run on until they stop by
+            # themselves
+            self.grow_hachures()
+
+        if checkpoint is not None:
+            # Finished, so there is nothing left to resume
+            checkpoint.clear()
+        return self.store
+
+    # =========================FUNCTION DEFINITIONS-=========================
+    # -----------------Samples the DEM, NaN when out of bounds---------------
+    def sample_elevations(self, xs, ys):
+        self.profiler.count("raster samples", len(xs))
+        return self.grid.sample(self.dem_array, xs, ys, outside=np.nan)
+
+    # ------Given an array of slopes, find the ideal spacing of hachures------
+    def spacing_lookup(self, slopes):
+        # NaN where the slope is too shallow for hachures
+        spacings = np.interp(slopes, self.spacing_slopes, self.spacing_table)
+        spacings[~(slopes >= self.params["minslope"])] = np.nan
+        return spacings
+
+    # -----The average slope under each Segment, a profile at a time--------
+    def segment_slopes(self, segments):
+        starts = np.array([segment.start for segment in segments], dtype=np.float64)
+        lengths = np.array([segment.length for segment in segments], dtype=np.float64)
+
+        by_profile = {}
+        for i, segment in enumerate(segments):
+            profile = segment.profile
+            by_profile.setdefault(id(profile), (profile, []))[1].append(i)
+
+        slopes = np.empty(len(segments))
+        for profile, indices in by_profile.values():
+            slopes[indices] = profile.means(
+                starts[indices], starts[indices] + lengths[indices]
+            )
+        return slopes, starts, lengths
+
+    # ----Sorts Segments into clip_all (0), too_short (1) & too_long (2)----
+    def classify(self, segments):
+        # -1 for the segments whose hachures are fine as they are.
+        # The 0.9 and 2.2 below are thermostat controls. Instead of a
+        # line being "too short" when it exactly falls below its ideal
+        # spacing, we let it get a little tighter to avoid near-parallel
+        # hachures cycling on/off rapidly.
+        slopes, _, lengths = self.segment_slopes(segments)
+        spacings = self.spacing_lookup(slopes)
+
+        status = np.full(len(segments), -1, dtype=np.int64)
+        clip_all = (slopes < self.min_slope) | np.isnan(spacings)
+        too_short = ~clip_all & (lengths < spacings * 0.9)
+        too_long = ~clip_all & ~too_short & (lengths > spacings * 2.2)
+        status[clip_all] = 0
+        status[too_short] = 1
+        status[too_long] = 2
+        return status
+
+    # --Where hachures start on Segments dashed according to ideal spacing--
+    def dash_points(self, segments):
+        # Our goal here is to split a segment into dashes & gaps, thusly:
+        #  ----    ----    ----    ----    ----    ----    ----
+        # Each dash length = spacing, surrounded by gaps half that width
+        # Thus one unit looks like this: |  ----  |
+        # We tune the spacing value based on the segment length to ensure
+        # an integer number of dashes. This is rather like the automatic
+        # dash/gap spacing in Adobe Illustrator. A hachure starts in the
+        # middle of each dash, i.e. in the middle of each unit, so the
+        # points are placed straight on the ring, dashes never being made.
+        if not segments:
+            return (np.empty(0), np.empty(0))
+        slopes, starts, lengths = self.segment_slopes(segments)
+        spacings = self.spacing_lookup(slopes)
+
+        keep = ~((slopes < self.min_slope) | np.isnan(spacings))
+        units = np.zeros(len(segments), dtype=np.int64)
+        # the length of a gap + dash + gap is spacing * 2
+        units[keep] = np.rint(lengths[keep] / (spacings[keep] * 2))
+        unit_lengths = lengths / np.maximum(units, 1)
+
+        xs = []
+        ys = []
+        for i in np.flatnonzero(units > 0):
+            locations = starts[i] + unit_lengths[i] * (np.arange(units[i]) + 0.5)
+            x, y = segments[i].profile.points(locations)
+            xs.append(x)
+            ys.append(y)
+
+        if not xs:
+            return (np.empty(0), np.empty(0))
+        return (np.concatenate(xs), np.concatenate(ys))
+
+    # -------------------Starts our first set of hachures--------------------
+    def first_contour(self, contour):
+
+        # Split the contour into even segments to begin
+        contour_segments = self.even_splitter(contour)
+
+        # Then start a hachure on each of their dashes
+        xs, ys = self.dash_points(contour_segments)
+
+        if len(xs):
+            self.index.add(self.hachure_generator(xs, ys))
+
+    # ----Checks a contour to see where hachures need to be trimmed/begun----
+    def subsequent_contour(self, contour):
+
+        # First we split the contour according to the existing hachures
+
+        split_contour = self.split_by_hachures(contour)
+
+        # We may need to further subdivide some of these. Some segments may
+        # be too long & their slope calculations are no longer local
+
+        segment_list = []
+
+        for segment in split_contour:
+            if segment.length > self.max_spacing * 3:
+                segment_list += self.even_splitter(segment)
+            else:
+                segment_list += [segment]
+
+        status = self.classify(segment_list)
+        too_short = [segment_list[i] for i in np.flatnonzero(status == 1)]
+        too_long = [segment_list[i] for i in np.flatnonzero(status == 2)]
+        clip_all = [segment_list[i] for i in np.flatnonzero(status == 0)]
+
+        # too_short: this segment spans 2 hachures that are too close
+        # too_long: segment's 2 hachures are too far apart
+        # clip_all: this segment's slope is low enough that hachures stop
+
+        # We first find which hachures must be clipped off
+
+        to_clip = []
+
+        for seg in clip_all:
+            to_clip.extend(seg.hachures)
+
+        for seg in too_short:
+            hachures = seg.hachures
+            if len(hachures) == 2:
+                # Some segments won't touch enough hachures
+                self.random.shuffle(hachures)
+                to_clip.append(hachures[0])
+
+        # to_clip can have duplicates. A hachure may have too_short segments
+        # on each side, and both of them choose that particular hachure as
+        # the 1 that needs to be clipped off. So we remove duplicates:
+
+        to_clip = list(set(to_clip))
+
+        if self.growth_mode == "lazy":
+            self.lazy_growth.stop(to_clip)
+
+        # Clip them in place in the store
+        self.haircut(contour, to_clip)
+
+        # Let's next deal with adding new hachures to the too_long segments
+
+        if len(too_long) > 0:
+            xs, ys = self.dash_points(too_long)
+
+            if len(xs):  # too short to fit a dash, there may be none
+                self.index.add(self.hachure_generator(xs, ys))
+
+    # ------Split a contour according to our current list of hachures-------
+    def split_by_hachures(self, contour):
+        all_segments = []
+
+        for line_geometry, profile, _ in contour.profiled_rings(self):
+
+            # Only hachures whose bounding box overlaps this ring can
+            # possibly cross it, so we ask the index for those first
+            candidates = self.index.candidates(line_geometry.boundingBox())
+            self.index.avoided += len(self.store) - len(candidates)
+            self.index.tested += len(candidates)
+            self.profiler.count("intersections", len(candidates))
+
+            intersection_points = []
+            for hachure_id in candidates:
+                # The geometry only lives for this one intersection
+                point = line_geometry.intersection(self.store.geometry(hachure_id))
+                if point.wkbType() == QgsWkbTypes.MultiPoint:
+                    intersection_points += [
+                        CutPoint(QgsGeometry.fromPointXY(p), hachure_id)
+                        for p in point.asMultiPoint()
+                    ]
+                elif point.wkbType() == QgsWkbTypes.Point:
+                    intersection_points += [CutPoint(point, hachure_id)]
+                # The intersection can return Empty or (rarely)
+                # a geometryCollection. We can safely skip over these
+
+            for point in intersection_points:
+                # This tells us where along the line to cut
+                point.cut_location = line_geometry.lineLocatePoint(point.geometry)
+
+            if len(intersection_points) > 0:
+                # If we found intersections, use them to cut the ring
+                contour_segments = cutpoint_splitter(
+                    line_geometry, intersection_points, profile
+                )
+                all_segments += contour_segments
+            else:
+                # If not, we should still return the unbroken ring
+                all_segments.append(Segment(line_geometry, profile))
+
+        return all_segments
+
+    # ----Clips off hachures that need to stop at this particular contour----
+    def haircut(self, contour, hachure_ids):
+        if self.clip_mode == "elevation":
+            self.elevation_haircut(contour, hachure_ids)
+            return
+
+        contour_poly_geometry = contour.polygon
+        self.profiler.count("differences", len(hachure_ids))
+
+        for hachure_id in hachure_ids:
+            clipped = self.store.geometry(hachure_id).difference(contour_poly_geometry)
+
+            if clipped.isEmpty():
+                self.profiler.count("hachures clipped")
+                self.store.remove(hachure_id)
+                continue
+
+            # A hachure that wanders back down-slope can be cut into pieces;
+            # the first keeps the id and any others become hachures of their
+            # own
+            if clipped.isMultipart():
+                parts = clipped.asMultiPolyline()
+            else:
+                parts = [clipped.asPolyline()]
+
+            first, *others = [
+                ([p.x() for p in part], [p.y() for p in part]) for part in parts
+            ]
+            # Only hachures the polygon actually cut count as clipped, as
+            # in elevation_haircut; the others are left as they are
+            if not others:
+                xs, ys = self.store.coords(hachure_id)
+                if np.array_equal(first[0], xs) and np.array_equal(first[1], ys):
+                    continue
+            self.profiler.count("hachures clipped")
+            self.store.replace(hachure_id, *first)
+            self.index.add([self.store.add(*part) for part in others])
+            self.profiler.count("hachures created", len(others))
+
+    # ---Same job as haircut, but cuts where the DEM rises past the contour---
+    def elevation_haircut(self, contour, hachure_ids):
+
+        for hachure_id in hachure_ids:
+            xs, ys = self.store.coords(hachure_id)
+            heights = self.sample_elevations(xs, ys)
+
+            # Hachures run up-slope, so we keep everything before the first
+            # vertex that is higher than the contour
+            higher = np.flatnonzero(heights > contour.elevation)
+            if higher.size == 0:
+                continue
+
+            first = higher[0]
+            self.profiler.count("hachures clipped")
+            if first == 0:
+                # the whole hachure is above this contour, so nothing is left
+                self.store.remove(hachure_id)
+                continue
+
+            # Place the cut between the last low vertex and the first high one
+            low, high = heights[first - 1], heights[first]
+            t = (contour.elevation - low) / (high - low)
+            cut_x = xs[first - 1] + t * (xs[first] - xs[first - 1])
+            cut_y = ys[first - 1] + t * (ys[first] - ys[first - 1])
+
+            self.store.truncate(hachure_id, first, cut_x, cut_y)
+
+    # -------Generates new hachures starting from the given points---------
+    def hachure_generator(self, xs, ys):
+        # xs, ys: the start points, from dash_points
+
+        # Grow a hachure from all of them at once
+        if self.growth_mode == "lazy":
+            # Only the first jump for now; the main loop grows them later
+            hachure_ids = self.lazy_growth.add(HachureBatch(self, xs, ys))
+        else:
+            hachure_ids = [
+                self.store.add(*line) for line in self.trace_hachures(xs, ys)
+            ]
+
+        self.profiler.count("hachures created", len(hachure_ids))
+        return hachure_ids
+
+    # ---In lazy mode, grows the live hachures up to a level, before checking-
+    def grow_hachures(self, level=None):
+        # Grown lines are bigger than their old index entries, so add them
+        # again
+        self.index.add(self.lazy_growth.grow(level))
+
+    # ---Grows hachures up-slope from many start points in lockstep-----------
+    def trace_hachures(self, xs, ys):
+        if self.flow_field is not None:
+            return self.flow_field.trace(xs, ys)
+
+        batch = HachureBatch(self, xs, ys)
+        batch.advance()
+
+        return [batch.coords(index) for index in batch.drawn()]
+
+    # -----Splits a line  into even segments based on max_spacing-----
+    def even_splitter(self, contourOrSeg):
+        spacing = self.max_spacing * 3
+        output_segments = []
+
+        for line_geometry, profile, offset in contourOrSeg.profiled_rings(self):
+            length = line_geometry.length()
+
+            i = spacing
+            cut_locations = []
+            while i < length:
+                cut_locations.append(i)
+                i += spacing
+
+            output_segments.extend(
+                master_splitter(line_geometry, cut_locations, profile, offset)
+            )
+
+        return output_segments
+
+
+# -------Turns list of tuples of xy coodinates into a line Geom-------
+def make_lines(coord_list):
+    points = [QgsPointXY(x, y) for x, y in coord_list]
+    polyline = QgsGeometry.fromPolylineXY(points)
+
+    return polyline
+
+
+# ---Takes a single line geometry and splits it at a list of locations---
+def master_splitter(line_geometry, cut_locations, profile, offset=0):
+    start_point = 0
+    cut_locations.append(line_geometry.length())
+    cut_locations.sort()
+
+    segment_list = []
+
+    constline = line_geometry.constGet()
+    for cut_spot in cut_locations:
+        line_substring = constline.curveSubstring(start_point, cut_spot)
+        segment_list.append(Segment(line_substring, profile, offset + start_point))
+        start_point = cut_spot
+
+    return segment_list
+
+
+# ---Like master_splitter, but uses CutPoints instead of cut locations---
+def cutpoint_splitter(line_geometry, CutPoint_list, profile):
+    CutPoint_list.sort(key=lambda x: x.cut_location)
+
+    # CutPoints hold info on what hachure generated them; we want to add
+    # that info to the subsequent segments
+
+    segment_list = []
+
+    # Add first segment
+    constline = line_geometry.constGet()
+    line_substring = constline.curveSubstring(
+        0, CutPoint_list[0].cut_location
+    )
+    segment_list.append(Segment(line_substring, profile))
+
+    # Then do all the middle cuts & append hachure data to the Segments
+    for i in range(0, len(CutPoint_list)):
+        start_point = CutPoint_list[i]
+        start_location = start_point.cut_location
+        if i == len(CutPoint_list) - 1:
+            # Checks if we're at end of the list & handles final segment
+            end_location = line_geometry.length()
+        else:
+            end_point = CutPoint_list[i + 1]
+            end_location = end_point.cut_location
+
+        line_substring = constline.curveSubstring(
+            start_location, end_location
+        )
+        new_segment = Segment(line_substring, profile, start_location)
+        segment_list.append(new_segment)
+        if i != len(CutPoint_list) - 1:
+            new_segment.hachures = [start_point.hachure, end_point.hachure]
+
+    return segment_list
@@ -0,0 +1,170 @@
+import math
+
+import numpy as np
+
+# The "flow" tracer: hachures follow D-infinity flow paths run backwards,
+# up-slope from cell to cell. The steepest way up out of every cell is
+# worked out once from the DEM (Tarboton's 8 triangular facets, on the
+# negated DEM), and kept as a pointer to the neighbour it mostly points at.
+# Tracing is then nothing but integer lookups in that pointer array. Paths
+# that only move between neighbouring cells come out jagged, so they are
+# smoothed with a moving average and thinned back to about a jump between
+# vertices afterwards.
+
+# (row, col) of the cardinal (e1) & diagonal (e2) neighbour of each facet
+FACETS = [
+    ((0, 1), (-1, 1)),
+    ((-1, 0), (-1, 1)),
+    ((-1, 0), (-1, -1)),
+    ((0, -1), (-1, -1)),
+    ((0, -1), (1, -1)),
+    ((1, 0), (1, -1)),
+    ((1, 0), (1, 1)),
+    ((0, 1), (1, 1)),
+]
+
+
+def shifted(array, d_row, d_col, fill=np.nan):
+    # array[row + d_row, col + d_col] for every cell, fill off the edge
+    rows, cols = array.shape
+    result = np.full(array.shape, fill, dtype=array.dtype)
+    result[
+        max(-d_row, 0) : rows - max(d_row, 0), max(-d_col, 0) : cols - max(d_col, 0)
+    ] = array[
+        max(d_row, 0) : rows - max(-d_row, 0), max(d_col, 0) : cols - max(-d_col, 0)
+    ]
+    return result
+
+
+# ----The up-slope neighbour of each cell, as a flat index; -1 if none----
+def upslope_pointers(dem, cell_width, cell_height, stop=None):
+    # dem: with NaN for nodata. stop: cells where paths end (e.g. too
+    # shallow), on top of peaks, flats & nodata.
+    rows, cols = dem.shape
+    flat_index = np.arange(rows * cols, dtype=np.int64).reshape(rows, cols)
+
+    best_slope = np.zeros(dem.shape)
+    pointer = np.full(dem.shape, -1, dtype=np.int64)
+    for (r1, c1), (r2, c2) in FACETS:
+        # Distances to the cardinal neighbour & across to the diagonal one
+        d1 = cell_width if c1 else cell_height
+        d2 = cell_height if c1 else cell_width
+        limit = math.atan2(d2, d1)
+
+        e1 = shifted(dem, r1, c1)
+        e2 = shifted(dem, r2, c2)
+        # Rises, since we're going up: D-infinity on the negated DEM
+        s1 = (e1 - dem) / d1
+        s2 = (e2 - e1) / d2
+
+        with np.errstate(invalid="ignore"):
+            angle = np.arctan2(s2, s1)
+            slope = np.hypot(s1, s2)
+            below = angle < 0
+            above = angle > limit
+            slope[below] = s1[below]
+            slope[above] = ((e2 - dem) / math.hypot(d1, d2))[above]
+            angle = np.clip(angle, 0, limit)
+
+            better = slope > best_slope
+        better &= np.isfinite(slope)
+
+        # The neighbour the facet's direction is closest to
+        nearer_diagonal = angle > limit / 2
+        target = np.where(
+            nearer_diagonal,
+            shifted(flat_index, r2, c2, fill=-1),
+            shifted(flat_index, r1, c1, fill=-1),
+        )
+        best_slope[better] = slope[better]
+        pointer[better] = target[better]
+
+    # Only ever strictly up, so a path can never loop
+    flat_dem = dem.ravel()
+    going_up = pointer >= 0
+    going_up[going_up] = flat_dem[pointer[going_up]] > dem[going_up]
+    pointer[~going_up] = -1
+    if stop is not None:
+        pointer[stop] = -1
+
+    return pointer.ravel()
+
+
+# ======THE FIELD: pointers made once per engine, walked per batch======
+class FlowField:
+    def __init__(self, engine):
+        self.engine = engine
+        self.grid = engine.grid
+        dem = np.asarray(engine.dem_array, dtype=np.float64)
+        # Nodata cells are NaN, as in derivatives.horn, so no pointer leads
+        # into them
+        missing = ~np.isfinite(dem)
+        if engine.nodata is not None:
+            missing |= dem == engine.nodata
+        stop = engine.slope_array < engine.min_slope
+        self.pointer = upslope_pointers(
+            np.where(missing, np.nan, dem),
+            self.grid.cell_width,
+            self.grid.cell_height,
+            stop,
+        )
+
+        # As long as the aspect tracer's longest hachure
+        cell_size = min(self.grid.cell_width, self.grid.cell_height)
+        self.max_cells = math.ceil(150 * engine.jump_distance / cell_size)
+        # Smoothing half-window & thinning, about a jump each
+        jump_pixels = engine.jump_distance / engine.average_pixel_size
+        self.smoothing = max(round(jump_pixels), 1)
+
+    def trace(self, xs, ys):
+        # Hachures from arrays of start points, as (xs, ys) lines of two
+        # points or more
+        grid = self.grid
+        profiler = self.engine.profiler
+        row, col = grid.xy_to_rc(xs, ys)
+        inside = (row >= 0) & (row < grid.rows) & (col >= 0) & (col < grid.cols)
+
+        count = len(xs)
+        cells = np.full((count, self.max_cells + 1), -1, dtype=np.int64)
+        cells[inside, 0] = row[inside] * grid.cols + col[inside]
+        lengths = inside.astype(np.int64)
+
+        walkers = np.flatnonzero(inside)
+        for step in range(1, self.max_cells + 1):
+            following = self.pointer[cells[walkers, step - 1]]
+            profiler.count("raster samples", walkers.size)
+            moving = following >= 0
+            walkers = walkers[moving]
+            if walkers.size == 0:
+                break
+            cells[walkers, step] = following[moving]
+            lengths[walkers] += 1
+            profiler.count("traced steps", walkers.size)
+
+        lines = []
+        for i in np.flatnonzero(lengths > 1):
+            path = cells[i, : lengths[i]]
+            line_x = grid.x_min + (path % grid.cols + 0.5) * grid.cell_width
+            line_y = grid.y_max - (path // grid.cols + 0.5) * grid.cell_height
+            # Start exactly where we were asked to, not at the cell centre
+            line_x[0] = xs[i]
+            line_y[0] = ys[i]
+            lines.append(self.smooth(line_x, line_y))
+
+        return lines
+
+    def smooth(self, line_x, line_y):
+        # A centred moving average, its window narrowing towards the ends
+        # so they stay put, then every smoothing-th vertex (and the last)
+        count = len(line_x)
+        index = np.arange(count)
+        half = np.minimum(np.minimum(index, count - 1 - index), self.smoothing)
+
+        def average(values):
+            totals = np.concatenate(([0.0], np.cumsum(values)))
+            return (totals[index + half + 1] - totals[index - half]) / (2 * half + 1)
+
+        keep = index[:: self.smoothing]
+        if keep[-1] != count - 1:
+            keep = np.append(keep, count - 1)
+        return (average(line_x)[keep], average(line_y)[keep])
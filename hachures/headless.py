@@ -0,0 +1,390 @@
+import os
+import tempfile
+
+import numpy as np
+
+from osgeo import gdal, ogr
+
+from qgis.core import QgsGeometry, QgsRectangle
+
+from .aoi import aoi_window, clip_store
+from .contours import build_contours, trace_contours
+from .derivatives import horn
+from .engine import HachureEngine
+from .levels import REFINE, adaptive_levels
+from .params import DEFAULT_PARAMS, needs_dem
+from .prefilter import prefilter_settings, smooth, smoothing_name
+from .profiling import NullProfiler
+from .rasters import Grid, TileCache
+from .writer import HachureWriter, elevations
+from . import tiles
+
+# Runs the whole algorithm from a DEM file, without QGIS' interface: no
+# iface, no project layers, no processing framework, no event loop. Only
+# qgis.core (for the geometries) and GDAL are needed, so it can run on a
+# server, and every call keeps its state to itself, so many can run at once.
+#
+#   from hachures.headless import generate
+#   store = generate("SampleDEM.tif", {"minhs": 5, "maxhs": 50})
+#   for hachure_id in store.ids():
+#       line = store.geometry(hachure_id)
+
+
+# ------Writes contour lines or filled contours, as in gdal_contour-------
+def make_contours(dataset, interval, polygonize=False):
+    def make(path):
+        band = dataset.GetRasterBand(1)
+        source = ogr.GetDriverByName("GPKG").CreateDataSource(path)
+        if polygonize:
+            layer = source.CreateLayer("contours", geom_type=ogr.wkbMultiPolygon)
+            layer.CreateField(ogr.FieldDefn("ID", ogr.OFTInteger))
+            layer.CreateField(ogr.FieldDefn("ELEV_MIN", ogr.OFTReal))
+            layer.CreateField(ogr.FieldDefn("ELEV_MAX", ogr.OFTReal))
+            options = [
+                "ID_FIELD=0",
+                "ELEV_FIELD_MIN=1",
+                "ELEV_FIELD_MAX=2",
+                "POLYGONIZE=YES",
+            ]
+        else:
+            layer = source.CreateLayer("contours", geom_type=ogr.wkbLineString)
+            layer.CreateField(ogr.FieldDefn("ID", ogr.OFTInteger))
+            layer.CreateField(ogr.FieldDefn("ELEV", ogr.OFTReal))
+            options = ["ID_FIELD=0", "ELEV_FIELD=1"]
+
+        options.append(f"LEVEL_INTERVAL={interval}")
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            options.append(f"NODATA={nodata}")
+        gdal.ContourGenerateEx(band, layer, options=options)
+        source = None
+
+    return make
+
+
+# -------An in-memory GDAL raster of an array, e.g. the smoothed DEM-------
+def array_dataset(array, grid, projection=None, nodata=None):
+    dataset = gdal.GetDriverByName("MEM").Create(
+        "", grid.cols, grid.rows, 1, gdal.GDT_Float64
+    )
+    dataset.SetGeoTransform(grid.geotransform())
+    if projection:
+        dataset.SetProjection(projection)
+    band = dataset.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(array)
+    return dataset
+
+
+# ---Reads contours back as (geometry, elevation, ...) tuples, plus their--
+# ---extent-----------------------------------------------------------------
+def read_contours(path, *elevation_fields):
+    source = ogr.Open(path)
+    layer = source.GetLayer(0)
+
+    features = []
+    for feature in layer:
+        geometry = QgsGeometry()
+        geometry.fromWkb(bytes(feature.GetGeometryRef().ExportToWkb()))
+        features.append(
+            (geometry, *(feature.GetField(field) for field in elevation_fields))
+        )
+
+    x_min, x_max, y_min, y_max = layer.GetExtent()
+    source = None
+
+    return features, QgsRectangle(x_min, y_min, x_max, y_max)
+
+
+# ------Everything a run needs before its main loop, made from the DEM------
+class Prepared:
+    def __init__(
+        self,
+        grid,
+        projection,
+        nodata,
+        contours,
+        dem_array=None,
+        slope_array=None,
+        aspect_array=None,
+    ):
+        # Only the params' checks, clip, contours, levels & prefilter went
+        # into these; the others only matter from the main loop on
+        self.grid = grid
+        self.projection = projection
+        self.nodata = nodata
+        self.contours = contours
+        self.dem_array = dem_array
+        self.slope_array = slope_array
+        self.aspect_array = aspect_array
+
+
+def prepare(
+    dem_path,
+    params=None,
+    arrays=True,
+    cache=None,
+    profiler=None,
+    aoi=None,
+    budget=None,
+):
+    # The contours, and with arrays the DEM, slope & aspect arrays (a tiled
+    # run reads its own windows instead). With an aoi, all of them only
+    # cover the window around it, and so does the returned grid. With a
+    # budget, the DEM, slope & aspect are out-of-core rasters.TiledRasters
+    # instead, which hold at most budget bytes of tiles between them. See
+    # generate() for the rest.
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    profiler = profiler or NullProfiler()
+    clip_mode = params["clip"]
+    out_of_core = arrays and budget is not None and aoi is None
+    if out_of_core and (
+        params["contours"] == "numpy"
+        or params["levels"] == "adaptive"
+        or params["prefilter"] is not None
+    ):
+        raise ValueError(
+            "Out-of-core rasters need gdal contours, uniform levels & no "
+            "prefilter, which all go over the whole DEM in memory"
+        )
+
+    dataset = gdal.Open(dem_path)
+    if dataset is None:
+        raise ValueError(f"Cannot open the DEM {dem_path}")
+    grid = Grid.from_geotransform(
+        dataset.GetGeoTransform(), dataset.RasterYSize, dataset.RasterXSize
+    )
+
+    band = dataset.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    smoothing = prefilter_settings(params, grid)
+    dem_array = slope_array = aspect_array = None
+    if aoi is not None:
+        # Only the window is read (& smoothed), with the margin the Horn
+        # kernel & the prefilter need, so its edges come out as they would
+        # on the whole DEM
+        window = aoi_window(grid, aoi, params)
+        with profiler.stage("derivatives"):
+            dem_array, slope_array, aspect_array = tiles.read_window(
+                dem_path, window, grid, smoothing
+            )
+        grid = grid.window(*window)
+        valid = np.isfinite(dem_array)
+        if nodata is not None:
+            valid &= dem_array != nodata
+        if not valid.any():
+            raise ValueError("The area of interest only covers nodata")
+        elevation_min = dem_array[valid].min()
+        elevation_max = dem_array[valid].max()
+    else:
+        elevation_min, elevation_max = band.ComputeRasterMinMax(False)
+    contour_interval = (elevation_max - elevation_min) / params["checks"]
+
+    # Each call gets its own scratch folder for the contours, so parallel
+    # runs never share files. With a cache, they live there instead and
+    # survive the run.
+    with tempfile.TemporaryDirectory(prefix="hachures-") as folder:
+        rectangle = grid.rectangle()
+        extent = (
+            rectangle.xMinimum(),
+            rectangle.yMinimum(),
+            rectangle.xMaximum(),
+            rectangle.yMaximum(),
+        )
+
+        def derivative(name, suffix, make, interval=None):
+            if cache is None:
+                path = os.path.join(folder, name + suffix)
+                make(path)
+                return path
+            return cache.get(dem_path, extent, name, suffix, make, interval)
+
+        adaptive = params["levels"] == "adaptive"
+        if out_of_core:
+            # Nothing is read yet: tiles are, as the main loop needs them
+            dem_array, slope_array, aspect_array = tiles.terrain_rasters(
+                dem_path, grid, cache=TileCache(budget)
+            )
+        elif aoi is None and (
+            arrays
+            or adaptive
+            or smoothing is not None
+            or params["contours"] == "numpy"
+        ):
+            # The DEM is read once; slope, aspect & numpy contours all come
+            # from it in memory
+            dem_array = band.ReadAsArray().astype(np.float64)
+
+        contour_dataset = dataset
+        contour_prefix = "gdal"
+        if aoi is not None:
+            # gdal contours of the window only, from memory; the cache key
+            # has the window's extent
+            contour_dataset = array_dataset(
+                dem_array, grid, dataset.GetProjection(), nodata
+            )
+            if smoothing is not None:
+                contour_prefix = "gdal_" + smoothing_name(smoothing)
+        elif smoothing is not None:
+            # Everything after this sees the smoothed DEM, the gdal
+            # contours included
+            with profiler.stage("prefilter"):
+                dem_array = smooth(dem_array, *smoothing, nodata)
+            contour_dataset = array_dataset(
+                dem_array, grid, dataset.GetProjection(), nodata
+            )
+            contour_prefix = "gdal_" + smoothing_name(smoothing)
+        if aoi is None and not out_of_core and (arrays or adaptive):
+            with profiler.stage("derivatives"):
+                slope_array, aspect_array = horn(
+                    dem_array, grid.cell_width, grid.cell_height, nodata
+                )
+
+        profiler.start("contours")
+        levels = None
+        if adaptive:
+            levels = adaptive_levels(
+                dem_array, slope_array, params, contour_interval, nodata
+            )
+            # The contours are made on the candidates' finer interval, then
+            # thinned down to the kept levels
+            contour_interval = contour_interval / REFINE
+
+        if params["contours"] == "numpy":
+            if clip_mode == "polygon":
+                raise ValueError("numpy contours need the elevation clip")
+            contours = trace_contours(
+                dem_array, grid, contour_interval, nodata, levels
+            )
+        else:
+            line_path = derivative(
+                contour_prefix + "_line_contours",
+                ".gpkg",
+                make_contours(contour_dataset, contour_interval),
+                contour_interval,
+            )
+            line_features, _ = read_contours(line_path, "ELEV")
+            polygon_features = boundary = None
+            if clip_mode == "polygon":
+                filled_path = derivative(
+                    contour_prefix + "_filled_contours",
+                    ".gpkg",
+                    make_contours(contour_dataset, contour_interval, polygonize=True),
+                    contour_interval,
+                )
+                polygon_features, boundary = read_contours(
+                    filled_path, "ELEV_MIN", "ELEV_MAX"
+                )
+            contours = build_contours(
+                line_features, polygon_features, boundary, profiler, levels
+            )
+        profiler.stop("contours")
+
+    projection = dataset.GetProjection()
+    dataset = contour_dataset = None
+
+    if not arrays:
+        dem_array = slope_array = aspect_array = None
+    return Prepared(
+        grid, projection, nodata, contours, dem_array, slope_array, aspect_array
+    )
+
+
+# ==================THE ENTRY POINT: DEM file in, hachures out=============
+def generate(
+    dem_path,
+    params=None,
+    tiling=None,
+    progress=None,
+    seed=None,
+    cache=None,
+    output=None,
+    profiler=None,
+    checkpoint=None,
+    aoi=None,
+    raster_budget=None,
+):
+    # params: as in the script (missing ones take DEFAULT_PARAMS).
+    # tiling: None, or {"size": ..., "overlap": ..., "workers": ...} to run
+    # tiles in a process pool, as the script's tiling does.
+    # progress: progress(i, total) per contour (per tile when tiled); the
+    # run stops early if it returns False.
+    # cache: a hachures.cache.DerivativeCache to keep the contours between
+    # calls, instead of remaking them every time.
+    # output: a .gpkg or .fgb path to stream the hachures to, with Z and
+    # a length attribute.
+    # profiler: a hachures.profiling.Profiler to time the stages & count
+    # the hot-path operations of this run.
+    # checkpoint: a hachures.checkpoint.Checkpoint, so an untiled run saves
+    # its progress as it goes and resumes from it when called again.
+    # aoi: an area of interest (see aoi.py), so only a window of the DEM
+    # around it is read & the hachures are cut back to it. Untiled only.
+    # raster_budget: bytes. For DEMs too big for memory: instead of whole
+    # arrays, the DEM, slope & aspect are read in tiles as the main loop
+    # reaches them, and at most this much of them is kept (least recently
+    # used first out). Untiled runs only; tiled ones read windows anyway.
+    # Returns the HachureStore of the finished hachures, or with an output
+    # the number of hachures written.
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    profiler = profiler or NullProfiler()
+
+    if aoi is not None and tiling is not None:
+        raise ValueError("An area of interest runs untiled")
+
+    prepared = prepare(
+        dem_path, params, tiling is None, cache, profiler, aoi, raster_budget
+    )
+    grid = prepared.grid
+
+    writer = None
+    if output is not None:
+        writer = HachureWriter(output, prepared.projection)
+
+    if tiling is None:
+        engine = HachureEngine(
+            params,
+            grid,
+            prepared.slope_array,
+            prepared.aspect_array,
+            prepared.dem_array if needs_dem(params) else None,
+            seed=seed,
+            profiler=profiler,
+            nodata=prepared.nodata,
+        )
+        if checkpoint is not None and checkpoint.dem_path is None:
+            checkpoint.dem_path = dem_path
+        with profiler.stage("main loop"):
+            store = engine.run(prepared.contours, progress, checkpoint)
+        if aoi is not None:
+            with profiler.stage("aoi clip"):
+                store = clip_store(store, aoi)
+        if writer is not None:
+            with profiler.stage("output"):
+                writer.write_store(
+                    store, elevations(grid, prepared.dem_array, prepared.nodata)
+                )
+        if not isinstance(prepared.slope_array, np.ndarray):
+            tile_cache = prepared.slope_array.source.cache
+            profiler.count("raster tile hits", tile_cache.hits)
+            profiler.count("raster tile misses", tile_cache.misses)
+    else:
+        profiler.start("main loop")
+        store, _ = tiles.run_tiled(
+            params,
+            grid,
+            prepared.contours,
+            dem_path,
+            tile_size=tiling.get("size", 2048),
+            overlap=tiling.get("overlap"),
+            workers=tiling.get("workers"),
+            progress=progress,
+            sink=writer,
+            profiler=profiler,
+        )
+        profiler.stop("main loop")
+
+    if writer is not None:
+        writer.close()
+        return writer.count
+    return store
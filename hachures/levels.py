@@ -0,0 +1,105 @@
+import numpy as np
+
+from .derivatives import NODATA
+from .marching import uniform_levels
+from .params import DEFAULT_PARAMS
+
+# Picks the contour levels the main loop runs over from the terrain, instead
+# of spacing them evenly through the elevation range. Candidate levels come
+# every interval / refine; for the band of DEM cells around each one we take
+# the share of hachure-worthy slope & the mean ideal spacing there, then:
+#   - a run of levels where no cell is steeper than minslope keeps only its
+#     first level, where the hachures coming up from below stop; the others
+#     would only walk over segments that get no hachures. The first steep
+#     level after it is kept too, for new hachures to start from
+#   - elsewhere a level is kept once the mean spacing has changed by step
+#     (of the min/max spacing range) since the last kept one, or after
+#     refine * max_skip candidates at the latest
+# So cliffs get up to refine times the levels of a uniform run and plains
+# or slow, even slopes get max_skip times fewer.
+
+REFINE = 2
+
+
+# ----Ideal spacing as a share of the spacing range, NaN when too flat----
+def spacing_share(slope, params):
+    # HachureEngine.spacing_lookup as a share of the spacing range: 0 at
+    # max spacing, 1 at min spacing, over the slope shifted the same way
+    exponent = params["shift"]
+    shifted = 90 * (np.clip(slope, 0, 90) / 90) ** exponent
+    min_slope = 90 * (params["minslope"] / 90) ** exponent
+    max_slope = 90 * (params["maxslope"] / 90) ** exponent
+
+    share = (np.minimum(shifted, max_slope) - min_slope) / (max_slope - min_slope)
+    share[shifted < min_slope] = np.nan
+    return share
+
+
+# ===============THE SCHEDULER: the levels worth a main loop pass==============
+def adaptive_levels(
+    dem, slope, params, interval, nodata=None, refine=REFINE, max_skip=4, step=0.05
+):
+    # dem, slope: the DEM array & its slope (as from derivatives.horn).
+    # interval: the uniform interval the levels stand in for.
+    # Returns the kept levels, low to high, all multiples of
+    # interval / refine.
+    params = {**DEFAULT_PARAMS, **params}
+    fine = interval / refine
+    candidates = uniform_levels(dem, fine, nodata)
+    if len(candidates) < 2:
+        return candidates
+
+    dem = np.asarray(dem, dtype=np.float64)
+    valid = np.isfinite(dem) & (slope != NODATA)
+    if nodata is not None:
+        valid &= dem != nodata
+
+    # Each cell counts for the candidate level nearest to its elevation
+    band = np.rint((dem[valid] - candidates[0]) / fine).astype(np.int64)
+    band = np.clip(band, 0, len(candidates) - 1)
+    share = spacing_share(slope[valid], params)
+    steep = ~np.isnan(share)
+
+    # Bands with no cells at all (between the steps of an integer DEM, or
+    # past a gap in it) say nothing about the terrain: they're passed over,
+    # not taken for flat ground
+    cells = np.bincount(band, minlength=len(candidates))
+    steep_cells = np.bincount(band[steep], minlength=len(candidates))
+    spacing_sum = np.bincount(
+        band[steep], weights=share[steep], minlength=len(candidates)
+    )
+    mean_share = spacing_sum / np.maximum(steep_cells, 1)
+
+    kept = [0]
+    previous = None
+    change = 0.0
+    for i in range(len(candidates)):
+        if cells[i] == 0:
+            continue
+        if previous is None:
+            previous = i
+            continue
+
+        flat = steep_cells[i] == 0
+        was_flat = steep_cells[previous] == 0
+        skipped = i - kept[-1]
+        last = previous
+        previous = i
+
+        if flat:
+            # Only the first of a flat run
+            if not was_flat:
+                kept.append(i)
+                change = 0.0
+            continue
+        if was_flat:
+            kept.append(i)
+            change = 0.0
+            continue
+
+        change += abs(mean_share[i] - mean_share[last])
+        if change >= step or skipped >= refine * max_skip:
+            kept.append(i)
+            change = 0.0
+
+    return candidates[kept]
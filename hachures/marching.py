@@ -0,0 +1,218 @@
+import numpy as np
+
+# Marching squares: per-level contour lines in a single pass. Instead of
+# running gdal:contour & re-grouping its features by ELEV, the contours can
+# be traced straight from the DEM array. Levels sit at
+# multiples of the interval like gdal_contour's, the DEM values are taken at
+# pixel centres, and each level comes out already dissolved into one
+# (multi)line. No polygons are made, so these go with the "elevation" clip,
+# whose up-slope test is the DEM itself.
+
+# Cell corners: top-left 8, top-right 4, bottom-right 2, bottom-left 1, set
+# when the corner is on or above the level. Cell edges: 0 top, 1 right, 2 bottom,
+# 3 left. Each case gives up to two segments as pairs of edges; 16 & 17 are
+# the saddles 5 & 10 when the cell centre is below the level.
+SEGMENTS = np.full((18, 2, 2), -1, dtype=np.int64)
+for case, pairs in {
+    1: [(3, 2)],
+    2: [(2, 1)],
+    3: [(3, 1)],
+    4: [(0, 1)],
+    5: [(3, 0), (2, 1)],
+    6: [(0, 2)],
+    7: [(3, 0)],
+    8: [(3, 0)],
+    9: [(0, 2)],
+    10: [(0, 1), (3, 2)],
+    11: [(0, 1)],
+    12: [(3, 1)],
+    13: [(2, 1)],
+    14: [(3, 2)],
+    16: [(0, 1), (3, 2)],
+    17: [(3, 0), (2, 1)],
+}.items():
+    for k, pair in enumerate(pairs):
+        SEGMENTS[case, k] = pair
+
+# Where each edge starts & ends, as (row, col) offsets from the cell's
+# top-left corner
+EDGE_START = np.array([(0, 0), (0, 1), (1, 0), (0, 0)])
+EDGE_END = np.array([(0, 1), (1, 1), (1, 1), (1, 0)])
+CORNER_BITS = {(0, 0): 8, (0, 1): 4, (1, 1): 2, (1, 0): 1}
+
+
+# Every segment is turned to run with the higher ground on its left. Two
+# cells sharing an edge then agree on which way the line runs through it,
+# so each point has one segment coming in & one going out.
+def orient_segments():
+    for case in range(18):
+        bits = {16: 5, 17: 10}.get(case, case)
+        for k in range(2):
+            a, b = SEGMENTS[case, k]
+            if a < 0:
+                continue
+            # the middle of each edge, & the lower corner of the first one
+            start = (EDGE_START[a] + EDGE_END[a]) / 2
+            end = (EDGE_START[b] + EDGE_END[b]) / 2
+            low = EDGE_START[a]
+            if not CORNER_BITS[tuple(EDGE_END[a])] & bits:
+                low = EDGE_END[a]
+            # cross product in (col, row) with rows running down: positive
+            # when the low corner is on the right of the way the line runs
+            d = end - start
+            v = low - start
+            if d[1] * v[0] - d[0] * v[1] < 0:
+                SEGMENTS[case, k] = (b, a)
+
+
+orient_segments()
+
+
+def uniform_levels(dem, interval, nodata=None):
+    # Every multiple of the interval within the DEM's range
+    dem = np.asarray(dem, dtype=np.float64)
+    valid = np.isfinite(dem)
+    if nodata is not None:
+        valid &= dem != nodata
+    if not valid.any():
+        return np.empty(0)
+
+    first = np.floor(dem[valid].min() / interval) + 1
+    last = np.floor(dem[valid].max() / interval)
+    return np.arange(first, last + 1) * interval
+
+
+def march(dem, levels, nodata=None):
+    # levels: sorted contour elevations. Returns {level: [(rows, cols),
+    # ...]}: the lines of each level as fractional row/col positions of the
+    # pixel centres, closed rings ending where they start.
+    levels = np.asarray(levels, dtype=np.float64)
+    dem = np.asarray(dem, dtype=np.float64)
+    n_rows, n_cols = dem.shape
+    valid = np.isfinite(dem)
+    if nodata is not None:
+        valid &= dem != nodata
+
+    # -----The one pass: every cell with the levels that cross it--------
+    tl = dem[:-1, :-1]
+    tr = dem[:-1, 1:]
+    br = dem[1:, 1:]
+    bl = dem[1:, :-1]
+    cell_valid = valid[:-1, :-1] & valid[:-1, 1:] & valid[1:, 1:] & valid[1:, :-1]
+    low = np.minimum(np.minimum(tl, tr), np.minimum(br, bl))
+    high = np.maximum(np.maximum(tl, tr), np.maximum(br, bl))
+
+    # A level crosses the cell when some corner is above it & some isn't.
+    # As in gdal_contour, a corner right on the level counts as above it,
+    # which keeps every line a simple chain even on integer DEMs
+    low = np.where(cell_valid, low, 0)
+    high = np.where(cell_valid, high, 0)
+    first = np.searchsorted(levels, low, side="right")
+    last = np.searchsorted(levels, high, side="right") - 1
+    count = np.where(cell_valid, np.maximum(last - first + 1, 0), 0).ravel()
+
+    cell = np.repeat(np.arange(count.size), count)
+    if cell.size == 0:
+        return {}
+    offsets = np.cumsum(count) - count
+    step = np.arange(cell.size) - np.repeat(offsets, count)
+    level_index = first.ravel()[cell] + step
+    level = levels[level_index]
+
+    row, col = np.divmod(cell, n_cols - 1)
+    corners = np.stack(
+        [dem[row, col], dem[row, col + 1], dem[row + 1, col + 1], dem[row + 1, col]]
+    )
+    above = corners >= level
+    case = above[0] * 8 + above[1] * 4 + above[2] * 2 + above[3] * 1
+    centre_below = corners.mean(axis=0) < level
+    case = np.where((case == 5) & centre_below, 16, case)
+    case = np.where((case == 10) & centre_below, 17, case)
+
+    # ----------Segments, their end points & where those sit-------------
+    edges = SEGMENTS[case]  # (crossing, segment, end)
+    has = edges[:, :, 0] >= 0
+    pair, k = np.nonzero(has)
+    edges = edges[pair, k]  # (segment, end)
+    seg_row = row[pair][:, None]
+    seg_col = col[pair][:, None]
+    seg_level = level[pair][:, None]
+
+    row_a = seg_row + EDGE_START[edges, 0]
+    col_a = seg_col + EDGE_START[edges, 1]
+    row_b = seg_row + EDGE_END[edges, 0]
+    col_b = seg_col + EDGE_END[edges, 1]
+    z_a = dem[row_a, col_a]
+    z_b = dem[row_b, col_b]
+    t = (seg_level - z_a) / (z_b - z_a)
+    point_rows = row_a + t * (row_b - row_a)
+    point_cols = col_a + t * (col_b - col_a)
+
+    # An edge is named by its start corner & direction, so the two cells
+    # sharing it agree on the name, and each level has its own nodes
+    horizontal = row_a == row_b
+    edge_id = (row_a * n_cols + col_a) * 2 + np.where(horizontal, 0, 1)
+    key = level_index[pair][:, None] * (n_rows * n_cols * 2) + edge_id
+    nodes, node = np.unique(key, return_inverse=True)
+    node = node.reshape(-1, 2)
+
+    node_rows = np.empty(nodes.size)
+    node_cols = np.empty(nodes.size)
+    node_rows[node.ravel()] = point_rows.ravel()
+    node_cols[node.ravel()] = point_cols.ravel()
+    levels_of_node = np.empty(nodes.size, dtype=np.int64)
+    levels_of_node[node.ravel()] = np.repeat(level_index[pair], 2)
+
+    return link(node, node_rows, node_cols, levels[levels_of_node])
+
+
+def link(node, node_rows, node_cols, node_levels):
+    # Chains the segments (pairs of nodes, in their running direction) into
+    # lines: every node has at most one segment going out & one coming in
+    start_node = node[:, 0]
+    end_node = node[:, 1]
+    out_segment = np.full(node_rows.size, -1, dtype=np.int64)
+    out_segment[start_node] = np.arange(len(node))
+    following = out_segment[end_node]
+    has_before = np.zeros(len(node), dtype=bool)
+    has_before[following[following >= 0]] = True
+
+    following = following.tolist()
+    start_list = start_node.tolist()
+    end_list = end_node.tolist()
+    used = bytearray(len(node))
+    chain = []
+    bounds = [0]
+
+    # Open lines first, from their first segment, then the closed rings
+    heads = np.flatnonzero(~has_before).tolist()
+    for segment in heads + list(range(len(node))):
+        if used[segment]:
+            continue
+        chain.append(start_list[segment])
+        while segment >= 0 and not used[segment]:
+            used[segment] = 1
+            chain.append(end_list[segment])
+            segment = following[segment]
+        bounds.append(len(chain))
+
+    chain = np.array(chain, dtype=np.int64)
+    bounds = np.array(bounds)
+    rows = node_rows[chain]
+    cols = node_cols[chain]
+
+    # A corner right on the level puts two points on the same spot
+    keep = np.ones(chain.size, dtype=bool)
+    keep[1:] = (np.diff(rows) != 0) | (np.diff(cols) != 0)
+    keep[bounds[:-1]] = True
+    kept = np.add.reduceat(keep, bounds[:-1])
+    levels = node_levels[chain[bounds[:-1]]]
+
+    lines = {}
+    rows = np.split(rows[keep], np.cumsum(kept)[:-1])
+    cols = np.split(cols[keep], np.cumsum(kept)[:-1])
+    for level, line_rows, line_cols in zip(levels.tolist(), rows, cols):
+        if len(line_rows) > 1:
+            lines.setdefault(level, []).append((line_rows, line_cols))
+
+    return lines
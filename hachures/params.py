@@ -0,0 +1,29 @@
+# The parameters a run accepts, with the script's default values. See the
+# USER PARAMETERS section of Hachure Generator.py for what each one does.
+DEFAULT_PARAMS = {
+    "minhs": 5,
+    "maxhs": 50,
+    "mins": None,
+    "maxs": None,
+    "minslope": 15,
+    "maxslope": 60,
+    "checks": 100,
+    "shift": 1,
+    "clip": "polygon",
+    "growth": "full",
+    "contours": "gdal",
+    "levels": "uniform",
+    "prefilter": None,
+    "tracer": "fixed",
+}
+
+
+# Whether a run with these params needs the DEM array itself, on top of
+# its slope & aspect
+def needs_dem(params):
+    params = {**DEFAULT_PARAMS, **params}
+    return (
+        params["clip"] == "elevation"
+        or params["growth"] == "lazy"
+        or params["tracer"] == "flow"
+    )
@@ -0,0 +1,106 @@
+import math
+
+import numpy as np
+
+from .params import DEFAULT_PARAMS
+
+# Smooths the DEM in memory before slope, aspect & contours are made from
+# it. A smoother surface gives contours with fewer vertices and traces that
+# zig-zag less, so every later stage gets cheaper. The strength is tied to
+# min_hachure_spacing: detail much finer than the closest hachures can't
+# show on the map anyway.
+#
+# "prefilter" param: None (off), or one of the presets below, as
+# (kernel, sigma as a fraction of min_hachure_spacing)
+PRESETS = {
+    "quality": ("gaussian", 0.1),
+    "balanced": ("gaussian", 0.25),
+    "fast": ("box", 0.5),
+}
+
+
+# -------The (kernel, sigma in pixels) a run's params ask for, or None-----
+def prefilter_settings(params, grid):
+    params = {**DEFAULT_PARAMS, **params}
+    preset = params["prefilter"]
+    if preset is None:
+        return None
+    if preset not in PRESETS:
+        raise ValueError(
+            "prefilter must be None or one of {}, not {!r}".format(
+                ", ".join(sorted(PRESETS)), preset
+            )
+        )
+
+    kernel, fraction = PRESETS[preset]
+    min_hachure_spacing = params["minhs"]
+    if params["mins"] is not None:
+        # map units: turn the spacing back into pixels
+        average_pixel_size = 0.5 * (grid.cell_width + grid.cell_height)
+        min_hachure_spacing = params["mins"] / average_pixel_size
+
+    return kernel, fraction * min_hachure_spacing
+
+
+# ------Tells smoothed DEMs apart in a cache key, e.g. "gaussian_1.25"------
+def smoothing_name(smoothing):
+    # The preset alone isn't enough: its sigma scales with the min spacing
+    kernel, sigma = smoothing
+    return "{}_{!r}".format(kernel, float(sigma))
+
+
+# ---------How many cells each side of a cell the kernel reaches----------
+def kernel_radius(kernel, sigma):
+    if kernel == "gaussian":
+        return max(math.ceil(3 * sigma), 1)
+    # A box as wide as a gaussian of the same variance
+    return max(round((math.sqrt(12 * sigma**2 + 1) - 1) / 2), 1)
+
+
+def kernel_weights(kernel, sigma):
+    radius = kernel_radius(kernel, sigma)
+    if kernel == "box":
+        return np.ones(2 * radius + 1)
+    offsets = np.arange(-radius, radius + 1)
+    return np.exp(-0.5 * (offsets / sigma) ** 2)
+
+
+# ----Convolves along one axis; cells past the edge count for nothing-----
+def convolve_axis(array, weights, axis):
+    radius = len(weights) // 2
+    length = array.shape[axis]
+    result = np.zeros_like(array)
+    for offset, weight in zip(range(-radius, radius + 1), weights):
+        if abs(offset) >= length:
+            continue
+        target = [slice(None)] * array.ndim
+        source = [slice(None)] * array.ndim
+        target[axis] = slice(max(-offset, 0), length - max(offset, 0))
+        source[axis] = slice(max(offset, 0), length - max(-offset, 0))
+        result[tuple(target)] += weight * array[tuple(source)]
+    return result
+
+
+# ===========THE PREFILTER: a smoothed copy of the DEM array============
+def smooth(dem, kernel, sigma, nodata=None):
+    # Separable, and normalized by the weight that actually landed, so
+    # nodata cells and the raster's edges don't drag the values down.
+    # Nodata cells stay nodata.
+    dem = np.asarray(dem, dtype=np.float64)
+    missing = ~np.isfinite(dem)
+    if nodata is not None:
+        missing |= dem == nodata
+    if sigma <= 0:
+        return dem.copy()
+
+    weights = kernel_weights(kernel, sigma)
+    valid = (~missing).astype(np.float64)
+    values = np.where(missing, 0.0, dem)
+    for axis in (0, 1):
+        values = convolve_axis(values, weights, axis)
+        valid = convolve_axis(valid, weights, axis)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        smoothed = values / valid
+    smoothed[missing] = dem[missing]
+    return smoothed
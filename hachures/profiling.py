@@ -0,0 +1,129 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Optional instrumentation for a run: wall time per stage, time per main
+# loop contour, and counts of the hot-path operations. The engine & the
+# script only ever call start/stop/stage/count/contour; a NullProfiler (the
+# default) makes those no-ops, so an unprofiled run pays next to nothing.
+
+
+class Profiler:
+    enabled = True
+
+    def __init__(self):
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+        self.counters = defaultdict(int)
+        self.contours = []  # (elevation, seconds) for each main loop pass
+        self.running = {}
+        self.started = time.perf_counter()
+
+    # ---------------------------Stage timings-------------------------------
+    def start(self, name):
+        self.running[name] = time.perf_counter()
+
+    def stop(self, name):
+        seconds = time.perf_counter() - self.running.pop(name)
+        stage = self.stages[name]
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+        return seconds
+
+    @contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def contour(self, elevation, seconds):
+        self.contours.append((elevation, seconds))
+
+    # ------------------------------Counters---------------------------------
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    # ------------------------------Reports----------------------------------
+    def merge(self, report):
+        # Adds another profiler's report() in, e.g. from a tile worker
+        for name, stage in report["stages"].items():
+            self.stages[name]["calls"] += stage["calls"]
+            self.stages[name]["seconds"] += stage["seconds"]
+        for name, n in report["counters"].items():
+            self.counters[name] += n
+        self.contours.extend(tuple(c) for c in report["contours"])
+
+    def report(self):
+        return {
+            "total_seconds": time.perf_counter() - self.started,
+            "stages": dict(self.stages),
+            "counters": dict(self.counters),
+            "contours": [list(c) for c in self.contours],
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary(self, slowest=5):
+        # The report as lines of a plain-text table, e.g. for tools.log
+        report = self.report()
+        total = report["total_seconds"]
+        lines = ["{:<28}{:>8}{:>12}{:>8}".format("stage", "calls", "seconds", "%")]
+        for name, stage in sorted(
+            report["stages"].items(), key=lambda item: -item[1]["seconds"]
+        ):
+            lines.append(
+                "{:<28}{:>8}{:>12.2f}{:>8.1f}".format(
+                    name,
+                    stage["calls"],
+                    stage["seconds"],
+                    100 * stage["seconds"] / total if total else 0,
+                )
+            )
+        lines.append("{:<28}{:>8}{:>12.2f}".format("total", "", total))
+
+        if report["counters"]:
+            lines.append("")
+            lines.append("{:<28}{:>20}".format("counter", "count"))
+            for name, n in sorted(report["counters"].items()):
+                lines.append("{:<28}{:>20,}".format(name, n))
+
+        if self.contours:
+            seconds = [s for _, s in self.contours]
+            lines.append("")
+            lines.append(
+                "{} contours, {:.3f}s mean, {:.3f}s max; slowest:".format(
+                    len(seconds), sum(seconds) / len(seconds), max(seconds)
+                )
+            )
+            for elevation, s in sorted(self.contours, key=lambda c: -c[1])[:slowest]:
+                lines.append("  elevation {:<18}{:>10.3f}s".format(elevation, s))
+
+        return lines
+
+
+class NullProfiler:
+    # Lets callers skip work (e.g. tile workers profiling for nothing)
+    enabled = False
+
+    def start(self, name):
+        pass
+
+    def stop(self, name):
+        return 0.0
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def contour(self, elevation, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, report):
+        pass
@@ -0,0 +1,235 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+# Out-of-core rasters, for DEMs too big to hold in memory as arrays (a
+# 50k x 50k DEM is 20 GB per float64 copy). A raster is cut into square
+# tiles that are made on demand (read from disk, worked out from other
+# rasters, ...) and kept in an LRU cache with a memory budget, so only the
+# tiles the tracer is working near stay in memory.
+#
+# A TiledRaster can be indexed like the arrays the engine otherwise gets,
+# with arrays of rows & cols (a batch of lookups, answered tile by tile) or
+# with a block of slices, so the engine doesn't need to know which it has.
+#
+# Grid, at the end, is where any of the rasters sits on the map.
+
+# Tells each TileSource's tiles apart in a shared cache
+source_ids = itertools.count()
+
+
+# ------Tiles, least recently used first, within a budget in bytes-------
+class TileCache:
+    def __init__(self, budget=1024**3):
+        self.budget = budget
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, make):
+        # The tile at key, made by make() when it isn't cached. A tile is
+        # an array or a tuple of arrays (the layers of a TileSource).
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return tile
+
+        self.misses += 1
+        tile = make()
+        self.tiles[key] = tile
+        self.nbytes += tile_bytes(tile)
+        # The newest tile always stays, even over budget
+        while self.nbytes > self.budget and len(self.tiles) > 1:
+            _, dropped = self.tiles.popitem(last=False)
+            self.nbytes -= tile_bytes(dropped)
+            self.evictions += 1
+
+        return tile
+
+    def clear(self):
+        self.tiles.clear()
+        self.nbytes = 0
+
+
+def tile_bytes(tile):
+    if isinstance(tile, tuple):
+        return sum(layer.nbytes for layer in tile)
+    return tile.nbytes
+
+
+# ------------A raster's tiles, each made by load() the first time-------
+class TileSource:
+    def __init__(self, shape, load, tile_size=512, cache=None):
+        # load(row, col, rows, cols) makes the block of cells a tile
+        # covers: an array of (rows, cols), or a tuple of them when several
+        # rasters are made together (see layers())
+        self.shape = shape
+        self.load = load
+        self.tile_size = tile_size
+        self.cache = cache if cache is not None else TileCache()
+        self.id = next(source_ids)
+        self.tile_cols = -(-shape[1] // tile_size)
+
+    def tile(self, tile_row, tile_col):
+        def make():
+            row = tile_row * self.tile_size
+            col = tile_col * self.tile_size
+            rows = min(self.tile_size, self.shape[0] - row)
+            cols = min(self.tile_size, self.shape[1] - col)
+            return self.load(row, col, rows, cols)
+
+        return self.cache.get((self.id, tile_row, tile_col), make)
+
+    def layers(self, count):
+        # One TiledRaster per array of the tuples load() makes
+        return [TiledRaster(self, layer) for layer in range(count)]
+
+
+# ----------One raster of a TileSource, indexed like an array------------
+class TiledRaster:
+    def __init__(self, source, layer=None):
+        self.source = source
+        self.layer = layer
+        self.shape = source.shape
+        self.ndim = 2
+
+    def tile(self, tile_row, tile_col):
+        tile = self.source.tile(tile_row, tile_col)
+        return tile if self.layer is None else tile[self.layer]
+
+    def __getitem__(self, index):
+        rows, cols = index
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            row, end_row, _ = rows.indices(self.shape[0])
+            col, end_col, _ = cols.indices(self.shape[1])
+            return self.window(row, col, end_row - row, end_col - col)
+        return self.lookup(rows, cols)
+
+    def lookup(self, rows, cols):
+        # Values at arrays of rows & cols (inside the raster), read tile by
+        # tile: every lookup in the same tile is served by one cache get
+        rows, cols = np.broadcast_arrays(np.asarray(rows), np.asarray(cols))
+        shape = rows.shape
+        rows = rows.ravel()
+        cols = cols.ravel()
+        if rows.size == 0:
+            return np.empty(shape, dtype=self.tile(0, 0).dtype)
+
+        size = self.source.tile_size
+        tile_ids = (rows // size) * self.source.tile_cols + cols // size
+        order = np.argsort(tile_ids, kind="stable")
+        sorted_ids = tile_ids[order]
+        starts = np.flatnonzero(np.diff(sorted_ids)) + 1
+
+        values = None
+        for group in np.split(order, starts):
+            tile_row, tile_col = divmod(int(tile_ids[group[0]]), self.source.tile_cols)
+            tile = self.tile(tile_row, tile_col)
+            if values is None:
+                values = np.empty(rows.size, dtype=tile.dtype)
+            values[group] = tile[
+                rows[group] - tile_row * size, cols[group] - tile_col * size
+            ]
+
+        return values.reshape(shape)
+
+    def window(self, row, col, rows, cols):
+        # A block of cells as an array, put together from its tiles
+        size = self.source.tile_size
+        block = None
+        for tile_row in range(row // size, -(-(row + rows) // size)):
+            for tile_col in range(col // size, -(-(col + cols) // size)):
+                tile = self.tile(tile_row, tile_col)
+                if block is None:
+                    block = np.empty((rows, cols), dtype=tile.dtype)
+                top = max(row, tile_row * size)
+                left = max(col, tile_col * size)
+                bottom = min(row + rows, (tile_row + 1) * size)
+                right = min(col + cols, (tile_col + 1) * size)
+                block[top - row : bottom - row, left - col : right - col] = tile[
+                    top - tile_row * size : bottom - tile_row * size,
+                    left - tile_col * size : right - tile_col * size,
+                ]
+
+        if block is None:
+            return np.empty((rows, cols), dtype=self.tile(0, 0).dtype)
+        return block
+
+
+# -----Where the rasters sit: turns x/y coordinates into rows & columns----
+class Grid:
+    def __init__(self, x_min, y_max, cell_width, cell_height, rows, cols):
+        self.x_min = x_min
+        self.y_max = y_max
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.rows = rows
+        self.cols = cols
+
+    @classmethod
+    def from_extent(cls, extent, rows, cols):
+        return cls(
+            extent.xMinimum(),
+            extent.yMaximum(),
+            extent.width() / cols,
+            extent.height() / rows,
+            rows,
+            cols,
+        )
+
+    @classmethod
+    def from_geotransform(cls, geotransform, rows, cols):
+        # A GDAL geotransform of a north-up raster
+        return cls(
+            geotransform[0],
+            geotransform[3],
+            geotransform[1],
+            -geotransform[5],
+            rows,
+            cols,
+        )
+
+    def geotransform(self):
+        return (self.x_min, self.cell_width, 0, self.y_max, 0, -self.cell_height)
+
+    def window(self, row, col, rows, cols):
+        # The grid of a rectangular block of this one's cells
+        return Grid(
+            self.x_min + col * self.cell_width,
+            self.y_max - row * self.cell_height,
+            self.cell_width,
+            self.cell_height,
+            rows,
+            cols,
+        )
+
+    def rectangle(self):
+        # (QGIS only comes in here: the grid itself is plain numpy)
+        from qgis.core import QgsRectangle
+
+        return QgsRectangle(
+            self.x_min,
+            self.y_max - self.rows * self.cell_height,
+            self.x_min + self.cols * self.cell_width,
+            self.y_max,
+        )
+
+    def xy_to_rc(self, x, y):
+        # Converts arrays of x/y coords to row/col for sampling the rasters
+        col = np.rint((x - self.x_min) / self.cell_width - 0.5).astype(np.int64)
+        row = np.rint((self.y_max - y) / self.cell_height - 0.5).astype(np.int64)
+
+        return (row, col)
+
+    def sample(self, array, x, y, outside=0):
+        # Samples a raster at arrays of x/y, with a fill value off the edge
+        row, col = self.xy_to_rc(x, y)
+        inside = (row >= 0) & (row < self.rows) & (col >= 0) & (col < self.cols)
+        values = np.full(row.shape, outside, dtype=np.float64)
+        values[inside] = array[row[inside], col[inside]]
+
+        return values
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+# ----All hachures as flat coordinate arrays, looked up by integer id----
+class HachureStore:
+    def __init__(self, capacity=1024):
+        # Coordinates of every hachure, one after another. A hachure is
+        # its id's start offset & length into these; when one is removed
+        # or replaced its old coordinates become garbage until compact()
+        self.xs = np.empty(capacity * 16, dtype=np.float64)
+        self.ys = np.empty(capacity * 16, dtype=np.float64)
+        self.used = 0
+        self.garbage = 0
+
+        self.start = np.zeros(capacity, dtype=np.int64)
+        self.length = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.bounds = np.zeros((capacity, 4), dtype=np.float64)
+        self.next_id = 0
+        self.live = 0
+
+    def __len__(self):
+        return self.live
+
+    def ids(self):
+        return np.flatnonzero(self.alive[: self.next_id])
+
+    def coords(self, hachure_id):
+        start = self.start[hachure_id]
+        end = start + self.length[hachure_id]
+        return (self.xs[start:end], self.ys[start:end])
+
+    def geometry(self, hachure_id):
+        # QGIS only comes in for a hachure's geometry & rectangle: the
+        # store itself is plain numpy
+        from .engine import make_lines
+
+        return make_lines(zip(*self.coords(hachure_id)))
+
+    def rectangle(self, hachure_id):
+        from qgis.core import QgsRectangle
+
+        return QgsRectangle(*self.bounds[hachure_id])
+
+    def add(self, line_x, line_y):
+        if self.next_id == len(self.alive):
+            self._grow_ids()
+
+        hachure_id = self.next_id
+        self.next_id += 1
+        # Only alive once placed, so a compact() on the way doesn't move
+        # coordinates it doesn't have yet
+        self._place(hachure_id, line_x, line_y)
+        self.alive[hachure_id] = True
+        self.live += 1
+
+        return hachure_id
+
+    def remove(self, hachure_id):
+        if self.alive[hachure_id]:
+            self.alive[hachure_id] = False
+            self.live -= 1
+            self.garbage += self.length[hachure_id]
+
+    def replace(self, hachure_id, line_x, line_y):
+        # New coordinates for an existing id, e.g. once it has grown
+        self.garbage += self.length[hachure_id]
+        self._place(hachure_id, line_x, line_y)
+
+    def truncate(self, hachure_id, keep, end_x, end_y):
+        # Keep the first points of a hachure and end it at a new point,
+        # all in place since a clipped line is never longer
+        start = self.start[hachure_id]
+        self.garbage += self.length[hachure_id] - keep - 1
+        self.xs[start + keep] = end_x
+        self.ys[start + keep] = end_y
+        self.length[hachure_id] = keep + 1
+        self._set_bounds(hachure_id)
+
+    def compact(self, skip=None):
+        # Squeeze the garbage out, keeping every id and its coordinates
+        # (but skip's, which are about to be replaced)
+        ids = self.ids()
+        if skip is not None:
+            ids = ids[ids != skip]
+        lengths = self.length[ids]
+        new_start = np.cumsum(lengths) - lengths
+        total = int(lengths.sum())
+        old_index = np.arange(total) + np.repeat(self.start[ids] - new_start, lengths)
+
+        capacity = max(total * 2, 1024)
+        xs = np.empty(capacity, dtype=np.float64)
+        ys = np.empty(capacity, dtype=np.float64)
+        xs[:total] = self.xs[old_index]
+        ys[:total] = self.ys[old_index]
+
+        self.xs, self.ys = xs, ys
+        self.start[ids] = new_start
+        self.used = total
+        self.garbage = 0
+
+    def _place(self, hachure_id, line_x, line_y):
+        count = len(line_x)
+        if self.used + count > len(self.xs):
+            if self.garbage > self.used // 2:
+                self.compact(skip=hachure_id)
+            if self.used + count > len(self.xs):
+                capacity = max(len(self.xs) * 2, self.used + count)
+                self.xs = np.resize(self.xs, capacity)
+                self.ys = np.resize(self.ys, capacity)
+
+        self.xs[self.used : self.used + count] = line_x
+        self.ys[self.used : self.used + count] = line_y
+        self.start[hachure_id] = self.used
+        self.length[hachure_id] = count
+        self.used += count
+        self._set_bounds(hachure_id)
+
+    def _set_bounds(self, hachure_id):
+        line_x, line_y = self.coords(hachure_id)
+        self.bounds[hachure_id] = (line_x.min(), line_y.min(), line_x.max(), line_y.max())
+
+    def _grow_ids(self):
+        # The new ids' slots start out zeroed, never as copies of old ones
+        capacity = len(self.alive) * 2
+
+        def grown(array):
+            result = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            result[: len(array)] = array
+            return result
+
+        self.start = grown(self.start)
+        self.length = grown(self.length)
+        self.alive = grown(self.alive)
+        self.bounds = grown(self.bounds)
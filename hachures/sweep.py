@@ -0,0 +1,170 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from qgis.core import QgsGeometry
+
+from .engine import Contour, HachureEngine
+from .headless import prepare
+from .params import DEFAULT_PARAMS, needs_dem
+from .rasters import Grid
+from .tiles import worker_context
+from .writer import HachureWriter, elevations
+
+# Runs many parameter sets over one DEM, to find good spacings & slopes
+# without redoing STEP 1 for every trial. Everything before the main loop
+# (slope, aspect, the contours & their polygons) is made once, then each
+# parameter set runs the main loop in a worker process and writes its own
+# file:
+#
+#   from hachures.sweep import sweep
+#   sweep("SampleDEM.tif", {
+#       "dense": {"minhs": 3, "maxhs": 30},
+#       "sparse": {"minhs": 8, "maxhs": 80, "minslope": 20},
+#   }, "/tmp/trials")   # -> /tmp/trials/dense.gpkg, /tmp/trials/sparse.gpkg
+#
+# The arrays are shared with the workers as memory-mapped .npy files, so
+# each worker only holds the pages it reads.
+
+# What the prepared state depends on: these must be the same for every set.
+# (Adaptive levels & the prefilter are also tuned to params' slopes and
+# spacings, so those come from params, not from each set.)
+PREPARED_PARAMS = ("checks", "clip", "contours", "levels", "prefilter")
+
+# The state each worker process loads once, for all its parameter sets
+shared = {}
+
+
+def load_shared(folder, grid, projection, nodata, contours):
+    shared["grid"] = Grid(*grid)
+    shared["projection"] = projection
+    shared["nodata"] = nodata
+    for name in ("dem", "slope", "aspect"):
+        shared[name] = np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+
+    shared["contours"] = []
+    for line_wkb, poly_wkb, elevation in contours:
+        line = QgsGeometry()
+        line.fromWkb(line_wkb)
+        poly = None
+        if poly_wkb is not None:
+            poly = QgsGeometry()
+            poly.fromWkb(poly_wkb)
+        shared["contours"].append(Contour(line, poly, elevation))
+
+
+# --------------One parameter set, inside a worker process----------------
+def run_one(name, params, path, seed):
+    started = time.perf_counter()
+    grid = shared["grid"]
+    engine = HachureEngine(
+        params,
+        grid,
+        shared["slope"],
+        shared["aspect"],
+        shared["dem"] if needs_dem(params) else None,
+        seed=seed,
+        nodata=shared["nodata"],
+    )
+    store = engine.run(shared["contours"])
+
+    with HachureWriter(path, shared["projection"]) as writer:
+        writer.write_store(store, elevations(grid, shared["dem"], shared["nodata"]))
+
+    return {
+        "name": name,
+        "path": path,
+        "hachures": writer.count,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+# ============THE SWEEP: prepare once, run every parameter set============
+def sweep(
+    dem_path,
+    param_sets,
+    folder,
+    params=None,
+    workers=None,
+    suffix=".gpkg",
+    seed=None,
+    cache=None,
+    progress=None,
+):
+    # param_sets: {name: params} (or a list, named 0, 1, ...), each laid
+    # over params (then DEFAULT_PARAMS). Each set is written to
+    # folder/<name><suffix>, a .gpkg or .fgb file. workers: processes at
+    # once (default: one per core). progress(done, total) is called as
+    # sets finish. Returns a {"name", "path", "hachures", "seconds"} dict
+    # for each set, in the order given.
+    if not isinstance(param_sets, dict):
+        param_sets = {str(i): p for i, p in enumerate(param_sets)}
+    base = {**DEFAULT_PARAMS, **(params or {})}
+    runs = {name: {**base, **p} for name, p in param_sets.items()}
+    for name, run_params in runs.items():
+        for key in PREPARED_PARAMS:
+            if run_params[key] != base[key]:
+                raise ValueError(
+                    f"{name}: {key} can't change within a sweep, it's made "
+                    "once for all sets; pass it in params instead"
+                )
+
+    os.makedirs(folder, exist_ok=True)
+    prepared = prepare(dem_path, base, cache=cache)
+    grid = prepared.grid
+
+    contours = []
+    for contour in prepared.contours:
+        poly = None
+        if contour.polygon is not None:
+            poly = bytes(contour.polygon.asWkb())
+        contours.append((bytes(contour.geometry.asWkb()), poly, contour.elevation))
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="hachures-sweep-") as arrays:
+        np.save(os.path.join(arrays, "dem.npy"), prepared.dem_array)
+        np.save(os.path.join(arrays, "slope.npy"), prepared.slope_array)
+        np.save(os.path.join(arrays, "aspect.npy"), prepared.aspect_array)
+        initargs = (
+            arrays,
+            (
+                grid.x_min,
+                grid.y_max,
+                grid.cell_width,
+                grid.cell_height,
+                grid.rows,
+                grid.cols,
+            ),
+            prepared.projection,
+            prepared.nodata,
+            contours,
+        )
+        # The workers have their own copies from here on
+        prepared = None
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=worker_context(),
+            initializer=load_shared,
+            initargs=initargs,
+        ) as pool:
+            futures = [
+                pool.submit(
+                    run_one,
+                    name,
+                    run_params,
+                    os.path.join(folder, name + suffix),
+                    seed,
+                )
+                for name, run_params in runs.items()
+            ]
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                results[result["name"]] = result
+                if progress is not None:
+                    progress(done, len(futures))
+
+    return [results[name] for name in runs]
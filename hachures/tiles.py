@@ -0,0 +1,307 @@
+import math
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from osgeo import gdal
+
+from qgis.core import QgsGeometry, QgsRectangle
+
+from .derivatives import horn
+from .prefilter import kernel_radius, prefilter_settings, smooth
+from .writer import elevations
+from .engine import Contour, HachureEngine
+from .params import DEFAULT_PARAMS, needs_dem
+from .profiling import NullProfiler, Profiler
+from .rasters import Grid, TileSource
+from .store import HachureStore
+
+# Tiled mode: the DEM is cut into square tiles, each padded with an overlap
+# on every side, and each tile runs the whole main loop in its own process.
+# A tile only keeps the hachures inside its core (the tile minus the
+# overlap), so neighbouring tiles meet at the seams without doubling up.
+# The overlap has to be wide enough that a tile sees every contour &
+# hachure that can reach its core; by default that's the longest possible
+# hachure (150 jumps of 3 px) plus one even_splitter chunk.
+
+
+def default_overlap(params, grid):
+    params = {**DEFAULT_PARAMS, **params}
+    max_hachure_spacing = params["maxhs"]
+    if params["maxs"] is not None:
+        # map units: turn the spacing back into pixels
+        average_pixel_size = 0.5 * (grid.cell_width + grid.cell_height)
+        max_hachure_spacing = params["maxs"] / average_pixel_size
+
+    return math.ceil(150 * 3 + 3 * max_hachure_spacing)
+
+
+# ------Cuts the raster into tiles: (row, col, rows, cols) + the core------
+def tile_windows(grid, tile_size, overlap):
+    windows = []
+    for core_row in range(0, grid.rows, tile_size):
+        for core_col in range(0, grid.cols, tile_size):
+            core_rows = min(tile_size, grid.rows - core_row)
+            core_cols = min(tile_size, grid.cols - core_col)
+
+            row = max(core_row - overlap, 0)
+            col = max(core_col - overlap, 0)
+            rows = min(core_row + core_rows + overlap, grid.rows) - row
+            cols = min(core_col + core_cols + overlap, grid.cols) - col
+
+            core = (core_row, core_col, core_rows, core_cols)
+            windows.append(((row, col, rows, cols), core))
+
+    return windows
+
+
+# --The cells read around a window, as (top, left, bottom, right)--------
+def window_padding(grid, window, smoothing=None):
+    # One extra cell all round (where the raster has it), so the Horn
+    # kernel sees the same neighbours as it would on the whole DEM. With a
+    # prefilter, (kernel, sigma), as many more as the smoothing reaches.
+    row, col, rows, cols = window
+    pad = 1
+    if smoothing is not None:
+        pad += kernel_radius(*smoothing)
+    return (
+        min(row, pad),
+        min(col, pad),
+        min(grid.rows - row - rows, pad),
+        min(grid.cols - col - cols, pad),
+    )
+
+
+# ----Reads one window of the DEM (float64) with its slope & aspect-------
+def read_window(path, window, grid, smoothing=None):
+    row, col, rows, cols = window
+    top, left, bottom, right = window_padding(grid, window, smoothing)
+
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    padded = band.ReadAsArray(
+        col - left, row - top, cols + left + right, rows + top + bottom
+    ).astype(np.float64)
+    nodata = band.GetNoDataValue()
+    dataset = None
+
+    if smoothing is not None:
+        padded = smooth(padded, *smoothing, nodata)
+    slope, aspect = horn(padded, grid.cell_width, grid.cell_height, nodata)
+    inner = (slice(top, top + rows), slice(left, left + cols))
+
+    return padded[inner], slope[inner], aspect[inner]
+
+
+# ---The DEM, slope & aspect of a DEM file, as out-of-core TiledRasters---
+def terrain_rasters(path, grid, smoothing=None, tile_size=512, cache=None):
+    # Each tile comes from read_window, so it matches the whole DEM's
+    # derivatives right up to its edges, and its three layers share one
+    # entry of the cache (a rasters.TileCache)
+    def load(row, col, rows, cols):
+        window = read_window(path, (row, col, rows, cols), grid, smoothing)
+        return tuple(np.ascontiguousarray(layer) for layer in window)
+
+    source = TileSource((grid.rows, grid.cols), load, tile_size, cache)
+    return source.layers(3)
+
+
+# ---------Runs the main loop on one tile, inside a worker process--------
+def run_tile(job):
+    window = job["window"]
+    grid = Grid(*job["grid"])
+    full_grid = Grid(*job["full_grid"])
+    profiler = Profiler() if job["profile"] else NullProfiler()
+
+    with profiler.stage("tile derivatives"):
+        window_dem, slope_array, aspect_array = read_window(
+            job["dem"],
+            window,
+            full_grid,
+            prefilter_settings(job["params"], full_grid),
+        )
+    dem_array = window_dem if job["needs_dem"] else None
+
+    contours = []
+    for line_wkb, poly_wkb, elevation in job["contours"]:
+        line = QgsGeometry()
+        line.fromWkb(line_wkb)
+        poly = None
+        if poly_wkb is not None:
+            poly = QgsGeometry()
+            poly.fromWkb(poly_wkb)
+        contours.append(Contour(line, poly, elevation))
+
+    engine = HachureEngine(
+        job["params"],
+        grid,
+        slope_array,
+        aspect_array,
+        dem_array,
+        seed=job["seed"],
+        profiler=profiler,
+        nodata=job["nodata"],
+    )
+    with profiler.stage("tile main loop"):
+        store = engine.run(contours)
+
+    # Keep only what falls inside this tile's core; the overlap belongs to
+    # the neighbours
+    core = QgsRectangle(*job["core"])
+    elevation = elevations(grid, window_dem, job["nodata"])
+    lines = []
+    for hachure_id in store.ids():
+        trimmed = store.geometry(hachure_id).clipped(core)
+        if trimmed.isEmpty():
+            continue
+        if trimmed.isMultipart():
+            parts = trimmed.asMultiPolyline()
+        else:
+            parts = [trimmed.asPolyline()]
+        for part in parts:
+            if len(part) > 1:
+                xs = np.array([p.x() for p in part], dtype=np.float64)
+                ys = np.array([p.y() for p in part], dtype=np.float64)
+                lines.append((xs, ys, elevation(xs, ys)))
+
+    return {
+        "lines": lines,
+        "avoided": engine.index.avoided,
+        "tested": engine.index.tested,
+        "profile": profiler.report() if job["profile"] else None,
+    }
+
+
+# --A python executable for the workers, even from inside QGIS on Windows--
+def worker_context():
+    context = multiprocessing.get_context("spawn")
+
+    # Inside QGIS, sys.executable is QGIS itself rather than its python
+    name = os.path.basename(sys.executable).lower()
+    if not name.startswith("python"):
+        for candidate in ("python.exe", "python3", "python"):
+            path = os.path.join(sys.exec_prefix, candidate)
+            if os.path.exists(path):
+                context.set_executable(path)
+                break
+
+    return context
+
+
+# -------Runs every tile in a process pool & stitches the results--------
+def run_tiled(
+    params,
+    grid,
+    contours,
+    dem_path,
+    tile_size=2048,
+    overlap=None,
+    workers=None,
+    progress=None,
+    sink=None,
+    profiler=None,
+):
+    # contours: the full Contour list, as the untiled main loop would get
+    # it. Each tile gets those contours clipped to its window, and works
+    # out the slope & aspect of its own window of the DEM at dem_path.
+    # progress is called as progress(done, total) as tiles finish; if it
+    # returns False the run stops there, with only the tiles handed over
+    # so far (those still running are waited for, then thrown away).
+    # Returns a HachureStore holding the stitched hachures, plus the
+    # summed spatial index counters. With a sink (a HachureWriter), each
+    # tile's hachures go straight to it, with their Z, and no store is
+    # kept (None is returned in its place). With a Profiler (not a
+    # NullProfiler), each tile's timings & counters are added to it (so
+    # stage times are summed over the workers).
+    profiler = profiler or NullProfiler()
+    if overlap is None:
+        overlap = default_overlap(params, grid)
+
+    dataset = gdal.Open(dem_path)
+    nodata = dataset.GetRasterBand(1).GetNoDataValue()
+    dataset = None
+
+    jobs = []
+    for seed, (window, core) in enumerate(tile_windows(grid, tile_size, overlap)):
+        row, col, rows, cols = window
+        tile_grid = grid.window(row, col, rows, cols)
+        rectangle = tile_grid.rectangle()
+        core_grid = grid.window(*core)
+        core_rectangle = core_grid.rectangle()
+
+        tile_contours = []
+        for contour in contours:
+            line = contour.geometry.clipped(rectangle)
+            if line.isEmpty():
+                continue
+            poly = None
+            if contour.polygon is not None:
+                poly = bytes(contour.polygon.clipped(rectangle).asWkb())
+            tile_contours.append((bytes(line.asWkb()), poly, contour.elevation))
+
+        jobs.append(
+            {
+                "window": window,
+                "grid": (
+                    tile_grid.x_min,
+                    tile_grid.y_max,
+                    tile_grid.cell_width,
+                    tile_grid.cell_height,
+                    tile_grid.rows,
+                    tile_grid.cols,
+                ),
+                "core": (
+                    core_rectangle.xMinimum(),
+                    core_rectangle.yMinimum(),
+                    core_rectangle.xMaximum(),
+                    core_rectangle.yMaximum(),
+                ),
+                "contours": tile_contours,
+                "params": params,
+                "full_grid": (
+                    grid.x_min,
+                    grid.y_max,
+                    grid.cell_width,
+                    grid.cell_height,
+                    grid.rows,
+                    grid.cols,
+                ),
+                "dem": dem_path,
+                "needs_dem": needs_dem(params),
+                "nodata": nodata,
+                "seed": seed,
+                "profile": profiler.enabled,
+            }
+        )
+
+    # Results are taken in tile order, so the output doesn't depend on
+    # which worker happened to finish first; a tile that finishes early
+    # waits here until those before it are done
+    results = {}
+    next_tile = 0
+    store = None if sink is not None else HachureStore()
+    counters = {"avoided": 0, "tested": 0}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context()) as pool:
+        futures = {pool.submit(run_tile, job): i for i, job in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            results[futures[future]] = future.result()
+            while next_tile in results:
+                result = results.pop(next_tile)
+                next_tile += 1
+                for xs, ys, zs in result["lines"]:
+                    if sink is not None:
+                        sink.write(xs, ys, zs)
+                    else:
+                        store.add(xs, ys)
+                counters["avoided"] += result["avoided"]
+                counters["tested"] += result["tested"]
+                profiler.merge(result["profile"])
+            if progress is not None and not progress(done, len(jobs)):
+                for future in futures:
+                    future.cancel()
+                break
+
+    return store, counters
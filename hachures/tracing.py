@@ -0,0 +1,366 @@
+import numpy as np
+
+from .rasters import TileSource
+
+# The up-slope tracer at the heart of the engine, on numpy alone: the step
+# field it reads its directions from, the batches of lines it grows in
+# lockstep, and the lazy growth that keeps batches between main loop
+# passes. Each takes the HachureEngine it works for (or anything with the
+# same attributes), as flow.FlowField does.
+
+
+# ----The tracer's view of the terrain: one up-slope step per raster cell----
+class StepField:
+    def __init__(self, engine):
+        # The field gets a 1-cell border that stops every hachure. Any
+        # location off the raster is clamped onto that border, so the
+        # tracer never needs a separate bounds check
+        self.grid = engine.grid
+        self.slope_array = engine.slope_array
+        self.aspect_array = engine.aspect_array
+        self.jump_distance = engine.jump_distance
+        self.min_slope = engine.min_slope
+        self.adaptive = engine.tracer == "adaptive"
+        shape = (self.grid.rows + 2, self.grid.cols + 2)
+        # ux/uy are only made for the adaptive tracer
+        count = 6 if self.adaptive else 4
+
+        if isinstance(engine.aspect_array, np.ndarray):
+            fields = self.load(0, 0, *shape)
+        else:
+            # Out-of-core slope & aspect (rasters.TiledRaster): the field
+            # is made tile by tile as the tracer reaches it, and kept in
+            # the same cache as they are
+            aspect = engine.aspect_array.source
+            source = TileSource(shape, self.load, aspect.tile_size, aspect.cache)
+            fields = source.layers(count)
+        self.dx, self.dy, self.no_aspect, self.shallow = fields[:4]
+        self.ux, self.uy = fields[4:] if self.adaptive else (None, None)
+
+    def load(self, row, col, rows, cols):
+        # The fields over a block of the bordered grid, as arrays
+        grid = self.grid
+        dx = np.zeros((rows, cols), dtype=np.float32)
+        dy = np.zeros((rows, cols), dtype=np.float32)
+        no_aspect = np.ones((rows, cols), dtype=bool)
+        shallow = np.ones((rows, cols), dtype=bool)
+        fields = (dx, dy, no_aspect, shallow)
+        if self.adaptive:
+            ux = np.zeros((rows, cols), dtype=np.float32)
+            uy = np.zeros((rows, cols), dtype=np.float32)
+            fields += (ux, uy)
+
+        # The raster cells in the block, past the border
+        top, left = max(row - 1, 0), max(col - 1, 0)
+        bottom = min(row + rows - 1, grid.rows)
+        right = min(col + cols - 1, grid.cols)
+        if bottom <= top or right <= left:
+            return fields
+        cells = (slice(top, bottom), slice(left, right))
+        inner = (
+            slice(top + 1 - row, bottom + 1 - row),
+            slice(left + 1 - col, right + 1 - col),
+        )
+        aspect = self.aspect_array[cells]
+        slope = self.slope_array[cells]
+
+        # The up-slope direction is the aspect + 180, and each step is
+        # jump_distance long, so we bake both into dx/dy once here
+        angle = np.radians(aspect + 180)
+        dx[inner] = np.sin(angle) * self.jump_distance
+        dy[inner] = np.cos(angle) * self.jump_distance
+
+        # An aspect of 0 is how the tracer has always spotted that it left
+        # the raster; shallow marks where lines should end on low slopes
+        no_aspect[inner] = aspect == 0
+        shallow[inner] = slope < self.min_slope
+
+        # The adaptive tracer blends the up-slope unit vectors of the four
+        # nearest cells instead. Cells with no direction (off the raster,
+        # flat) add nothing to the blend.
+        if self.adaptive:
+            has_direction = ~no_aspect[inner] & (aspect >= 0)
+            ux[inner] = np.where(has_direction, np.sin(angle), 0)
+            uy[inner] = np.where(has_direction, np.cos(angle), 0)
+
+        return fields
+
+    def cells(self, x, y):
+        row, col = self.grid.xy_to_rc(x, y)
+        row = np.clip(row + 1, 0, self.grid.rows + 1)
+        col = np.clip(col + 1, 0, self.grid.cols + 1)
+
+        return (row, col)
+
+    def direction(self, x, y):
+        # Bilinear up-slope unit vector at arrays of x/y; (0, 0) where
+        # there's no direction to be had
+        grid = self.grid
+        col = np.clip((x - grid.x_min) / grid.cell_width + 0.5, 0, grid.cols + 1)
+        row = np.clip((grid.y_max - y) / grid.cell_height + 0.5, 0, grid.rows + 1)
+        col0 = np.minimum(col.astype(np.int64), grid.cols)
+        row0 = np.minimum(row.astype(np.int64), grid.rows)
+        fc = col - col0
+        fr = row - row0
+
+        def blend(field):
+            top = field[row0, col0] * (1 - fc) + field[row0, col0 + 1] * fc
+            bottom = field[row0 + 1, col0] * (1 - fc) + field[row0 + 1, col0 + 1] * fc
+            return top * (1 - fr) + bottom * fr
+
+        ux = blend(self.ux)
+        uy = blend(self.uy)
+        norm = np.hypot(ux, uy)
+        norm[norm < 1e-6] = np.inf
+
+        return (ux / norm, uy / norm)
+
+
+# ---Hachures traced together, which can pause at a level and resume-----
+class HachureBatch:
+    def __init__(self, engine, xs, ys, max_steps=150):
+        # Every seed advances one jump per pass, looking its step up in the
+        # step field. The stop rules are the same ones the old point-by-
+        # point loop used, applied to the whole batch at once, so a seed
+        # follows the same path it always did.
+        self.engine = engine
+        step_field = engine.step_field
+        count = len(xs)
+        self.max_steps = max_steps
+        self.line_x = np.empty((count, max_steps + 2), dtype=np.float64)
+        self.line_y = np.empty((count, max_steps + 2), dtype=np.float64)
+        self.line_x[:, 0] = xs
+        self.line_y[:, 0] = ys
+
+        cell = step_field.cells(xs, ys)
+
+        # if we go out of bounds, those lines never start
+        self.started = ~step_field.no_aspect[cell]
+        self.growing = self.started.copy()
+
+        self.line_x[:, 1] = xs + step_field.dx[cell]
+        self.line_y[:, 1] = ys + step_field.dy[cell]
+        self.lengths = np.full(count, 2, dtype=np.int64)
+        self.steps = np.zeros(count, dtype=np.int64)
+
+        # Only filled in by LazyGrowth: the store id of each drawn line
+        self.ids = np.full(count, -1, dtype=np.int64)
+
+        # The adaptive tracer's next stride for each line, and the
+        # direction at its newest point when already known (NaN if not)
+        self.stride = np.full(count, engine.jump_distance, dtype=np.float64)
+        self.kx = np.full(count, np.nan)
+        self.ky = np.full(count, np.nan)
+
+        # Lines paused at a level whose newest point has already passed
+        # the stop rules (see advance)
+        self.checked = np.zeros(count, dtype=bool)
+
+    @classmethod
+    def restore(cls, engine, arrays):
+        # A batch as it was saved by a checkpoint, ready to grow on
+        batch = cls.__new__(cls)
+        batch.engine = engine
+        for name, array in arrays.items():
+            setattr(batch, name, np.array(array))
+        batch.max_steps = batch.line_x.shape[1] - 2
+        return batch
+
+    def coords(self, index):
+        length = self.lengths[index]
+        return (self.line_x[index, :length], self.line_y[index, :length])
+
+    def drawn(self):
+        # if we stopped before we even got 2 points, don't bother
+        return np.flatnonzero(self.started & (self.lengths > 1))
+
+    def advance(self, level=None):
+        # Grow the lines until they stop. With a level, a line also pauses
+        # once its newest point is higher than that level, and picks up
+        # from there on the next call.
+        # A line only pauses after its newest point has passed the stop
+        # rules, and on the next call goes straight on to its next step,
+        # without checking (or counting) that point again. So the main
+        # loop splits & clips the contours in between with the start of
+        # the line full growth traces, with one exception: the zig-zag
+        # rule at the next point can still snip the paused point off. The
+        # finished lines are the same either way (see tests/test_lazy.py).
+        step_field = self.engine.step_field
+        profiler = self.engine.profiler
+        jump_distance_2 = self.engine.jump_distance_2
+        adaptive = self.engine.tracer == "adaptive"
+        line_x, line_y, lengths = self.line_x, self.line_y, self.lengths
+        checked = self.checked
+
+        active = self.growing.copy()
+        while True:
+            # steps is a failsafe in case other checks below fail
+            # to stop the hachures when they should
+            capped = active & ~checked & (self.steps >= self.max_steps)
+            self.growing[capped] = False
+            active &= ~capped
+
+            live = np.flatnonzero(active)
+            if live.size == 0:
+                break
+            fresh = ~checked[live]
+            if not adaptive:
+                # (the adaptive tracer counts its own: the stop checks
+                # below are at points it has already sampled)
+                self.steps[live[fresh]] += 1
+                profiler.count("raster samples", fresh.sum())
+
+            last = lengths[live] - 1
+            x = line_x[live, last]
+            y = line_y[live, last]
+            cell = step_field.cells(x, y)
+
+            # Out of bounds or shallow slopes both mean the line should end
+            ended = fresh & (step_field.no_aspect[cell] | step_field.shallow[cell])
+
+            # Hachures often bounce back and forth in shallow slopes & should
+            # stop. If lines are zig-zagging, every other point will be
+            # separated by only a small distance
+            zig_zag = np.zeros(live.size, dtype=bool)
+            long_enough = fresh & ~ended & (lengths[live] > 3)
+            if long_enough.any():
+                back = last[long_enough] - 2
+                dx = x[long_enough] - line_x[live[long_enough], back]
+                dy = y[long_enough] - line_y[live[long_enough], back]
+                zig_zag[long_enough] = (dx * dx + dy * dy) < jump_distance_2
+
+            # Drop the last point if we left the raster or hit shallow
+            # slopes, or snip off the last couple points if we've gone bad
+            lengths[live[ended]] -= 1
+            lengths[live[zig_zag]] -= 2
+
+            moving = ~(ended | zig_zag)
+            active[live[~moving]] = False
+            self.growing[live[~moving]] = False
+
+            if level is not None:
+                # Past the level: wait here for the next call
+                above = np.zeros(live.size, dtype=bool)
+                heights = self.engine.sample_elevations(x[moving], y[moving])
+                above[moving] = heights > level
+                active[live[above]] = False
+                checked[live[above]] = True
+                moving &= ~above
+            checked[live[moving]] = False
+
+            walkers = live[moving]
+            if adaptive:
+                # A stride that was too long is retried shorter on the
+                # next pass, from the same point
+                new_x, new_y, accepted = self.adaptive_step(
+                    walkers, x[moving], y[moving]
+                )
+                walkers = walkers[accepted]
+                new_x = new_x[accepted]
+                new_y = new_y[accepted]
+            else:
+                step_row = cell[0][moving]
+                step_col = cell[1][moving]
+                new_x = x[moving] + step_field.dx[step_row, step_col]
+                new_y = y[moving] + step_field.dy[step_row, step_col]
+            line_x[walkers, lengths[walkers]] = new_x
+            profiler.count("traced steps", walkers.size)
+            line_y[walkers, lengths[walkers]] = new_y
+            lengths[walkers] += 1
+
+    def adaptive_step(self, walkers, x, y):
+        # One step of the Heun-Euler pair along the bilinear direction
+        # field for each walker: an Euler stride, checked against the
+        # direction at its far end. Where the two disagree by more than
+        # stride_tolerance the stride is retried shorter (down to the
+        # fixed jump, near ridges & valleys); where they agree it grows.
+        # The direction at the far end starts the next stride, so each
+        # step samples the field at one new point. Returns the new points
+        # & which of them were accepted.
+        engine = self.engine
+        field = engine.step_field
+        stride = self.stride[walkers]
+
+        k1x = self.kx[walkers]
+        k1y = self.ky[walkers]
+        unknown = np.isnan(k1x)
+        k1x[unknown], k1y[unknown] = field.direction(x[unknown], y[unknown])
+
+        new_x = x + stride * k1x
+        new_y = y + stride * k1y
+        k2x, k2y = field.direction(new_x, new_y)
+        engine.profiler.count("raster samples", len(walkers) + unknown.sum())
+
+        error = 0.5 * stride * np.hypot(k2x - k1x, k2y - k1y)
+        shortest = stride <= engine.jump_distance
+        accepted = (error <= engine.stride_tolerance) | shortest
+
+        factor = 0.9 * np.sqrt(engine.stride_tolerance / np.maximum(error, 1e-12))
+        self.stride[walkers] = np.clip(
+            stride * np.clip(factor, 0.25, 2), engine.jump_distance, engine.max_stride
+        )
+
+        # An accepted point's direction starts the next stride; a rejected
+        # one keeps the direction where it stands
+        self.kx[walkers] = np.where(accepted, k2x, k1x)
+        self.ky[walkers] = np.where(accepted, k2y, k1y)
+
+        # steps stays in fixed jumps, so max_steps caps the length as before
+        done = walkers[accepted]
+        self.steps[done] += np.maximum(
+            np.rint(stride[accepted] / engine.jump_distance), 1
+        ).astype(np.int64)
+
+        return (new_x, new_y, accepted)
+
+
+# ---Keeps still-growing hachures, traced only as far as the main loop is----
+class LazyGrowth:
+    def __init__(self, store):
+        self.store = store
+        self.batches = []
+        self.owners = {}  # store id of a growing hachure: (batch, index)
+
+    def add(self, batch):
+        # Stores a fresh batch's (so far short) hachures & returns their ids
+        hachure_ids = []
+        for index in batch.drawn():
+            hachure_id = self.store.add(*batch.coords(index))
+            batch.ids[index] = hachure_id
+            self.owners[hachure_id] = (batch, index)
+            hachure_ids.append(hachure_id)
+
+        self.batches.append(batch)
+        return hachure_ids
+
+    def stop(self, hachure_ids):
+        # These hachures were clipped, so they never grow again
+        for hachure_id in hachure_ids:
+            owner = self.owners.pop(hachure_id, None)
+            if owner is not None:
+                batch, index = owner
+                batch.growing[index] = False
+
+    def grow(self, level=None):
+        # Extends every growing hachure up to the given level (or all the
+        # way when there is none), and returns the ids of those that grew.
+        # Lines that shrank below 2 points are removed from the store.
+        grown = []
+        for batch in self.batches:
+            before = batch.lengths.copy()
+            batch.advance(level)
+
+            for index in np.flatnonzero(batch.lengths != before):
+                hachure_id = batch.ids[index]
+                if hachure_id < 0 or hachure_id not in self.owners:
+                    continue
+
+                if batch.lengths[index] > 1:
+                    self.store.replace(hachure_id, *batch.coords(index))
+                    grown.append(hachure_id)
+                else:
+                    self.store.remove(hachure_id)
+                    del self.owners[hachure_id]
+
+        self.batches = [b for b in self.batches if b.growing.any()]
+        return grown
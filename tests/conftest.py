@@ -0,0 +1,76 @@
+import random
+import types
+
+import numpy as np
+import pytest
+
+from hachures.derivatives import horn
+from hachures.profiling import NullProfiler
+from hachures.rasters import Grid
+from hachures.store import HachureStore
+from hachures.tracing import LazyGrowth, StepField
+
+
+def hill(size=120):
+    # A bumpy hill: lines run into its flat top, off the raster & into
+    # zig-zags on the way up
+    r, c = np.mgrid[0:size, 0:size]
+    middle = size / 2
+    dem = 400 * np.exp(-((np.hypot(r - middle, c - middle) / (size / 4)) ** 2))
+    dem += 5 * np.sin(r / 3.0) * np.cos(c / 4.0)
+    return dem
+
+
+def make_engine(dem, tracer="fixed", cell_size=1, min_slope=15, **arrays):
+    # Everything the tracer, flow field & checkpoint read off a
+    # HachureEngine, set up the same way, without the QGIS half of it.
+    # min_slope is the default params' one.
+    # slope_array/aspect_array/dem_array can be passed in (e.g. as
+    # TiledRasters); otherwise they come from the DEM.
+    rows, cols = dem.shape
+    grid = Grid(0, rows * cell_size, cell_size, cell_size, rows, cols)
+    slope, aspect = horn(dem, cell_size, cell_size)
+    engine = types.SimpleNamespace(
+        params={"tracer": tracer},
+        grid=grid,
+        slope_array=arrays.get("slope_array", slope),
+        aspect_array=arrays.get("aspect_array", aspect),
+        dem_array=arrays.get("dem_array", dem),
+        nodata=None,
+        average_pixel_size=cell_size,
+        min_slope=min_slope,
+        tracer=tracer,
+        profiler=NullProfiler(),
+    )
+    engine.jump_distance = engine.average_pixel_size * 3
+    engine.jump_distance_2 = (engine.jump_distance * 1.5) ** 2
+    engine.max_stride = engine.jump_distance * 4
+    engine.stride_tolerance = engine.average_pixel_size * 0.25
+
+    def sample_elevations(xs, ys):
+        return grid.sample(engine.dem_array, xs, ys, outside=np.nan)
+
+    engine.sample_elevations = sample_elevations
+    engine.step_field = StepField(engine)
+    engine.store = HachureStore()
+    engine.lazy_growth = LazyGrowth(engine.store)
+    engine.random = random.Random(1)
+    # The QGIS spatial index over the store: nothing to rebuild here
+    engine.index = types.SimpleNamespace(rebuild=lambda: None)
+    return engine
+
+
+@pytest.fixture
+def engine_for():
+    return make_engine
+
+
+@pytest.fixture
+def hill_dem():
+    return hill()
+
+
+@pytest.fixture
+def seeds():
+    rng = np.random.default_rng(0)
+    return rng.uniform(5, 115, 400), rng.uniform(5, 115, 400)
@@ -0,0 +1,84 @@
+import os
+import threading
+
+from hachures.cache import DerivativeCache
+
+
+def write(data):
+    def make(path):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    return make
+
+
+def test_second_get_is_a_hit(tmp_path):
+    dem = tmp_path / "dem.tif"
+    dem.write_bytes(b"elevations")
+    cache = DerivativeCache(str(tmp_path / "cache"))
+
+    first = cache.get(str(dem), (0, 0, 1, 1), "slope", ".tif", write(b"slope"))
+    second = cache.get(str(dem), (0, 0, 1, 1), "slope", ".tif", write(b"other"))
+
+    assert first == second
+    assert (cache.hits, cache.misses) == (1, 1)
+    with open(second, "rb") as f:
+        assert f.read() == b"slope"
+
+
+def test_edited_dem_misses(tmp_path):
+    dem = tmp_path / "dem.tif"
+    dem.write_bytes(b"elevations")
+    cache = DerivativeCache(str(tmp_path / "cache"))
+    first = cache.get(str(dem), (0, 0, 1, 1), "slope", ".tif", write(b"a"))
+
+    dem.write_bytes(b"new elevations")
+    second = cache.get(str(dem), (0, 0, 1, 1), "slope", ".tif", write(b"b"))
+
+    assert first != second
+
+
+def test_side_by_side_gets_keep_each_others_files(tmp_path):
+    # Two contour subtasks sharing one cache, over budget from the start:
+    # neither's eviction may delete the file the other was just handed
+    dem = tmp_path / "dem.tif"
+    dem.write_bytes(b"elevations" * 1000)
+    cache = DerivativeCache(str(tmp_path / "cache"), max_bytes=1)
+    both_making = threading.Barrier(2)
+    paths = {}
+
+    def run(name):
+        def make(path):
+            both_making.wait(timeout=10)
+            write(name.encode() * 100)(path)
+
+        paths[name] = cache.get(str(dem), (0, 0, 1, 1), name, ".gpkg", make, 5)
+
+    threads = [
+        threading.Thread(target=run, args=(name,)) for name in ("lines", "polygons")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache._dem_hashes) == 1
+    for name, path in paths.items():
+        with open(path, "rb") as f:
+            assert f.read() == name.encode() * 100
+
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    dem = tmp_path / "dem.tif"
+    dem.write_bytes(b"elevations")
+    folder = str(tmp_path / "cache")
+    old = DerivativeCache(folder)
+    stale = old.get(str(dem), (0, 0, 1, 1), "old", ".tif", write(b"x" * 100))
+    os.utime(stale, (0, 0))
+
+    # A later run's cache hasn't handed out the old file, so it can go
+    cache = DerivativeCache(folder, max_bytes=150)
+    fresh = cache.get(str(dem), (0, 0, 1, 1), "new", ".tif", write(b"y" * 100))
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
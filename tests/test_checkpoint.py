@@ -0,0 +1,53 @@
+import types
+
+import numpy as np
+
+from hachures.checkpoint import Checkpoint
+
+# A slope rising to the east
+RAMP = np.tile(np.arange(50) * 0.5, (50, 1))
+
+
+CONTOURS = [types.SimpleNamespace(elevation=e) for e in (10.0, 20.0)]
+
+
+def test_restore_zero_fills_spare_capacity(tmp_path, engine_for):
+    dem = tmp_path / "dem.tif"
+    dem.write_bytes(b"elevations")
+    saved = engine_for(RAMP)
+    for n in range(5):
+        saved.store.add(np.arange(3.0) + n, np.arange(3.0))
+    checkpoint = Checkpoint(str(tmp_path / "run.npz"), dem_path=str(dem))
+    checkpoint.save(saved, CONTOURS, 1)
+
+    resumed = engine_for(RAMP)
+    assert Checkpoint(str(tmp_path / "run.npz"), dem_path=str(dem)).restore(
+        resumed, CONTOURS
+    ) == 1
+
+    store = resumed.store
+    assert store.next_id == 5
+    for hachure_id in range(5):
+        xs, _ = store.coords(hachure_id)
+        np.testing.assert_array_equal(xs, np.arange(3.0) + hachure_id)
+    # Nothing past what was saved: no tiled copies of the saved hachures
+    assert not store.start[5:].any()
+    assert not store.length[5:].any()
+    assert not store.alive[5:].any()
+    assert not store.bounds[5:].any()
+    assert not store.xs[store.used :].any()
+
+
+def test_dem_edited_in_place_starts_over(tmp_path, engine_for):
+    dem = tmp_path / "dem.tif"
+    dem.write_bytes(b"elevations")
+    saved = engine_for(RAMP)
+    saved.store.add(np.arange(3.0), np.arange(3.0))
+    Checkpoint(str(tmp_path / "run.npz"), dem_path=str(dem)).save(saved, CONTOURS, 1)
+
+    # Same shape, extent & params: only the bytes differ
+    dem.write_bytes(b"elevationz")
+    resumed = engine_for(RAMP)
+    checkpoint = Checkpoint(str(tmp_path / "run.npz"), dem_path=str(dem))
+    assert checkpoint.restore(resumed, CONTOURS) == 0
+    assert resumed.store.next_id == 0
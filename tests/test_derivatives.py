@@ -0,0 +1,35 @@
+import numpy as np
+
+from hachures.derivatives import NODATA, horn
+
+
+def test_plane_gives_its_slope_and_facing():
+    # Rising 1 m per 2 m cell to the east: 26.57 degrees, facing west
+    dem = np.tile(np.arange(20.0), (20, 1))
+    slope, aspect = horn(dem, 2, 2)
+    # (the cells off the raster take the edge cells' values, flattening
+    # the edges, so only the inside is the plane)
+    inside = (slice(1, -1), slice(1, -1))
+    np.testing.assert_allclose(slope[inside], np.degrees(np.arctan(0.5)))
+    np.testing.assert_allclose(aspect[inside], 270)
+
+    # Rising to the north (up the rows), on cells twice as tall as wide
+    dem = np.tile(np.arange(20.0)[::-1, None], (1, 20))
+    slope, aspect = horn(dem, 1, 2)
+    np.testing.assert_allclose(slope[inside], np.degrees(np.arctan(0.5)))
+    np.testing.assert_allclose(aspect[inside] % 360, 180)
+
+
+def test_nodata_and_flats():
+    dem = np.tile(np.arange(10.0), (10, 1))
+    dem[4, 4] = -1
+    dem[:, 8:] = 7
+    slope, aspect = horn(dem, 1, 1, nodata=-1)
+
+    assert slope[4, 4] == NODATA and aspect[4, 4] == NODATA
+    # Its neighbours take the centre cell's value instead, so they keep
+    # a slope, and the cells out of its reach are the plane
+    assert (slope[3:6, 3:6] > 0).sum() == 8
+    np.testing.assert_allclose(slope[1:3, 1:7], 45)
+    assert (aspect[:, 9] == NODATA).all()
+    assert (slope[:, 9] == 0).all()
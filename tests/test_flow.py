@@ -0,0 +1,51 @@
+import numpy as np
+
+from hachures.flow import FlowField, upslope_pointers
+
+
+def test_pointers_only_ever_lead_up(hill_dem):
+    pointer = upslope_pointers(hill_dem, 1, 1)
+    flat = hill_dem.ravel()
+    going = pointer >= 0
+
+    assert going.mean() > 0.9
+    assert (flat[pointer[going]] > flat[going]).all()
+    # Every pointer is to one of the 8 neighbours
+    rows, cols = np.divmod(np.flatnonzero(going), hill_dem.shape[1])
+    to_rows, to_cols = np.divmod(pointer[going], hill_dem.shape[1])
+    assert (np.abs(to_rows - rows) <= 1).all()
+    assert (np.abs(to_cols - cols) <= 1).all()
+
+
+def test_pointers_follow_a_plane_and_stop_where_asked():
+    # Rising to the east, so every path heads straight for the last column
+    dem = np.tile(np.arange(10.0), (10, 1))
+    stop = np.zeros(dem.shape, dtype=bool)
+    stop[:, 6] = True
+    dem[0, 0] = np.nan
+    pointer = upslope_pointers(dem, 1, 1, stop).reshape(dem.shape)
+
+    index = np.arange(dem.size).reshape(dem.shape)
+    np.testing.assert_array_equal(pointer[1:, :6], index[1:, 1:7])
+    assert (pointer[:, 6] == -1).all()
+    assert (pointer[:, -1] == -1).all()
+    # Nothing leads into the nodata cell, or out of it
+    assert pointer[0, 0] == -1
+    assert (pointer != 0).all()
+
+
+def test_flow_lines_climb_from_their_seeds(engine_for, hill_dem, seeds):
+    engine = engine_for(hill_dem, "flow")
+    field = FlowField(engine)
+    xs, ys = seeds
+    lines = field.trace(xs, ys)
+
+    assert len(lines) > len(xs) / 2
+    starts = {(x, y) for x, y in zip(xs, ys)}
+    for line_x, line_y in lines:
+        assert (line_x[0], line_y[0]) in starts
+        heights = engine.grid.sample(hill_dem, line_x, line_y, outside=np.nan)
+        assert heights[-1] > heights[0]
+        # Thinned to about a jump between vertices
+        steps = np.hypot(np.diff(line_x), np.diff(line_y))
+        assert (steps[:-1] > engine.average_pixel_size).all()
@@ -0,0 +1,31 @@
+import numpy as np
+
+from hachures.tracing import HachureBatch
+
+
+def test_lines_paused_at_levels_are_starts_of_the_full_lines(
+    engine_for, hill_dem, seeds
+):
+    engine = engine_for(hill_dem)
+    xs, ys = seeds
+    full = HachureBatch(engine, xs, ys)
+    full.advance()
+    lazy = HachureBatch(engine, xs, ys)
+
+    for level in np.arange(0, 420, 7.0):
+        lazy.advance(level)
+        for index in lazy.drawn():
+            lazy_x, lazy_y = lazy.coords(index)
+            full_x, full_y = full.coords(index)
+            # Every paused point passed the stop rules; only a zig-zag
+            # snip at the next step can still take the newest one back
+            count = min(len(lazy_x), len(full_x))
+            assert len(lazy_x) <= len(full_x) + 1
+            np.testing.assert_array_equal(lazy_x[:count], full_x[:count])
+            np.testing.assert_array_equal(lazy_y[:count], full_y[:count])
+
+    lazy.advance()
+    np.testing.assert_array_equal(lazy.lengths, full.lengths)
+    for index in full.drawn():
+        np.testing.assert_array_equal(lazy.coords(index)[0], full.coords(index)[0])
+        np.testing.assert_array_equal(lazy.coords(index)[1], full.coords(index)[1])
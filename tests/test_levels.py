@@ -0,0 +1,20 @@
+import numpy as np
+
+from hachures.derivatives import horn
+from hachures.levels import adaptive_levels
+from hachures.marching import uniform_levels
+
+
+def test_integer_dem_gets_no_more_levels_than_a_float_one():
+    # An even slope stored as whole metres: with interval / refine under a
+    # metre, every other band holds no cells. Those mustn't read as flat
+    # ground, or each step is kept twice over (first flat & first steep).
+    ramp = np.arange(600)[:, None] / 2 * np.ones((1, 50))
+    rounded = np.floor(ramp).astype(np.int16)
+    slope, _ = horn(rounded, 1, 1)
+
+    levels = adaptive_levels(rounded, slope, {}, 1)
+    float_levels = adaptive_levels(ramp, horn(ramp, 1, 1)[0], {}, 1)
+
+    assert len(levels) <= len(uniform_levels(rounded, 1))
+    assert abs(len(levels) - len(float_levels)) <= len(float_levels) // 10
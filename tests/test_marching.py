@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from hachures.marching import march, uniform_levels
+
+
+def on_level(dem, rows, cols):
+    # The DEM interpolated along the cell edge each vertex lies on: every
+    # vertex sits on a row or a column of pixel centres
+    whole_row = rows == np.round(rows)
+    whole_col = cols == np.round(cols)
+    assert (whole_row | whole_col).all()
+
+    heights = np.empty(rows.size)
+    r = np.round(rows[whole_row]).astype(np.int64)
+    c0 = np.minimum(np.floor(cols[whole_row]).astype(np.int64), dem.shape[1] - 2)
+    t = cols[whole_row] - c0
+    heights[whole_row] = dem[r, c0] * (1 - t) + dem[r, c0 + 1] * t
+
+    across = ~whole_row
+    c = np.round(cols[across]).astype(np.int64)
+    r0 = np.minimum(np.floor(rows[across]).astype(np.int64), dem.shape[0] - 2)
+    t = rows[across] - r0
+    heights[across] = dem[r0, c] * (1 - t) + dem[r0 + 1, c] * t
+    return heights
+
+
+@pytest.mark.parametrize("integer", [False, True])
+def test_every_vertex_lies_on_its_level(hill_dem, integer):
+    # An integer DEM puts plenty of corners right on a level
+    dem = np.round(hill_dem) if integer else hill_dem
+    levels = uniform_levels(dem, 10)
+    lines = march(dem, levels)
+
+    assert sorted(lines) == sorted(levels)
+    for level, level_lines in lines.items():
+        for rows, cols in level_lines:
+            assert len(rows) > 1
+            np.testing.assert_allclose(on_level(dem, rows, cols), level, atol=1e-9)
+
+
+def test_lines_inside_the_raster_close_into_rings(hill_dem):
+    # The hill's top levels never reach the edge of the raster
+    lines = march(hill_dem, [300.0, 350.0])
+    for level_lines in lines.values():
+        for rows, cols in level_lines:
+            assert (rows[0], cols[0]) == (rows[-1], cols[-1])
+
+
+def test_nodata_cells_get_no_lines():
+    dem = np.tile(np.arange(10.0), (10, 1))
+    dem[:, 5] = -9999
+    lines = march(dem, [2.5, 5.0, 7.5], nodata=-9999)
+
+    assert sorted(lines) == [2.5, 7.5]
+    for level_lines in lines.values():
+        for rows, cols in level_lines:
+            assert ((cols < 4) | (cols > 6)).all()
+
+
+def test_uniform_levels_are_the_multiples_within_the_range():
+    dem = np.array([[3.0, 17.0], [-9999, 41.0]])
+    np.testing.assert_array_equal(uniform_levels(dem, 10, -9999), [10, 20, 30, 40])
+    assert uniform_levels(np.full((2, 2), -9999.0), 10, -9999).size == 0
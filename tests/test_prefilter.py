@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from hachures.prefilter import kernel_radius, prefilter_settings, smooth
+from hachures.rasters import Grid
+
+
+@pytest.mark.parametrize("kernel", ["gaussian", "box"])
+def test_constant_and_plane_come_through(kernel):
+    # Normalized by the weight that landed: the edges aren't dragged down,
+    # and a plane stays a plane away from them
+    constant = np.full((30, 40), 250.0)
+    np.testing.assert_allclose(smooth(constant, kernel, 2), constant)
+
+    plane = np.tile(np.arange(40.0), (30, 1))
+    radius = kernel_radius(kernel, 2)
+    inside = (slice(None), slice(radius, -radius))
+    np.testing.assert_allclose(smooth(plane, kernel, 2)[inside], plane[inside])
+
+
+def test_nodata_stays_nodata_and_adds_nothing(hill_dem):
+    dem = hill_dem.copy()
+    dem[50:60, 50:60] = -9999
+    smoothed = smooth(dem, "gaussian", 1.5, nodata=-9999)
+
+    assert (smoothed[50:60, 50:60] == -9999).all()
+    valid = dem != -9999
+    assert smoothed[valid].min() >= dem[valid].min()
+    assert smoothed[valid].max() <= dem[valid].max()
+    # Smoother: less change from cell to cell
+    assert np.abs(np.diff(smoothed[:40], axis=1)).sum() < np.abs(
+        np.diff(dem[:40], axis=1)
+    ).sum()
+
+
+def test_settings_scale_with_the_min_spacing():
+    grid = Grid(0, 100, 2, 2, 50, 50)
+    assert prefilter_settings({}, grid) is None
+    assert prefilter_settings({"prefilter": "balanced", "minhs": 8}, grid) == (
+        "gaussian",
+        2.0,
+    )
+    # In map units, turned back into pixels
+    assert prefilter_settings({"prefilter": "fast", "mins": 8}, grid) == ("box", 2.0)
+    with pytest.raises(ValueError):
+        prefilter_settings({"prefilter": "sharp"}, grid)
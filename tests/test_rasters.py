@@ -0,0 +1,70 @@
+import numpy as np
+
+from hachures.rasters import Grid, TileCache, TiledRaster, TileSource
+
+
+def tiled(array, tile_size, cache=None):
+    loads = []
+
+    def load(row, col, rows, cols):
+        loads.append((row, col))
+        return array[row : row + rows, col : col + cols].copy()
+
+    source = TileSource(array.shape, load, tile_size, cache)
+    return TiledRaster(source), loads
+
+
+def test_tiled_raster_reads_like_its_array():
+    array = np.arange(70 * 45, dtype=np.float32).reshape(70, 45)
+    raster, loads = tiled(array, 16)
+    rng = np.random.default_rng(0)
+    rows = rng.integers(0, 70, (20, 30))
+    cols = rng.integers(0, 45, (20, 30))
+
+    np.testing.assert_array_equal(raster[rows, cols], array[rows, cols])
+    assert raster[rows, cols].dtype == np.float32
+    np.testing.assert_array_equal(raster[5:37, 14:45], array[5:37, 14:45])
+    np.testing.assert_array_equal(raster[:, :], array)
+    # Each tile made once: every tile of the raster, the last ones cut short
+    assert sorted(loads) == [(r, c) for r in range(0, 70, 16) for c in range(0, 45, 16)]
+
+
+def test_cache_keeps_to_its_budget_least_recently_used_first():
+    tile = np.zeros((16, 16))  # 2 KB
+    cache = TileCache(budget=3 * tile.nbytes)
+    for key in "abcd":
+        cache.get(key, tile.copy)
+    assert list(cache.tiles) == ["b", "c", "d"]
+    assert (cache.misses, cache.evictions, cache.nbytes) == (4, 1, 3 * tile.nbytes)
+
+    cache.get("b", tile.copy)
+    cache.get("e", tile.copy)
+    assert list(cache.tiles) == ["d", "b", "e"]
+    assert cache.hits == 1
+
+    # The newest tile always stays, even over budget
+    cache.get("big", np.zeros((64, 64)).copy)
+    assert list(cache.tiles) == ["big"]
+
+
+def test_sources_share_a_cache_without_mixing_tiles():
+    cache = TileCache()
+    first, _ = tiled(np.zeros((10, 10)), 8, cache)
+    second, _ = tiled(np.ones((10, 10)), 8, cache)
+    assert first[3, 3] == 0 and second[3, 3] == 1
+    assert len(cache.tiles) == 2
+
+
+def test_grid_sample_and_window():
+    grid = Grid(100, 500, 10, 20, 4, 3)
+    array = np.arange(12.0).reshape(4, 3)
+    # Cell centres, a corner (rounded to even, as round() did), and off
+    # the raster
+    xs = np.array([105, 125, 120.0, 95, 131])
+    ys = np.array([490, 430, 460.0, 490, 430])
+    np.testing.assert_array_equal(grid.sample(array, xs, ys, -1), [0, 11, 8, -1, -1])
+
+    window = grid.window(1, 2, 2, 1)
+    assert window.geotransform() == (120, 10, 0, 480, 0, -20)
+    rows, cols = window.xy_to_rc(np.array([125.0]), np.array([450.0]))
+    assert (rows[0], cols[0]) == (1, 0)
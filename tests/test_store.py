@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+import pytest
+
+from hachures.store import HachureStore
+
+
+def line(rng, count):
+    xs = np.array([rng.uniform(0, 1000) for _ in range(count)])
+    ys = np.array([rng.uniform(0, 1000) for _ in range(count)])
+    return xs, ys
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_store_keeps_every_hachure_through_growth_and_compaction(seed):
+    # add, replace, truncate & remove, as the main loop mixes them, well
+    # past the 1024 ids (& 16k coordinates) a store starts with. Removing
+    # most of what's touched keeps compact() running between adds.
+    rng = random.Random(seed)
+    store = HachureStore()
+    expected = {}
+
+    for _ in range(100):
+        for _ in range(rng.randint(5, 30)):
+            xs, ys = line(rng, rng.randint(2, 150))
+            expected[store.add(xs, ys)] = (xs, ys)
+
+        for hachure_id in rng.sample(sorted(expected), min(100, len(expected))):
+            action = rng.random()
+            if action < 0.6:
+                store.remove(hachure_id)
+                del expected[hachure_id]
+            elif action < 0.7 or len(expected[hachure_id][0]) < 3:
+                xs, ys = line(rng, rng.randint(2, 150))
+                store.replace(hachure_id, xs, ys)
+                expected[hachure_id] = (xs, ys)
+            else:
+                xs, ys = expected[hachure_id]
+                keep = rng.randint(1, len(xs) - 2)
+                end_x, end_y = rng.uniform(0, 1000), rng.uniform(0, 1000)
+                store.truncate(hachure_id, keep, end_x, end_y)
+                expected[hachure_id] = (
+                    np.append(xs[:keep], end_x),
+                    np.append(ys[:keep], end_y),
+                )
+
+    assert store.next_id > 1024
+    assert len(store) == len(expected)
+    assert sorted(store.ids()) == sorted(expected)
+    for hachure_id, (xs, ys) in expected.items():
+        stored_x, stored_y = store.coords(hachure_id)
+        np.testing.assert_array_equal(stored_x, xs)
+        np.testing.assert_array_equal(stored_y, ys)
+        np.testing.assert_array_equal(
+            store.bounds[hachure_id], (xs.min(), ys.min(), xs.max(), ys.max())
+        )
+
+    store.compact()
+    for hachure_id, (xs, ys) in expected.items():
+        np.testing.assert_array_equal(store.coords(hachure_id)[0], xs)
@@ -0,0 +1,162 @@
+import math
+
+import numpy as np
+import pytest
+
+from hachures.rasters import TileCache, TiledRaster, TileSource
+from hachures.tracing import HachureBatch
+
+
+def old_loop(engine, x, y):
+    # The point-by-point tracer the script started out with, kept as the
+    # reference HachureBatch has to match: one seed at a time, sampling
+    # the rasters with 0 off the edge
+    grid = engine.grid
+    jump_distance = engine.jump_distance
+
+    def sample(array, x, y):
+        col = round((x - grid.x_min) / grid.cell_width - 0.5)
+        row = round((grid.y_max - y) / grid.cell_height - 0.5)
+        if row >= grid.rows or col >= grid.cols or row < 0 or col < 0:
+            return 0
+        return array[row, col]
+
+    def step(x, y, value):
+        value += 180
+        return (
+            x + math.sin(math.radians(value)) * jump_distance,
+            y + math.cos(math.radians(value)) * jump_distance,
+        )
+
+    line_coords = [(x, y)]
+    value = sample(engine.aspect_array, x, y)
+    if value == 0:
+        return None
+    line_coords.append(step(x, y, value))
+
+    for _ in range(150):
+        x, y = line_coords[-1]
+        value = sample(engine.aspect_array, x, y)
+        if value == 0:
+            del line_coords[-1]
+            break
+        if sample(engine.slope_array, x, y) < engine.min_slope:
+            del line_coords[-1]
+            break
+        if len(line_coords) > 3:
+            back_x, back_y = line_coords[-3]
+            if (x - back_x) ** 2 + (y - back_y) ** 2 < engine.jump_distance_2:
+                del line_coords[-2:]
+                break
+        line_coords.append(step(x, y, value))
+
+    if len(line_coords) > 1:
+        return np.array(line_coords)
+    return None
+
+
+def traced(batch):
+    lines = {}
+    for index in batch.drawn():
+        xs, ys = batch.coords(index)
+        lines[int(index)] = np.column_stack((xs, ys))
+    return lines
+
+
+def tiled_engine(engine_for, dem, tracer, tile_size=16):
+    # The same engine with slope, aspect & DEM read from TiledRasters
+    cache = TileCache(budget=64 * 1024)
+    whole = engine_for(dem, tracer)
+
+    def tiled(array):
+        def load(row, col, rows, cols):
+            return array[row : row + rows, col : col + cols].copy()
+
+        return TiledRaster(TileSource(array.shape, load, tile_size, cache))
+
+    engine = engine_for(
+        dem,
+        tracer,
+        slope_array=tiled(whole.slope_array),
+        aspect_array=tiled(whole.aspect_array),
+        dem_array=tiled(whole.dem_array),
+    )
+    return engine, cache
+
+
+def test_vectorized_tracer_matches_the_old_loop(engine_for, hill_dem, seeds):
+    engine = engine_for(hill_dem)
+    xs, ys = seeds
+    batch = HachureBatch(engine, xs, ys)
+    batch.advance()
+    lines = traced(batch)
+
+    expected = {}
+    for index, (x, y) in enumerate(zip(xs, ys)):
+        line = old_loop(engine, x, y)
+        if line is not None:
+            expected[index] = line
+
+    assert sorted(lines) == sorted(expected)
+    for index, line in expected.items():
+        # The step field keeps its steps as float32
+        np.testing.assert_allclose(lines[index], line, atol=1e-3)
+
+
+def test_adaptive_lines_climb_in_strides_within_bounds(engine_for, hill_dem, seeds):
+    engine = engine_for(hill_dem, "adaptive")
+    xs, ys = seeds
+    batch = HachureBatch(engine, xs, ys)
+    batch.advance()
+    lines = traced(batch)
+
+    assert lines
+    longer = 0
+    grid = engine.grid
+    for line in lines.values():
+        strides = np.hypot(*np.diff(line, axis=0).T)
+        # (the first step is the step field's, in float32)
+        assert strides.max() <= engine.max_stride + 1e-6
+        assert strides.min() >= engine.jump_distance - 1e-6
+        longer += (strides > engine.jump_distance + 1e-6).any()
+        # Up-slope from start to end, and never off the raster
+        heights = grid.sample(hill_dem, line[:, 0], line[:, 1], outside=np.nan)
+        assert not np.isnan(heights).any()
+        assert heights[-1] > heights[0]
+    # Smooth stretches of the hill take longer strides than the fixed jump
+    assert longer > len(lines) / 2
+
+
+@pytest.mark.parametrize("tracer", ["fixed", "adaptive"])
+def test_tiled_raster_tracing_is_identical_to_in_memory(
+    engine_for, hill_dem, seeds, tracer
+):
+    xs, ys = seeds
+    whole = engine_for(hill_dem, tracer)
+    tiled, cache = tiled_engine(engine_for, hill_dem, tracer)
+
+    expected = HachureBatch(whole, xs, ys)
+    expected.advance()
+    batch = HachureBatch(tiled, xs, ys)
+    batch.advance()
+
+    # The budget only holds a few tiles, so they come & go on the way
+    assert cache.evictions > 0
+    np.testing.assert_array_equal(batch.started, expected.started)
+    np.testing.assert_array_equal(batch.lengths, expected.lengths)
+    for index in expected.drawn():
+        np.testing.assert_array_equal(batch.coords(index), expected.coords(index))
+
+
+def test_tiled_lazy_growth_is_identical_to_in_memory(engine_for, hill_dem, seeds):
+    xs, ys = seeds
+    whole = engine_for(hill_dem)
+    tiled, _ = tiled_engine(engine_for, hill_dem, "fixed")
+
+    expected = HachureBatch(whole, xs, ys)
+    batch = HachureBatch(tiled, xs, ys)
+    for level in np.arange(0, 420, 20.0):
+        expected.advance(level)
+        batch.advance(level)
+        np.testing.assert_array_equal(batch.lengths, expected.lengths)
+        np.testing.assert_array_equal(batch.checked, expected.checked)